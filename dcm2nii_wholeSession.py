@@ -1,7 +1,13 @@
-import argparse, requests, os, sys
-import dicom as dicomLib
-# from shutil import copy as fileCopy
-from nipype.interfaces.dcm2nii import Dcm2nii
+import argparse, requests, os, sys, time, threading, json
+try:
+    import dicom as dicomLib
+except ImportError:
+    import pydicom as dicomLib # pydicom >= 1.0
+from shutil import copy as fileCopy
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 
 def cleanServer(server):
     server.strip()
@@ -24,244 +30,609 @@ def get(url,**kwargs):
 def isTrue(arg):
     return arg is not None and (arg=='Y' or arg=='1' or arg=='True')
 
-
-parser = argparse.ArgumentParser(description="Run dcm2nii on every file in a session")
-parser.add_argument("--host", default="https://cnda.wustl.edu", help="CNDA host", required=True)
-parser.add_argument("--user", help="CNDA username", required=True)
-parser.add_argument("--password", help="Password", required=True)
-parser.add_argument("--session", help="Session ID", required=True)
-parser.add_argument("--cachedir", help="Root output directory for DICOM files", required=True)
-parser.add_argument("--niftidir", help="Root output directory for NIFTI files", required=True)
-parser.add_argument("--overwrite", help="Overwrite NIFTI files if they exist")
-parser.add_argument("--nii", help="Create .nii file, or .img/.hdr pair")
-parser.add_argument("--gzip", help="GZip .nii output into .nii.gz?")
-parser.add_argument('--version', action='version', version='%(prog)s 1')
-
-args = parser.parse_args()
-auth = (args.user,args.password)
-host = cleanServer(args.host)
-session = args.session
-overwrite = isTrue(args.overwrite)
-makenii = isTrue(args.nii)
-gzip = isTrue(args.gzip)
-dicomdir = args.dicomdir
-niftidir = args.niftidir
-
-builddir = os.getcwd()
-
-# Set up working directory
-if not os.access(dicomdir, os.R_OK):
-    print 'Making DICOM directory %s' % dicomdir
-    os.mkdir(dicomdir)
-if not os.access(niftidir, os.R_OK):
-    print 'Making NIFTI directory %s' % niftidir
-    os.mkdir(niftidir)
-
-
-# Get JSESSION token
-r = get( host+"/data/JSESSION", auth=auth, verify=False )
-jsessionID = r.content
-print "JSESSION ID: %s" % jsessionID
-cookie = {"Cookie": "JSESSIONID=" + jsessionID}
-
-# Get list of scan ids
-print "Get scan list for session ID %s." % session
-r = get( host+"/data/experiments/%s/scans?format=json"%session, headers=cookie, verify=False )
-scanRequestResultList = r.json()["ResultSet"]["Result"]
-scanIDList = [scan['ID'] for scan in scanRequestResultList]
-print 'Found scans %s.'%', '.join(scanIDList)
-
-for scanid in scanIDList:
-    print
-    print 'Beginning process for scan %s.'%scanid
-
-    # Get scan resources
-    print "Get scan resources for scan %s." % scanid
-    r = get( host+"/data/experiments/%s/scans/%s/resources?format=json"%(session,scanid), headers=cookie, verify=False )
-    scanResources = r.json()["ResultSet"]["Result"]
-    print 'Found resources %s.'%', '.join(res["label"] for res in scanResources)
-
-    ##########
-    # Do initial checks to determine if scan should be skipped
-    hasNifti = any([res["label"]=="NIFTI" for res in scanResources]) # Store this for later
-    if hasNifti and not overwrite:
-        print "Scan %s has a preexisting NIFTI resource, and I am running with overwrite=False. Skipping." % scanid
-        continue
-
-    dicomResourceList = [res for res in scanResources if res["label"]=="DICOM"]
-    if len(dicomResourceList) == 0:
-        print "Scan %s has no DICOM resource. Skipping." % scanid
-        # scanInfo['hasDicom'] = False
-        continue
-    elif len(dicomResourceList) > 1:
-        print "Scan %s has more than one DICOM resource. Skipping." % scanid
-        # scanInfo['hasDicom'] = False
-        continue
-
-    dicomResource = dicomResourceList[0]
-    if int(dicomResource["file_count"]) == 0:
-        print "DICOM resource for scan %s has no files. Skipping." % scanid
-        # scanInfo['hasDicom'] = True
-        continue
-
-    ##########
-    # Prepare DICOM directory structure
-    print
-    scanDicomDir = os.path.join(dicomdir,scanid)
-    if not os.access(scanDicomDir, os.R_OK):
-        print 'Making scan DICOM directory %s.' % scanDicomDir
-        os.mkdir(scanDicomDir)
-    # Remove any existing files in the cachedir.
-    # This is unlikely to happen in any environment other than testing.
-    for f in os.listdir(scanDicomDir):
-        os.remove(os.path.join(scanDicomDir,f))
-
-    ##########
-    # Get list of DICOMs
-    print 'Get list of DICOM files for scan %s.' % scanid
-    r = get( host+"/data/experiments/%s/scans/%s/resources/DICOM/files?format=json"%(session,scanid), headers=cookie, verify=False )
-    # I don't like the results being in a list, so I will build a dict keyed off file name
-    dicomFileDict = {dicom['Name']: {'URI':dicom['URI']} for dicom in r.json()["ResultSet"]["Result"]}
-
-    # Have to manually add absolutePath with a separate request
-    r = get( host+"/data/experiments/%s/scans/%s/resources/DICOM/files?format=json&locator=absolutePath"%(session,scanid),
-        headers=cookie, verify=False )
-    for dicom in r.json()["ResultSet"]["Result"]:
-        dicomFileDict[dicom['Name']]['absolutePath'] = dicom['absolutePath']
-
-    ##########
-    # Download DICOMs
-    print "Downloading files for scan %s." % scanid
-    os.chdir(scanDicomDir)
-    for j,(name,pathDict) in enumerate(dicomFileDict.iteritems()):
-        skipScan = False
-
-        if os.access(pathDict['absolutePath'], os.R_OK):
-            try:
-                os.symlink(pathDict['absolutePath'],name)
-                print 'Made link to %s.' % pathDict['absolutePath']
-            except:
-                fileCopy(pathDict['absolutePath'],name)
-                print 'Copied %s.' % pathDict['absolutePath']
-        else:
-            with open(name, 'wb') as f:
-                r = get(pathDict['URI'], headers=cookie, verify=False, stream=True)
-
-                if not r.ok:
-                    print "Could not download file %s. Skipping scan %s." % (name,scanid)
-                    skipScan = True
-                    continue # break out of file download loop
-
-                for block in r.iter_content(1024):
-                    if not block:
-                        break
-
-                    f.write(block)
-            print 'Downloaded file %s.' % name
-
-        if j==0 and not skipScan:
-            # For the first file in the list, we want to check its headers.
-            # If its modality indicates it is secondary, we don't want to convert the
-            # series and there is no reason to continue downloading the rest of the files.
-            print 'Checking modality in DICOM headers of file %s.'%name
-            d = dicomLib.read_file(name)
-            modalityHeader = d.get((0x0008,0x0060), None)
-            if modalityHeader:
-                print 'Modality header: %s'%modalityHeader
-                modality = modalityHeader.value.strip("'").strip('"')
-                skipScan = modality == 'SC' or modality == 'SR'
-                if skipScan:
-                    print 'Scan %s is a secondary capture. Skipping.' % scanid
-                    continue # break out of file download loop
-            else:
-                print 'Could not read modality from DICOM headers. Skipping.'
-                skipScan = True
-                continue # break out of file download loop
-
-        pathDict['localPath'] = os.path.join(scanDicomDir,name)
-    os.chdir(builddir)
-
-    if skipScan:
-        # break out of the rest of the processing for scanid
-        continue
-
-    print 'Done downloading for scan %s.'%scanid
-    print
-
-
-    ##########
-    # Prepare NIFTI directory structure
-    scanNiftiDir = os.path.join(niftidir,scanid)
-    if not os.access(scanNiftiDir, os.R_OK):
-        print 'Creating scan NIFTI directory %s.' % scanNiftiDir
-        os.mkdir(scanNiftiDir)
-    # Remove any existing files in the cachedir.
-    # This is unlikely to happen in any environment other than testing.
-    for f in os.listdir(scanNiftiDir):
-        os.remove(os.path.join(scanNiftiDir,f))
-
-    ##########
-    # Prepare and run Dcm2nii nipype interface
+def dcm2nii(sourceNames, outputDir, makenii, gzip):
+    """
+    :param sourceNames are DICOM files of one scan:
+    :param outputDir:
+    :param makenii; else .img/.hdr pairs:
+    :param gzip:
+    :return list of converted files:
+    """
+    from nipype.interfaces.dcm2nii import Dcm2nii
     converter = Dcm2nii()
-    converter.inputs.source_names = [pathDict['localPath'] for pathDict in dicomFileDict.itervalues()]
+    converter.inputs.source_names = sourceNames
     converter.inputs.nii_output = makenii
     converter.inputs.gzip_output = gzip
-    converter.inputs.output_dir = scanNiftiDir
+    converter.inputs.output_dir = outputDir
     converter.inputs.reorient = False
     converter.inputs.reorient_and_crop = False
-
-    print 'Converting scan %s to NIFTI...' % scanid
     print converter.cmdline
     result = converter.run()
-    print 'Done.'
 
     outfiles = result.outputs.converted_files
     # If one file was created, we get a string. If more than one, a list.
     # We want a list no matter what.
     if isinstance(outfiles, basestring):
-        # The result is a string, not a list
-        outfilesList = [outfiles]
+        return [outfiles]
+    return outfiles
+
+# NIfTI-1 header, little-endian, 348 bytes
+NIFTI_HEADER = '<i10s18sihcB8h3fhhhh8ffffhBBffffii80s24shh6f4f4f4f16s4s'
+NIFTI_DATATYPES = {'uint8': (2, 8), 'int16': (4, 16), 'int32': (8, 32), 'float32': (16, 32), 'float64': (64, 64),
+                   'int8': (256, 8), 'uint16': (512, 16), 'uint32': (768, 32)}
+
+def niftiHeader(shape, dtype, affine, pixdim, makenii=True, slope=1.0, inter=0.0, descrip=''):
+    """
+    :param shape of the volume, indexed (column, row, slice[, frame]):
+    :param dtype of the stored voxels:
+    :param affine is the 4x4 numpy array from indices to RAS mm:
+    :param pixdim are voxel sizes in mm, and frame duration in sec for 4D:
+    :param makenii for a single .nii; else the header of an .hdr/.img pair:
+    :param slope and inter scale stored voxels:
+    :param descrip:
+    :return bytes of the header, followed by an empty extension for .nii:
+    """
+    import struct
+    import numpy as np
+    datatype, bitpix = NIFTI_DATATYPES[np.dtype(dtype).name]
+    dim = [len(shape)] + list(shape) + [1] * (7 - len(shape))
+    zooms = np.sqrt((affine[:3, :3] ** 2).sum(axis=0))
+    R = affine[:3, :3] / zooms
+    qfac = 1.0
+    if np.linalg.det(R) < 0:
+        qfac = -1.0
+        R[:, 2] = -R[:, 2]
+    b, c, d = quaternion(R)
+    pd = [qfac] + list(pixdim) + [1.0] * (7 - len(pixdim))
+    fields = [348, b'', b'', 0, 0, b'r', 0] + dim + [0.0, 0.0, 0.0, 0, datatype, bitpix, 0] + pd
+    fields += [352.0 if makenii else 0.0, slope, inter, 0, 0, 2 | (8 if len(shape) > 3 else 0), # mm, sec
+               0.0, 0.0, 0.0, 0.0, 0, 0, descrip.encode('ascii', 'replace')[:79], b'',
+               1, 1, b, c, d] # qform and sform are scanner coordinates
+    fields += list(affine[:3, 3]) + list(affine[0]) + list(affine[1]) + list(affine[2])
+    fields += [b'', b'n+1\0' if makenii else b'ni1\0']
+    header = struct.pack(NIFTI_HEADER, *fields)
+    return header + (b'\0' * 4 if makenii else b'')
+
+def quaternion(R):
+    """
+    :param R is a proper 3x3 rotation:
+    :return (b, c, d) of the NIfTI quaternion, with a >= 0:
+    """
+    import numpy as np
+    a = 0.5 * np.sqrt(max(1.0 + R[0, 0] + R[1, 1] + R[2, 2], 0.0))
+    if a > 1e-4:
+        return 0.25 * (R[2, 1] - R[1, 2]) / a, 0.25 * (R[0, 2] - R[2, 0]) / a, 0.25 * (R[1, 0] - R[0, 1]) / a
+    # rotation near 180 degrees
+    i = int(np.argmax(np.diag(R)))
+    j, k = (i + 1) % 3, (i + 2) % 3
+    q = np.zeros(3)
+    q[i] = 0.5 * np.sqrt(max(1.0 + R[i, i] - R[j, j] - R[k, k], 0.0))
+    q[j] = 0.25 * (R[j, i] + R[i, j]) / q[i]
+    q[k] = 0.25 * (R[k, i] + R[i, k]) / q[i]
+    s = np.sign(0.25 * (R[k, j] - R[j, k]) / q[i]) or 1.0 # keeps a >= 0
+    return tuple(s * q)
+
+def readSlice(fn):
+    """
+    :param fn is a single-frame DICOM:
+    :return dict of the fields dcm2niiNative needs, and the pixel array:
+    """
+    d = dicomLib.read_file(fn)
+    return {'series': (str(d.get('SeriesInstanceUID', '')), tuple(float(x) for x in d.ImageOrientationPatient),
+                       d.Rows, d.Columns),
+            'ipp': [float(x) for x in d.ImagePositionPatient],
+            'spacing': [float(x) for x in d.PixelSpacing],
+            'thickness': float(d.get('SliceThickness') or 1),
+            'instance': int(d.get('InstanceNumber') or 0),
+            'slope': float(d.get('RescaleSlope') or 1),
+            'inter': float(d.get('RescaleIntercept') or 0),
+            'name': '%s_%s' % (str(d.get('SeriesDescription', 'series')), str(d.get('SeriesNumber', ''))),
+            'pixels': d.pixel_array}
+
+def dcm2niiNative(sourceNames, outputDir, makenii, gzip, nthreads=4, compresslevel=6):
+    """
+    converts in-process, a drop-in for dcm2nii.  Slices are decoded on a thread pool, grouped by series, orientation
+    and matrix, sorted by ImagePositionPatient along the slice normal, and stacked into one contiguous array per
+    group; slices repeating a position are frames of a 4D volume, ordered by InstanceNumber.  A common rescale is
+    kept in scl_slope and scl_inter; differing rescales are applied in one vectorized pass to float32.
+    :param sourceNames are DICOM files of one scan:
+    :param outputDir:
+    :param makenii; else .img/.hdr pairs:
+    :param gzip:
+    :param nthreads decoding slices:
+    :param compresslevel of gzip:
+    :return list of converted files:
+    """
+    import re
+    import numpy as np
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, min(nthreads, len(sourceNames))))
+    try:
+        slices = pool.map(readSlice, sourceNames)
+    finally:
+        pool.close()
+        pool.join()
+    groups = {}
+    for s in slices:
+        groups.setdefault(s['series'], []).append(s)
+
+    outfiles = []
+    for n, key in enumerate(sorted(groups)):
+        group = groups[key]
+        iop = np.array(key[1])
+        normal = np.cross(iop[:3], iop[3:])
+        group.sort(key=lambda s: (round(np.dot(s['ipp'], normal), 3), s['instance']))
+        positions = sorted(set(round(np.dot(s['ipp'], normal), 3) for s in group))
+        nz = len(positions)
+        nt = len(group) // nz
+        if nz * nt != len(group):
+            raise AssertionError('dcm2niiNative found %d slices at %d positions' % (len(group), nz))
+        # frames of each position are adjacent; reorder to (frame, slice)
+        order = np.arange(len(group)).reshape(nz, nt).T.ravel()
+        pixels = np.stack([group[i]['pixels'] for i in order]) # (frame * slice, row, column), contiguous
+        pixels = pixels.astype(pixels.dtype.newbyteorder('<'), copy=False)
+        slope = np.array([group[i]['slope'] for i in order], dtype='float32')
+        inter = np.array([group[i]['inter'] for i in order], dtype='float32')
+        if np.ptp(slope) == 0 and np.ptp(inter) == 0:
+            sl, it = float(slope[0]), float(inter[0])
+        else:
+            pixels = pixels * slope.reshape(-1, 1, 1) + inter.reshape(-1, 1, 1)
+            sl, it = 1.0, 0.0
+
+        ipp = np.array([group[i]['ipp'] for i in order[:nz]])
+        dr, dc = group[0]['spacing']
+        step = (ipp[-1] - ipp[0]) / (nz - 1) if nz > 1 else normal * group[0]['thickness']
+        affine = np.eye(4)
+        affine[:3, 0] = iop[:3] * dc
+        affine[:3, 1] = iop[3:] * dr
+        affine[:3, 2] = step
+        affine[:3, 3] = ipp[0]
+        affine = np.diag([-1, -1, 1, 1]).dot(affine) # LPS to RAS
+        shape = (key[3], key[2], nz) + ((nt,) if nt > 1 else ())
+        pixdim = [dc, dr, float(np.linalg.norm(step))]
+
+        root = re.sub(r'[^\w.-]+', '_', group[0]['name']) + ('_%d' % n if len(groups) > 1 else '')
+        header = niftiHeader(shape, pixels.dtype, affine, pixdim, makenii=makenii, slope=sl, inter=it,
+                             descrip=group[0]['name'])
+        if makenii:
+            outfiles.append(writeNifti(os.path.join(outputDir, root + '.nii'), [header, pixels], gzip, compresslevel))
+        else:
+            outfiles.append(writeNifti(os.path.join(outputDir, root + '.hdr'), [header], gzip, compresslevel))
+            outfiles.append(writeNifti(os.path.join(outputDir, root + '.img'), [pixels], gzip, compresslevel))
+    return outfiles
+
+def writeNifti(fn, parts, gzip, compresslevel=6):
+    """
+    streams parts, bytes or arrays of slices, to fn, or to fn.gz
+    :return filename written:
+    """
+    import gzip as gz
+    if gzip:
+        fn += '.gz'
+        f = gz.open(fn, 'wb', compresslevel)
     else:
-        # The result is a list, not a string
-        outfilesList = outfiles
-
+        f = open(fn, 'wb')
+    with f:
+        for part in parts:
+            if isinstance(part, bytes):
+                f.write(part)
+                continue
+            for k in range(len(part)):
+                f.write(part[k].tobytes())
+    return fn
+
+
+
+class SessionPipeline(object):
+    """Converts every scan of a session to NIFTI in three stages, download, convert and upload, each with its own
+       workers, so that downloading scan k+1, converting scan k and uploading scan k-1 overlap."""
+
+    block_size = 1048576 # bytes per block of downloads
+    probe_bytes = 65536 # leading bytes of the first DICOM read to find its modality
+    skip_xsitypes = ('xnat:scScanData', 'xnat:srScanData', 'xnat:otherDicomScanData') # secondary, report, non-imaging
+    skip_modalities = ('SC', 'SR', 'KO', 'PR', 'DOC')
+
+    @property
+    def bytes_avoided(self):
+        """is the sum over scans of the session of bytes not downloaded because the scan was skipped"""
+        return sum(t['avoided'] for t in self.timing.values())
+
+    def scan_ids(self):
+        print "Get scan list for session ID %s." % self.session
+        r = get( self.host+"/data/experiments/%s/scans?format=json"%self.session, headers=self.cookie, verify=False )
+        scanRequestResultList = r.json()["ResultSet"]["Result"]
+        self.scans = dict((scan['ID'], scan) for scan in scanRequestResultList)
+        scanIDList = [scan['ID'] for scan in scanRequestResultList]
+        print 'Found scans %s.'%', '.join(scanIDList)
+        return scanIDList
+
+    def run(self, scanIDList=None):
+        """
+        :param scanIDList; default is all scans of the session:
+        :return self.timing, keyed by scan ID:
+        """
+        if scanIDList is None:
+            scanIDList = self.scan_ids()
+        nDownload, nConvert, nUpload = [max(1, n) for n in self.nworkers]
+        scans = Queue()
+        for scanid in scanIDList:
+            scans.put(scanid)
+        for _ in range(nDownload):
+            scans.put(None)
+        converts = Queue(maxsize=nConvert)
+        uploads = Queue(maxsize=nUpload)
+
+        downloaders = self.__start(nDownload, self.download, scans, converts)
+        converters = self.__start(nConvert, self.convert, converts, uploads)
+        uploaders = self.__start(nUpload, self.upload, uploads, None)
+        for stage, n, qout in [(downloaders, nConvert, converts), (converters, nUpload, uploads), (uploaders, 0, None)]:
+            for t in stage:
+                t.join()
+            for _ in range(n):
+                qout.put(None)
+        return self.timing
+
+    def download(self, scanid):
+        """
+        :param scanid:
+        :return job dict for convert, or None if the scan is skipped:
+        """
+        print
+        print 'Beginning process for scan %s.'%scanid
+        self.__time(scanid, status='downloading')
+        t0 = time.time()
+
+        # Get scan resources
+        print "Get scan resources for scan %s." % scanid
+        r = self.__get( self.host+"/data/experiments/%s/scans/%s/resources?format=json"%(self.session,scanid) )
+        scanResources = r.json()["ResultSet"]["Result"]
+        print 'Found resources %s.'%', '.join(res["label"] for res in scanResources)
+
+        ##########
+        # Do initial checks to determine if scan should be skipped
+        hasNifti = any([res["label"]=="NIFTI" for res in scanResources]) # Store this for later
+        if hasNifti and not self.overwrite:
+            print "Scan %s has a preexisting NIFTI resource, and I am running with overwrite=False. Skipping." % scanid
+            return self.__skip(scanid)
+
+        dicomResourceList = [res for res in scanResources if res["label"]=="DICOM"]
+        if len(dicomResourceList) == 0:
+            print "Scan %s has no DICOM resource. Skipping." % scanid
+            return self.__skip(scanid)
+        elif len(dicomResourceList) > 1:
+            print "Scan %s has more than one DICOM resource. Skipping." % scanid
+            return self.__skip(scanid)
+
+        dicomResource = dicomResourceList[0]
+        if int(dicomResource["file_count"]) == 0:
+            print "DICOM resource for scan %s has no files. Skipping." % scanid
+            return self.__skip(scanid)
+
+        # The scan listing already knows secondary captures, reports and non-imaging scans
+        xsiType = self.scans.get(scanid, {}).get('xsiType')
+        if xsiType in self.skip_xsitypes:
+            print "Scan %s is %s. Skipping." % (scanid, xsiType)
+            return self.__skip(scanid, avoided=int(dicomResource.get("file_size") or 0))
+
+        ##########
+        # Get list of DICOMs
+        print 'Get list of DICOM files for scan %s.' % scanid
+        r = self.__get( self.host+"/data/experiments/%s/scans/%s/resources/DICOM/files?format=json"%(self.session,scanid) )
+        # I don't like the results being in a list, so I will build a dict keyed off file name
+        dicomFileDict = dict((dicom['Name'], {'URI':dicom['URI'], 'Size':int(dicom.get('Size') or 0)})
+                             for dicom in r.json()["ResultSet"]["Result"])
+
+        # Have to manually add absolutePath with a separate request
+        r = self.__get( self.host+"/data/experiments/%s/scans/%s/resources/DICOM/files?format=json&locator=absolutePath"%(self.session,scanid) )
+        for dicom in r.json()["ResultSet"]["Result"]:
+            dicomFileDict[dicom['Name']]['absolutePath'] = dicom['absolutePath']
+
+        ##########
+        # Check the modality of the first file from its leading bytes, before downloading the rest of the files.
+        first = sorted(dicomFileDict)[0]
+        print 'Checking modality in DICOM headers of file %s.'%first
+        modality, nbytes = self.probe_modality(dicomFileDict[first])
+        avoided = sum(d['Size'] for d in dicomFileDict.values()) - nbytes
+        if modality is None:
+            print 'Could not read modality from DICOM headers. Skipping.'
+            return self.__skip(scanid, bytes=nbytes, avoided=avoided)
+        print 'Modality: %s'%modality
+        if modality in self.skip_modalities:
+            print 'Scan %s has modality %s. Skipping.' % (scanid, modality)
+            return self.__skip(scanid, bytes=nbytes, avoided=avoided)
+
+        ##########
+        # Prepare DICOM directory structure
+        scanDicomDir = os.path.join(self.dicomdir,scanid)
+        if not os.access(scanDicomDir, os.R_OK):
+            print 'Making scan DICOM directory %s.' % scanDicomDir
+            os.mkdir(scanDicomDir)
+        # Remove any existing files in the cachedir.
+        # This is unlikely to happen in any environment other than testing.
+        for f in os.listdir(scanDicomDir):
+            os.remove(os.path.join(scanDicomDir,f))
+
+        ##########
+        # Download DICOMs
+        print "Downloading files for scan %s." % scanid
+        for name in sorted(dicomFileDict):
+            pathDict = dicomFileDict[name]
+            localPath = os.path.join(scanDicomDir,name)
+
+            if os.access(pathDict['absolutePath'], os.R_OK):
+                try:
+                    os.symlink(pathDict['absolutePath'],localPath)
+                    print 'Made link to %s.' % pathDict['absolutePath']
+                except OSError:
+                    fileCopy(pathDict['absolutePath'],localPath)
+                    print 'Copied %s.' % pathDict['absolutePath']
+            else:
+                r = self.__session().get(self.__uri(pathDict['URI']), verify=False, stream=True)
+                if not r.ok:
+                    print "Could not download file %s. Skipping scan %s." % (name,scanid)
+                    return self.__skip(scanid, 'failed')
+                with open(localPath, 'wb') as f:
+                    for block in r.iter_content(self.block_size):
+                        f.write(block)
+                        nbytes += len(block)
+                print 'Downloaded file %s.' % name
+
+            pathDict['localPath'] = localPath
+
+        print 'Done downloading for scan %s.'%scanid
+        self.__time(scanid, download=time.time() - t0, bytes=nbytes, status='downloaded')
+        return {'scanid': scanid, 'hasNifti': hasNifti, 'dicomDir': scanDicomDir,
+                'sourceNames': [dicomFileDict[n]['localPath'] for n in sorted(dicomFileDict)]}
+
+    def probe_modality(self, pathDict):
+        """
+        reads only the leading bytes of a DICOM, from the archive if it is mounted, else by an HTTP range request,
+        growing the range until the header parses as far as Modality (0008,0060)
+        :param pathDict with 'URI', 'absolutePath' and 'Size':
+        :return (modality or None, bytes transferred):
+        """
+        from io import BytesIO
+        n = self.probe_bytes
+        transferred = 0
+        while True:
+            if os.access(pathDict['absolutePath'], os.R_OK):
+                with open(pathDict['absolutePath'], 'rb') as f:
+                    head = f.read(n)
+            else:
+                r = self.__session().get(self.__uri(pathDict['URI']), verify=False, stream=True,
+                                         headers={'Range': 'bytes=0-%d' % (n - 1)})
+                r.raise_for_status()
+                head = r.raw.read(n, decode_content=True) # the server may ignore Range
+                r.close()
+                transferred += len(head)
+            try:
+                d = dicomLib.read_file(BytesIO(head), stop_before_pixels=True, force=True)
+                modalityHeader = d.get((0x0008,0x0060), None)
+            except Exception:
+                modalityHeader = None
+            if modalityHeader:
+                return modalityHeader.value.strip("'").strip('"'), transferred
+            if len(head) < n or (pathDict['Size'] and n >= pathDict['Size']): # Size 0 is unknown
+                return None, transferred
+            n *= 4
+
+    def convert(self, job):
+        """
+        :param job from download:
+        :return job with outfiles for upload:
+        """
+        scanid = job['scanid']
+        t0 = time.time()
+
+        ##########
+        # Prepare NIFTI directory structure
+        scanNiftiDir = os.path.join(self.niftidir,scanid)
+        if not os.access(scanNiftiDir, os.R_OK):
+            print 'Creating scan NIFTI directory %s.' % scanNiftiDir
+            os.mkdir(scanNiftiDir)
+        # Remove any existing files in the cachedir.
+        # This is unlikely to happen in any environment other than testing.
+        for f in os.listdir(scanNiftiDir):
+            os.remove(os.path.join(scanNiftiDir,f))
+
+        print 'Converting scan %s to NIFTI...' % scanid
+        job['outfiles'] = self.converter(job['sourceNames'], scanNiftiDir, self.makenii, self.gzip)
+        print 'Done converting scan %s.' % scanid
+        self.__time(scanid, convert=time.time() - t0, status='converted')
+        return job
+
+    def upload(self, job):
+        """
+        :param job from convert:
+        """
+        scanid = job['scanid']
+        t0 = time.time()
+        print
+        print 'Preparing to upload files for scan %s.'%scanid
+
+        # If we have a NIFTI resource and we've reached this point, we know overwrite=True.
+        # We should delete the existing NIFTI resource.
+        if job['hasNifti']:
+            print "Scan %s has a preexisting NIFTI resource. Deleting it now." % scanid
+            try:
+                r = self.__session().delete( self.host+"/data/experiments/%s/scans/%s/resources/NIFTI"%(self.session,scanid),
+                    verify=False )
+                r.raise_for_status()
+            except (requests.ConnectionError, requests.exceptions.RequestException) as e:
+                print "There was a problem deleting"
+                print "    " + str( e )
+                print "Skipping upload for scan %s." %scanid
+                return self.__skip(scanid, 'failed')
+
+        # Uploading
+        for path in job['outfiles']:
+            name = os.path.basename(path)
+
+            print 'Uploading file %s for scan %s' % (name, scanid)
+            with open(path, 'rb') as f:
+                r = self.__session().put(self.host+"/data/experiments/%s/scans/%s/resources/NIFTI/files/%s?format=NIFTI&content=NIFTI_RAW" % (self.session,scanid,name),
+                    verify=False, files={'file':f})
+            if not r.ok:
+                print "Could not upload file %s for scan %s." % (name,scanid)
+                self.__time(scanid, status='failed')
+
+        ##########
+        # Clean up input directory
+        print
+        print 'Cleaning up %s directory.'%job['dicomDir']
+        for f in os.listdir(job['dicomDir']):
+            os.remove(os.path.join(job['dicomDir'],f))
+        self.__time(scanid, upload=time.time() - t0)
+        if self.timing[scanid]['status'] != 'failed':
+            self.__time(scanid, status='uploaded')
+
+    def print_timing(self):
+        print
+        print '%-8s %-10s %12s %12s %12s %14s %14s' % ('scan', 'status', 'download (s)', 'convert (s)', 'upload (s)',
+                                                     'bytes', 'avoided')
+        for scanid, t in self.timing.items():
+            print '%-8s %-10s %12.3f %12.3f %12.3f %14d %14d' % (scanid, t['status'], t['download'], t['convert'],
+                                                               t['upload'], t['bytes'], t['avoided'])
+        print 'Skipping scans before download avoided %d bytes for session %s.' % (self.bytes_avoided, self.session)
+
+    def __start(self, n, fn, qin, qout):
+        threads = [threading.Thread(target=self.__work, args=(fn, qin, qout)) for _ in range(n)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        return threads
+
+    def __work(self, fn, qin, qout):
+        while True:
+            item = qin.get()
+            if item is None:
+                return
+            scanid = item['scanid'] if isinstance(item, dict) else item
+            try:
+                out = fn(item)
+            except (Exception, SystemExit) as e:
+                print 'Scan %s failed in %s:  %s' % (scanid, fn.__name__, e)
+                self.__skip(scanid, 'failed')
+                out = None
+            if out is not None and qout is not None:
+                qout.put(out)
+
+    def __get(self, url):
+        r = self.__session().get(url, verify=False)
+        r.raise_for_status()
+        return r
+
+    def __session(self):
+        """
+        :return requests.Session of the calling thread, sending the JSESSION cookie:
+        """
+        if not hasattr(self.__local, 'session'):
+            self.__local.session = requests.Session()
+            self.__local.session.headers.update(self.cookie)
+        return self.__local.session
+
+    def __skip(self, scanid, status='skipped', **fields):
+        self.__time(scanid, status=status, **fields)
+        return None
+
+    def __time(self, scanid, **fields):
+        with self.__lock:
+            t = self.timing.setdefault(scanid, {'status': None, 'download': 0.0, 'convert': 0.0, 'upload': 0.0,
+                                                'bytes': 0, 'avoided': 0})
+            t.update(fields)
+
+    def __uri(self, uri):
+        return uri if uri.startswith('http') else self.host + uri
+
+    def __init__(self, host, session, dicomdir, niftidir, cookie, overwrite=False, makenii=False, gzip=False,
+                 converter=dcm2nii, nworkers=(1, 1, 1)):
+        """
+        :param host:
+        :param session ID:
+        :param dicomdir is the root output directory for DICOM files:
+        :param niftidir is the root output directory for NIFTI files:
+        :param cookie is a header dict containing the JSESSIONID:
+        :param converter(sourceNames, outputDir, makenii, gzip) returns the list of converted files:
+        :param nworkers are threads for download, convert and upload:
+        """
+        from collections import OrderedDict
+        self.host = host
+        self.session = session
+        self.dicomdir = dicomdir
+        self.niftidir = niftidir
+        self.cookie = cookie
+        self.overwrite = overwrite
+        self.makenii = makenii
+        self.gzip = gzip
+        self.converter = converter
+        self.nworkers = nworkers
+        self.scans = {}
+        self.timing = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+
+
+CONVERTERS = {'dcm2nii': dcm2nii, 'native': dcm2niiNative}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run dcm2nii on every file in a session")
+    parser.add_argument("--host", default="https://cnda.wustl.edu", help="CNDA host", required=True)
+    parser.add_argument("--user", help="CNDA username", required=True)
+    parser.add_argument("--password", help="Password", required=True)
+    parser.add_argument("--session", help="Session ID", required=True)
+    parser.add_argument("--cachedir", help="Root output directory for DICOM files", required=True)
+    parser.add_argument("--niftidir", help="Root output directory for NIFTI files", required=True)
+    parser.add_argument("--overwrite", help="Overwrite NIFTI files if they exist")
+    parser.add_argument("--nii", help="Create .nii file, or .img/.hdr pair")
+    parser.add_argument("--gzip", help="GZip .nii output into .nii.gz?")
+    parser.add_argument("--download-workers", type=int, default=1, help="Threads downloading scans")
+    parser.add_argument("--convert-workers", type=int, default=1, help="Threads converting scans")
+    parser.add_argument("--upload-workers", type=int, default=1, help="Threads uploading scans")
+    parser.add_argument("--converter", choices=sorted(CONVERTERS), default='dcm2nii',
+                        help="dcm2nii runs Dcm2nii through nipype; native converts in-process")
+    parser.add_argument("--timing", help="JSON file for per-scan timing")
+    parser.add_argument('--version', action='version', version='%(prog)s 2')
+
+    args = parser.parse_args(argv)
+    auth = (args.user,args.password)
+    host = cleanServer(args.host)
+    session = args.session
+    dicomdir = args.cachedir
+    niftidir = args.niftidir
+
+    # Set up working directory
+    if not os.access(dicomdir, os.R_OK):
+        print 'Making DICOM directory %s' % dicomdir
+        os.mkdir(dicomdir)
+    if not os.access(niftidir, os.R_OK):
+        print 'Making NIFTI directory %s' % niftidir
+        os.mkdir(niftidir)
+
+    # Get JSESSION token
+    r = get( host+"/data/JSESSION", auth=auth, verify=False )
+    jsessionID = r.content
+    print "JSESSION ID: %s" % jsessionID
+    cookie = {"Cookie": "JSESSIONID=" + jsessionID}
+
+    pipeline = SessionPipeline(host, session, dicomdir, niftidir, cookie,
+                               overwrite=isTrue(args.overwrite), makenii=isTrue(args.nii), gzip=isTrue(args.gzip),
+                               converter=CONVERTERS[args.converter],
+                               nworkers=(args.download_workers, args.convert_workers, args.upload_workers))
+    t0 = time.time()
+    timing = pipeline.run()
+    pipeline.print_timing()
+    print 'Session %s took %.3f s.' % (session, time.time() - t0)
+    if args.timing:
+        with open(args.timing, 'w') as f:
+            json.dump(timing, f, indent=2)
 
     ##########
-    # Upload results
+    # Clean up token
+    r = requests.delete( host+"/data/JSESSION", headers=cookie, verify=False )
     print
-    print 'Preparing to upload files for scan %s.'%scanid
-
-    # If we have a NIFTI resource and we've reached this point, we know overwrite=True.
-    # We should delete the existing NIFTI resource.
-    if hasNifti:
-        print "Scan %s has a preexisting NIFTI resource. Deleting it now." % scanid
-        try:
-            r = requests.delete( url=host+"/data/experiments/%s/scans/%s/resources/NIFTI"%(session,scanid),
-                headers=cookie, verify=False )
-            r.raise_for_status()
-        except (requests.ConnectionError, requests.exceptions.RequestException) as e:
-            print "There was a problem deleting"
-            print "    " + str( e )
-            print "Skipping upload for scan %s." %scanid
-            continue
-
-    # Uploading
-    for path in outfilesList:
-        name = os.path.basename(path)
-
-        print 'Uploading file %s for scan %s' % (name, scanid)
-        r = requests.put(host+"/data/experiments/%s/scans/%s/resources/NIFTI/files/%s?format=NIFTI&content=NIFTI_RAW" % (session,scanid,name),
-            headers=cookie, verify=False, files={'file':open(path, 'rb')})
+    print 'All done.'
+    return timing
 
-    ##########
-    # Clean up input directory
-    print
-    print 'Cleaning up %s directory.'%scanDicomDir
-    for f in os.listdir(scanDicomDir):
-        os.remove(os.path.join(scanDicomDir,f))
-
-##########
-# Clean up token
-r = requests.delete( host+"/data/JSESSION", headers=cookie, verify=False )
-print
-print 'All done.'
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,9 @@
 """orchestrate.py
 Usage:
-    orchestrate.py (scans|experiments_list|subjects) HOST USERNAME PASSWORD WRAPPER_NAME PARENT_ID PROJECT
+    orchestrate.py (scans|experiments|experiments_list|subjects) HOST USERNAME PASSWORD WRAPPER_NAME PARENT_ID PROJECT [options]
     orchestrate.py (-h | --help)
     orchestrate.py --version
+
 Options:
     -h --help           Show the usage
     --version           Show the version
@@ -11,13 +12,50 @@ Options:
     PASSWORD            Password (or "secret" value from an alias token)
     WRAPPER_NAME        Name of the wrapper to launch.
     PARENT_ID           ID of parent object. (For instance, when looping on scans, PARENT_ID is a session ID.)
+                        Comma-separated IDs launch for all parents with one connection.
     PROJECT             Project name
+    --chunk=<n>         Containers requested per bulklaunch [default: 10]
+    --max-running=<n>   Containers running at once [default: 20]
+    --retries=<n>       Relaunches of each failed launch [default: 2]
+    --poll=<sec>        Seconds between polls of container status [default: 10]
+    --no-wait           Exit once all containers are launched
+    --report=<file>     JSON report of launches and container statuses [default: orchestrate_report.json]
+    --parents=<file>    File of further parent IDs, one per line
+    --cache=<file>      Cache of wrapper IDs and root element names [default: ~/.orchestrate_cache.json]
+    --ttl=<sec>         Seconds for which cached wrappers are used; 0 disables the cache [default: 86400]
 """
 
+import os
+import time
+import json
 import requests
+from collections import OrderedDict, deque
 from docopt import docopt
 from jsonpath import jsonpath
 
+version = "1.1"
+
+THINGS = {
+    "scans": {
+        "xsiType": "xnat:imageScanData",
+        "searchUriTemplate": "/data/experiments/{}/scans",
+        "jsonpathSearch": '$.ResultSet.Result[*].ID',
+        "launchArgTemplate": "/experiments/{parent}/scans/{thing}"},
+    "experiments": {
+        "xsiType": "xnat:imageSessionData",
+        "searchUriTemplate": "/data/subjects/{}/experiments",
+        "jsonpathSearch": '$.items[0].children[?(@.field == "experiments/experiment")].items[*].data_fields.ID',
+        "launchArgTemplate": "{thing}"},
+    "subjects": {
+        "xsiType": "xnat:subjectData",
+        "searchUriTemplate": "/data/projects/{}/subjects",
+        "jsonpathSearch": "$.ResultSet.Result[*].ID",
+        "launchArgTemplate": "{thing}"}}
+THINGS["experiments_list"] = THINGS["experiments"] # former name of the command
+
+TERMINAL_STATUSES = ("Complete", "Done", "Failed", "Killed", "poll failed")
+MAX_POLL_FAILURES = 10 # consecutive failed polls of a container before its record is marked "poll failed"
+
 def die_if(condition, message="ERROR", exit=1):
     if condition:
         die(message=message, exit=exit)
@@ -30,122 +68,261 @@ def die(message="ERROR", exit=1):
 def false_or_empty(l):
     return l is False or len(l) == 0
 
-version = "1.0"
-
-args = docopt(__doc__, version=version)
-
-host        = args.get('HOST')
-username    = args.get('USERNAME')
-password    = args.get('PASSWORD')
-wrapperName = args.get("WRAPPER_NAME")
-parentId    = args.get('PARENT_ID')
-project     = args.get('PROJECT')
-
-if args.get("scans"):
-    thingString = "scans"
-    xsiType = "xnat:imageScanData"
-    searchUriTemplate = "/data/experiments_list/{}/scans"
-    jsonpathSearch = '$.ResultSet.Result[*].ID'
-    launchArgTemplate = "/experiments_list/{}".format(parentId) + "/scans/{}"
-elif args.get("experiments_list"):
-    thingString = "experiments_list"
-    xsiType = "xnat:imageSessionData"
-    searchUriTemplate = "/data/subjects/{}/experiments_list"
-    jsonpathSearch = '$.items[0].children[?(@.field == "experiments_list/experiment")].items[*].data_fields.ID'
-    launchArgTemplate = "{}"
-elif args.get("subjects"):
-    thingString = "subjects"
-    xsiType = "xnat:subjectData"
-    searchUriTemplate = "/data/projects/{}/subjects"
-    jsonpathSearch = "$.ResultSet.Result[*].ID"
-    launchArgTemplate = "{}"
-else:
-    die("ERROR: Please run orchestrate.py with the first argument being \"scans\", \"experiments_list\", or \"subjects\".", exit=__doc__)
-
-searchUri = searchUriTemplate.format(parentId)
-
-s = requests.Session()
-s.auth = (username, password)
-
-print("Attempting to connect to XNAT at {}.".format(host))
-r = s.get(host + "/data/JSESSION")
-die_if(not r.ok, message="ERROR: Connection failed.", exit=r.text)
-print("OK")
-
-# Find the wrapper ID
-print("\nFinding {} wrapper ID.".format(wrapperName))
-r = s.get(host + '/xapi/commands/available', params={"project": project, "xsiType": xsiType})
-die_if(not r.ok, message="ERROR: Could not search for available commands.", exit=r.text)
-
-try:
-    commandsAvailable = r.json()
-except:
-    die("ERROR: Improper response from /commands/available", r.text)
-
-wrapperIds = jsonpath(commandsAvailable, '$[?(@["wrapper-name"] == "{}" && @.enabled)].wrapper-id'.format(wrapperName))
-die_if(false_or_empty(wrapperIds), message="ERROR: Could not find {} as an enabled command on project {}.".format(wrapperName, project))
-
-wrapperId = max(wrapperIds)
-if len(wrapperIds) > 1:
-    print("Found multiple wrapper ids: {}.\nChoosing max id: {}.".format(wrapperIds, wrapperId))
-else:
-    print("Found wrapper id: {}.".format(wrapperId))
-
-print("\nFinding root element name for wrapper ID {}.".format(wrapperId))
-rootElementNameList = jsonpath(commandsAvailable, '$[?(@["wrapper-id"] == {})].root-element-name'.format(wrapperId))
-die_if(false_or_empty(rootElementNameList), message="ERROR: Could not find root-element-name for wrapper-id {} in /commands/available.".format(wrapperId))
-die_if(len(rootElementNameList) > 1, message="ERROR: Could not find unique root-element-name for wrapper-id {} in /commands/available.".format(wrapperId))
-rootElementName = rootElementNameList[0]
-
-print("\nSearching for {} with URI {}.".format(thingString, searchUri))
-r = s.get(host + searchUri, params={"format": "json"})
-die_if(not r.ok, message="ERROR: Search failed.", exit=r.text)
-
-try:
-    searchJson = r.json()
-except:
-    die(message="ERROR: Improper response from {}".format(searchUri), exit=r.text)
-
-# Do a jsonpath search to find scan
-print("Searching json to find {}.".format(thingString))
-results = jsonpath(searchJson, jsonpathSearch)
-
-die_if(results == False, message='No {} found.'.format(thingString), exit=searchJson)
-
-print("Found {}: {}.".format(thingString, results))
-
-# Launch container with each of the things
-print("\nBulk launching {} containers for each of the {}.".format(wrapperName, thingString))
-launchArgs = [{rootElementName: launchArgTemplate.format(thing)} for thing in results]
-r = s.post(host + '/xapi/projects/{}/wrappers/{}/bulklaunch'.format(project, wrapperId), json=launchArgs, timeout=None)
-die_if(not r.ok, message="ERROR: Launching failed.", exit=r.text)
-
-try:
-    launchReport = r.json()
-    successes = launchReport.get("successes", [])
-    failures = launchReport.get("failures", [])
-    atLeastOneSuccess = len(successes) > 0
-    atLeastOneFailure = len(failures) > 0
-
-    if atLeastOneSuccess:
-        if atLeastOneFailure:
-            print("SUCCESSFUL LAUNCHES")
-        else:
-            print("ALL LAUNCHES SUCCEEDED!")
+def is_terminal(status):
+    return status is not None and (status in TERMINAL_STATUSES or status.startswith("Failed"))
+
+
+
+def connect(host, username, password):
+    """
+    :return requests.Session authenticated with XNAT:
+    """
+    s = requests.Session()
+    s.auth = (username, password)
+    print("Attempting to connect to XNAT at {}.".format(host))
+    r = s.get(host + "/data/JSESSION")
+    die_if(not r.ok, message="ERROR: Connection failed.", exit=r.text)
+    print("OK")
+    return s
+
+def find_wrapper(s, host, project, xsiType, wrapperName):
+    """
+    :return (wrapperId, rootElementName) of the enabled wrapper named wrapperName having the greatest ID:
+    """
+    print("\nFinding {} wrapper ID.".format(wrapperName))
+    r = s.get(host + '/xapi/commands/available', params={"project": project, "xsiType": xsiType})
+    die_if(not r.ok, message="ERROR: Could not search for available commands.", exit=r.text)
+
+    try:
+        commandsAvailable = r.json()
+    except ValueError:
+        die("ERROR: Improper response from /commands/available", r.text)
+
+    wrapperIds = jsonpath(commandsAvailable, '$[?(@["wrapper-name"] == "{}" && @.enabled)].wrapper-id'.format(wrapperName))
+    die_if(false_or_empty(wrapperIds), message="ERROR: Could not find {} as an enabled command on project {}.".format(wrapperName, project))
+
+    wrapperId = max(wrapperIds)
+    if len(wrapperIds) > 1:
+        print("Found multiple wrapper ids: {}.\nChoosing max id: {}.".format(wrapperIds, wrapperId))
+    else:
+        print("Found wrapper id: {}.".format(wrapperId))
+
+    print("\nFinding root element name for wrapper ID {}.".format(wrapperId))
+    rootElementNameList = jsonpath(commandsAvailable, '$[?(@["wrapper-id"] == {})].root-element-name'.format(wrapperId))
+    die_if(false_or_empty(rootElementNameList), message="ERROR: Could not find root-element-name for wrapper-id {} in /commands/available.".format(wrapperId))
+    die_if(len(rootElementNameList) > 1, message="ERROR: Could not find unique root-element-name for wrapper-id {} in /commands/available.".format(wrapperId))
+    return wrapperId, rootElementNameList[0]
+
+def find_wrapper_cached(s, host, project, xsiType, wrapperName, cache=None, ttl=86400):
+    """
+    :param cache is a JSON file of wrappers already found, keyed by host, project, xsiType and wrapperName:
+    :param ttl in seconds:
+    :return (wrapperId, rootElementName) from cache if no older than ttl, else from find_wrapper:
+    """
+    key = "|".join([host, project, xsiType, wrapperName])
+    entries = {}
+    if cache and ttl > 0 and os.path.isfile(cache):
+        try:
+            with open(cache) as f:
+                entries = json.load(f)
+        except ValueError:
+            entries = {}
+    e = entries.get(key)
+    if e and time.time() - e["time"] < ttl:
+        print("\nFound cached wrapper id: {}, root element name: {}.".format(e["wrapperId"], e["rootElementName"]))
+        return e["wrapperId"], e["rootElementName"]
+    wrapperId, rootElementName = find_wrapper(s, host, project, xsiType, wrapperName)
+    if cache and ttl > 0:
+        entries[key] = {"wrapperId": wrapperId, "rootElementName": rootElementName, "time": time.time()}
+        with open(cache + ".tmp", "w") as f:
+            json.dump(entries, f, indent=2, sort_keys=True)
+        os.rename(cache + ".tmp", cache)
+    return wrapperId, rootElementName
 
-        print(rootElementName + " - container id")
-        for success in successes:
-            print("{} - {}".format(success.get("params", {}).get(rootElementName), success.get("container-id")))
+def search_things(s, host, thingString, parentId, strict=True):
+    """
+    :param strict; if False, failed searches return [] instead of exiting:
+    :return IDs of things, e.g., scans, children of parentId:
+    """
+    thing = THINGS[thingString]
+    searchUri = thing["searchUriTemplate"].format(parentId)
+    print("\nSearching for {} with URI {}.".format(thingString, searchUri))
+    r = s.get(host + searchUri, params={"format": "json"})
+    if not strict and not r.ok:
+        print("WARNING: Search failed for {}.".format(parentId))
+        return []
+    die_if(not r.ok, message="ERROR: Search failed.", exit=r.text)
 
-    if atLeastOneFailure:
-        if atLeastOneSuccess:
-            print("FAILED LAUNCHES")
+    try:
+        searchJson = r.json()
+    except ValueError:
+        die(message="ERROR: Improper response from {}".format(searchUri), exit=r.text)
+
+    print("Searching json to find {}.".format(thingString))
+    results = jsonpath(searchJson, thing["jsonpathSearch"])
+    if not strict and results == False:
+        print("WARNING: No {} found for {}.".format(thingString, parentId))
+        return []
+    die_if(results == False, message='No {} found.'.format(thingString), exit=searchJson)
+    print("Found {}: {}.".format(thingString, results))
+    return results
+
+def launch_args(thingString, parentId, rootElementName, things):
+    template = THINGS[thingString]["launchArgTemplate"]
+    return [{rootElementName: template.format(parent=parentId, thing=t)} for t in things]
+
+def launch(s, host, project, wrapperId, rootElementName, launchArgs,
+           chunk=10, maxRunning=20, retries=2, poll=10, wait=True):
+    """
+    requests containers with bulklaunch in chunks, keeping no more than maxRunning containers running,
+    relaunching failed launches up to retries times, and polling /xapi/containers until all are terminal
+    :param launchArgs are dicts keyed by rootElementName:
+    :param wait; if False, returns once all are launched:
+    :return list of dicts, ordered as launchArgs, with params, attempts, container-id, status, message
+            and times of launch and completion:
+    """
+    records = OrderedDict()
+    for a in launchArgs:
+        records[a[rootElementName]] = {"params": a, "attempts": 0, "container-id": None, "status": "pending",
+                                       "message": None, "launched": None, "finished": None, "poll-failures": 0}
+    pending = deque(launchArgs)
+    running = []
+    uri = host + '/xapi/projects/{}/wrappers/{}/bulklaunch'.format(project, wrapperId)
+
+    while pending or (wait and running):
+        room = maxRunning - len(running)
+        if pending and room > 0:
+            batch = [pending.popleft() for _ in range(min(chunk, room, len(pending)))]
+            try:
+                r = s.post(uri, json=batch, timeout=None)
+                r.raise_for_status()
+                launchReport = r.json()
+                successes = launchReport.get("successes", [])
+                failures = launchReport.get("failures", [])
+            except (requests.exceptions.RequestException, ValueError) as e:
+                successes = []
+                failures = [{"params": a, "message": str(e)} for a in batch]
+            for success in successes:
+                rec = records[success.get("params", {}).get(rootElementName)]
+                rec["attempts"] += 1
+                rec["container-id"] = success.get("container-id")
+                rec["status"] = "launched"
+                rec["launched"] = time.time()
+                running.append(rec)
+            for failure in failures:
+                rec = records[failure.get("params", {}).get(rootElementName)]
+                rec["attempts"] += 1
+                rec["message"] = failure.get("message")
+                if rec["attempts"] <= retries:
+                    pending.append(rec["params"])
+                else:
+                    rec["status"] = "launch failed"
+            print_progress(records)
+            if failures and not successes:
+                time.sleep(poll)
+            continue
+        time.sleep(poll)
+        running = poll_containers(s, host, running)
+        print_progress(records)
+    return list(records.values())
+
+def poll_containers(s, host, running, maxFailures=MAX_POLL_FAILURES):
+    """
+    :param running are records from launch:
+    :param maxFailures are consecutive failed polls after which a record is terminal as "poll failed":
+    :return records not yet terminal:
+    """
+    still = []
+    for rec in running:
+        try:
+            r = s.get(host + '/xapi/containers/{}'.format(rec["container-id"]))
+            r.raise_for_status()
+            rec["status"] = r.json().get("status", rec["status"])
+            rec["poll-failures"] = 0
+        except (requests.exceptions.RequestException, ValueError) as e:
+            rec["poll-failures"] = rec.get("poll-failures", 0) + 1
+            rec["message"] = str(e)
+            if rec["poll-failures"] >= maxFailures:
+                rec["status"] = "poll failed"
+        if is_terminal(rec["status"]):
+            rec["finished"] = time.time()
         else:
-            print("ALL LAUNCHES FAILED!")
+            still.append(rec)
+    return still
+
+def count_statuses(records):
+    counts = {}
+    for rec in records:
+        counts[rec["status"]] = counts.get(rec["status"], 0) + 1
+    return counts
+
+def print_progress(records):
+    counts = count_statuses(records.values())
+    print("{}: {}".format(time.strftime("%H:%M:%S"),
+                          ", ".join("{} {}".format(n, k) for k, n in sorted(counts.items()))))
+
+def write_report(fname, records, **fields):
+    """
+    :param fname for JSON:
+    :param records from launch:
+    :param fields describe the run, e.g., host, project, wrapper-id:
+    :return report as dict:
+    """
+    report = dict(fields)
+    report["counts"] = count_statuses(records)
+    report["launches"] = records
+    if fname:
+        with open(fname, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print("\nWrote report to {}.".format(fname))
+    return report
+
+
+
+def main(argv=None):
+    args = docopt(__doc__, argv=argv, version=version)
+
+    host        = args.get('HOST')
+    username    = args.get('USERNAME')
+    password    = args.get('PASSWORD')
+    wrapperName = args.get("WRAPPER_NAME")
+    parentIds   = [p for p in args.get('PARENT_ID').split(',') if p]
+    project     = args.get('PROJECT')
+    if args.get('--parents'):
+        with open(args.get('--parents')) as f:
+            parentIds += [l.strip() for l in f if l.strip()]
+    thingStrings = [t for t in ("scans", "experiments", "experiments_list", "subjects") if args.get(t)]
+    die_if(not thingStrings,
+           message="ERROR: Please run orchestrate.py with the first argument being \"scans\", \"experiments\", or \"subjects\".",
+           exit=__doc__)
+    thingString = thingStrings[0]
+
+    started = time.time()
+    s = connect(host, username, password)
+    wrapperId, rootElementName = find_wrapper_cached(s, host, project, THINGS[thingString]["xsiType"], wrapperName,
+                                                     cache=os.path.expanduser(args.get("--cache")),
+                                                     ttl=float(args.get("--ttl")))
+    launchArgs = []
+    for parentId in parentIds:
+        results = search_things(s, host, thingString, parentId, strict=len(parentIds) == 1)
+        launchArgs += launch_args(thingString, parentId, rootElementName, results)
+
+    print("\nLaunching {} containers for each of the {}.".format(wrapperName, thingString))
+    records = launch(s, host, project, wrapperId, rootElementName, launchArgs,
+                     chunk=int(args.get("--chunk")),
+                     maxRunning=int(args.get("--max-running")),
+                     retries=int(args.get("--retries")),
+                     poll=float(args.get("--poll")),
+                     wait=not args.get("--no-wait"))
 
-        print(rootElementName + " - error message")
-        for failure in failures:
-            print("{} - \"{}\"".format(failure.get("params", {}).get(rootElementName), failure.get("message")))
+    print("\n" + rootElementName + " - container id - status")
+    for rec in records:
+        print("{} - {} - {}{}".format(rec["params"][rootElementName], rec["container-id"], rec["status"],
+                                      " \"{}\"".format(rec["message"]) if rec["status"] == "launch failed" else ""))
+    return write_report(args.get("--report"), records,
+                        host=host, project=project, parents=parentIds, things=thingString,
+                        wrapper=wrapperName, wrapperId=wrapperId, rootElementName=rootElementName,
+                        started=started, finished=time.time())
 
-except:
-    print("Could not parse launch report.\n" + r.text)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+import os
+import time
+from warnings import warn
+
+
+
+class CacheManager(object):
+    """Bounds the staging cachedir, <cachedir>/<project>/ses-*/<folder>, by a quota of bytes.  Folders are tracked
+       per session and tracer folder, e.g., FDG_DT*-Converted-NAC, and least-recently-used folders that are fully
+       processed are evicted first.  A tracer folder is pinned until its reconstruction has finished, other folders of
+       a session, e.g., umaps, rawdata or mri, while any tracer folder of the session is pinned, and any folder holding
+       a pin file."""
+
+    __author__ = "John J. Lee"
+    __copyright__ = "Copyright 2019"
+
+    quota = None # bytes for all projects of cachedir; None only ensures free space on the filesystem
+    finished = os.path.join('output', 'PET', 'reconstruction_Reconstruction_finished.touch') # as Calibration.recon_outputs
+    pin_name = '.pinned'
+    used_name = '.last_used' # mtime marks last use of a folder
+
+    @staticmethod
+    def is_tracer_folder(folder):
+        return '-Converted-' in os.path.basename(folder)
+
+    def folders(self):
+        """
+        :return list of dict with path, project, session, folder, bytes, last_used, finished and pinned
+                for each folder of each session of cachedir:
+        """
+        from glob import glob
+        flds = []
+        for ses in sorted(glob(os.path.join(self.cachedir, '*', 'ses-*'))):
+            if not os.path.isdir(ses) or os.path.islink(ses):
+                continue
+            sflds = []
+            for f in sorted(os.listdir(ses)):
+                path = os.path.join(ses, f)
+                if not os.path.isdir(path) or os.path.islink(path):
+                    continue
+                sflds.append({'path': path,
+                              'project': os.path.basename(os.path.dirname(ses)),
+                              'session': os.path.basename(ses),
+                              'folder': f,
+                              'bytes': self.folder_bytes(path),
+                              'last_used': self.last_used(path),
+                              'finished': os.path.exists(os.path.join(path, self.finished)),
+                              'pinned': os.path.exists(os.path.join(path, self.pin_name))})
+            pending = any(self.is_tracer_folder(f['folder']) and not f['finished'] for f in sflds)
+            for f in sflds:
+                if self.is_tracer_folder(f['folder']):
+                    f['pinned'] = f['pinned'] or not f['finished']
+                else:
+                    f['pinned'] = f['pinned'] or pending
+            flds += sflds
+        return flds
+
+    def sessions(self):
+        """
+        :return dict keyed by project/ses-* with total bytes, pinned bytes and last use of its folders:
+        """
+        sess = {}
+        for f in self.folders():
+            s = sess.setdefault(f['project'] + '/' + f['session'], {'bytes': 0, 'pinned_bytes': 0, 'last_used': 0})
+            s['bytes'] += f['bytes']
+            s['pinned_bytes'] += f['bytes'] if f['pinned'] else 0
+            s['last_used'] = max(s['last_used'], f['last_used'])
+        return sess
+
+    def folder_bytes(self, path):
+        """
+        :param path:
+        :return bytes of regular files in path, not following symlinks:
+        """
+        import stat
+        nbytes = 0
+        for dirpath, dirnames, files in os.walk(path):
+            for f in files:
+                st = os.lstat(os.path.join(dirpath, f))
+                if stat.S_ISREG(st.st_mode):
+                    nbytes += st.st_size
+        return nbytes
+
+    def usage(self, flds=None):
+        """
+        :param flds; default is self.folders():
+        :return bytes of regular files in flds, counting files hardlinked more than once, e.g., by
+                xnatpet.objectstore, only once:
+        """
+        import stat
+        if flds is None:
+            flds = self.folders()
+        inodes = {}
+        for fld in flds:
+            for dirpath, dirnames, files in os.walk(fld['path']):
+                for f in files:
+                    st = os.lstat(os.path.join(dirpath, f))
+                    if stat.S_ISREG(st.st_mode):
+                        inodes[(st.st_dev, st.st_ino)] = st.st_size
+        return sum(inodes.values())
+
+    def free_bytes(self):
+        st = os.statvfs(self.cachedir)
+        return st.f_bavail * st.f_frsize
+
+    def last_used(self, path):
+        marker = os.path.join(path, self.used_name)
+        if os.path.exists(marker):
+            return os.path.getmtime(marker)
+        return os.path.getmtime(path)
+
+    def touch(self, path):
+        """
+        marks folder path, or every folder of session path, as used now
+        :param path is a folder or ses-* directory:
+        """
+        paths = [path]
+        if os.path.basename(path).startswith('ses-'):
+            paths = [os.path.join(path, f) for f in os.listdir(path) if os.path.isdir(os.path.join(path, f))]
+        for p in paths:
+            with open(os.path.join(p, self.used_name), 'a'):
+                pass
+            os.utime(os.path.join(p, self.used_name), None)
+
+    def pin(self, path):
+        with open(os.path.join(path, self.pin_name), 'a'):
+            pass
+
+    def unpin(self, path):
+        if os.path.exists(os.path.join(path, self.pin_name)):
+            os.remove(os.path.join(path, self.pin_name))
+
+    def ensure_space(self, nbytes, keep=None):
+        """
+        evicts least-recently-used folders not pinned until nbytes fit within the quota and the free space of the
+        filesystem of cachedir
+        :param nbytes to be staged:
+        :param keep is a ses-* directory, e.g., the session being staged, none of whose folders are evicted:
+        :return True if nbytes fit:
+        """
+        flds = self.folders()
+        need = self.__need(nbytes, flds)
+        if keep is not None:
+            keep = os.path.realpath(keep)
+            flds = [f for f in flds if os.path.realpath(os.path.dirname(f['path'])) != keep]
+        for f in sorted([f for f in flds if not f['pinned']], key=lambda f: f['last_used']):
+            if need <= 0:
+                break
+            self.evict(f['path'])
+            need = self.__need(nbytes) # hardlinked files are freed only with their last link
+        if need > 0:
+            warn('CacheManager.ensure_space could not free %d bytes in %s' % (need, self.cachedir))
+            return False
+        return True
+
+    def evict(self, path):
+        """
+        removes folder path, its session if then empty, and objects of xnatpet.objectstore no longer used
+        :param path:
+        """
+        import shutil
+        from objectstore import ObjectStore
+        print('CacheManager.evict:  %s' % path)
+        shutil.rmtree(path)
+        ses = os.path.dirname(path)
+        if not [f for f in os.listdir(ses) if os.path.isdir(os.path.join(ses, f))]:
+            shutil.rmtree(ses)
+        self.evicted.append(path)
+        ObjectStore(self.cachedir).gc()
+
+    def report(self):
+        flds = self.folders()
+        return {'quota': self.quota,
+                'bytes': self.usage(flds),
+                'pinned_bytes': sum(f['bytes'] for f in flds if f['pinned']),
+                'folders': len(flds),
+                'pinned_folders': sum(f['pinned'] for f in flds),
+                'evicted': list(self.evicted),
+                'free_bytes': self.free_bytes(),
+                'time': time.time()}
+
+    def __need(self, nbytes, flds=None):
+        """
+        :return bytes to evict for nbytes to fit the quota and the free space of the filesystem:
+        """
+        need = nbytes - self.free_bytes()
+        if self.quota is not None:
+            need = max(need, self.usage(flds) + nbytes - self.quota)
+        return need
+
+    def __init__(self, cachedir, quota=None):
+        """
+        :param cachedir is the staging cache directory, e.g., StageXnat.cachedir:
+        :param quota in bytes; default is CacheManager.quota:
+        """
+        self.cachedir = cachedir
+        if quota is not None:
+            self.quota = quota
+        self.evicted = []
+
+
+
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser(description='reports on or evicts folders of a staging cachedir to fit a quota')
+    p.add_argument('-c', '--cachedir', metavar='<path>', required=True, help='path containing project-level data')
+    p.add_argument('-q', '--quota', metavar='<GB>', type=float, default=None, help='evicts folders to fit the quota')
+    args = p.parse_args()
+    cm = CacheManager(args.cachedir, quota=int(args.quota * 2**30) if args.quota else None)
+    if args.quota:
+        cm.ensure_space(0)
+    for k, v in sorted(cm.sessions().items()):
+        print('%-40s %14d bytes %14d pinned' % (k, v['bytes'], v['pinned_bytes']))
+    print(cm.report())
@@ -0,0 +1,235 @@
+import os
+import struct
+import zlib
+
+MAGIC = b'XBFZ'
+SUFFIX = '.bfz'
+_HEADER = struct.Struct('<4sIIQ') # magic, version, chunk bytes, raw bytes
+_ENTRY = struct.Struct('<QII') # offset, stored bytes, raw bytes
+_FOOTER = struct.Struct('<QI4s') # offset of index, chunks, magic
+
+
+
+def bfz_for(bf):
+    return os.path.splitext(bf)[0] + SUFFIX
+
+def bf_path(bf):
+    """
+    :param bf:
+    :return bf if it exists, else its .bfz if that exists, else bf:
+    """
+    if not os.path.exists(bf) and os.path.exists(bfz_for(bf)):
+        return bfz_for(bf)
+    return bf
+
+def raw_size(bf):
+    """
+    :param bf, which may be stored as .bfz:
+    :return bytes of bf, decompressed if need be:
+    """
+    if os.path.exists(bf):
+        return os.path.getsize(bf)
+    return CompressedBf(bfz_for(bf)).raw_bytes
+
+
+
+class CompressedBf(object):
+    """Is a listmode .bf stored as <root>.bfz, compressed with zlib in chunks of chunk_bytes, each decodable alone.
+       A trailing index of chunk offsets allows streaming decompression, reads of any range of bytes and
+       materializing the .bf on demand, e.g., before reconstruction.  With shuffle, the bytes of each chunk are
+       grouped by their position within 32-bit words before compression, which suits the slowly varying high bytes
+       of PETLINK words."""
+
+    __author__ = "John J. Lee"
+    __copyright__ = "Copyright 2019"
+
+    version = 1
+    chunk_bytes = 1 << 22 # 4 MiB, a multiple of 4
+    level = 1 # zlib level; 1 is fastest
+    shuffle = True
+    nthreads = 4 # chunks compressed concurrently; zlib compression objects release the GIL
+
+    @classmethod
+    def compress(cls, bf, dest=None, remove=False):
+        """
+        :param bf is a listmode file:
+        :param dest; default is the .bfz with the root of bf:
+        :param remove bf after compressing:
+        :return CompressedBf of dest:
+        """
+        from multiprocessing.pool import ThreadPool
+        if dest is None:
+            dest = bfz_for(bf)
+        index = []
+        flags = 1 if cls.shuffle else 0
+        pool = ThreadPool(max(1, cls.nthreads))
+        try:
+            with open(bf, 'rb') as f, open(dest + '.tmp', 'wb') as g:
+                g.write(_HEADER.pack(MAGIC, cls.version | flags << 16, cls.chunk_bytes, os.fstat(f.fileno()).st_size))
+                while True:
+                    raws = [f.read(cls.chunk_bytes) for _ in range(max(1, cls.nthreads))] # bounds memory
+                    raws = [r for r in raws if r]
+                    if not raws:
+                        break
+                    for raw, data in zip(raws, pool.map(cls.__encode, raws)):
+                        index.append((g.tell(), len(data), len(raw)))
+                        g.write(data)
+                offset = g.tell()
+                for e in index:
+                    g.write(_ENTRY.pack(*e))
+                g.write(_FOOTER.pack(offset, len(index), MAGIC))
+        finally:
+            pool.close()
+            pool.join()
+        os.rename(dest + '.tmp', dest)
+        if remove:
+            os.remove(bf)
+        return cls(dest)
+
+    @classmethod
+    def __encode(cls, raw):
+        z = zlib.compressobj(cls.level)
+        return z.compress(cls.__shuffle(raw) if cls.shuffle else raw) + z.flush()
+
+    @property
+    def stored_bytes(self):
+        return os.path.getsize(self.path)
+
+    @property
+    def ratio(self):
+        return float(self.raw_bytes) / self.stored_bytes if self.stored_bytes else 0.0
+
+    def chunks(self, first=0):
+        """
+        :param first chunk:
+        :return generator of decompressed chunks, read sequentially:
+        """
+        with open(self.path, 'rb') as f:
+            if first < len(self.index):
+                f.seek(self.index[first][0])
+            for offset, stored, raw in self.index[first:]:
+                yield self.__decode(f.read(stored), raw)
+
+    def read(self, start, nbytes):
+        """
+        :param start byte of the .bf:
+        :param nbytes:
+        :return bytes of the .bf from start, decompressing only the chunks holding them:
+        """
+        stop = min(start + nbytes, self.raw_bytes)
+        out = []
+        pos = (start // self.chunk_bytes) * self.chunk_bytes
+        for data in self.chunks(start // self.chunk_bytes):
+            if pos >= stop:
+                break
+            out.append(data[max(start - pos, 0):stop - pos])
+            pos += len(data)
+        return b''.join(out)
+
+    def decompress(self, dest=None):
+        """
+        materializes the .bf
+        :param dest; default is the .bf with the root of self.path:
+        :return dest:
+        """
+        if dest is None:
+            dest = os.path.splitext(self.path)[0] + '.bf'
+        with open(dest + '.tmp', 'wb') as g:
+            for data in self.chunks():
+                g.write(data)
+        os.rename(dest + '.tmp', dest)
+        return dest
+
+    def report(self, decode=True):
+        """
+        :param decode all chunks to measure throughput:
+        :return dict with path, raw_bytes, stored_bytes, ratio, chunks and decode MB/s:
+        """
+        import time
+        rep = {'path': self.path, 'raw_bytes': self.raw_bytes, 'stored_bytes': self.stored_bytes,
+               'ratio': self.ratio, 'chunks': len(self.index), 'decode_MBps': None}
+        if decode:
+            t0 = time.time()
+            for _ in self.chunks():
+                pass
+            dt = time.time() - t0
+            rep['decode_MBps'] = self.raw_bytes / 1e6 / dt if dt > 0 else float('inf')
+        return rep
+
+    @staticmethod
+    def __shuffle(raw):
+        import numpy as np
+        n = len(raw) // 4 * 4
+        b = np.frombuffer(raw[:n], dtype=np.uint8).reshape(-1, 4)
+        return b.T.tobytes() + raw[n:]
+
+    @staticmethod
+    def __unshuffle(data):
+        import numpy as np
+        n = len(data) // 4 * 4
+        b = np.frombuffer(data[:n], dtype=np.uint8).reshape(4, -1)
+        return b.T.tobytes() + data[n:]
+
+    def __decode(self, stored, raw):
+        data = zlib.decompress(stored)
+        if len(data) != raw:
+            raise AssertionError('CompressedBf found a corrupt chunk in %s' % self.path)
+        return self.__unshuffle(data) if self.shuffled else data
+
+    def __init__(self, path):
+        """
+        :param path of a .bfz:
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version, self.chunk_bytes, self.raw_bytes = _HEADER.unpack(f.read(_HEADER.size))
+            f.seek(-_FOOTER.size, os.SEEK_END)
+            offset, nchunks, magic1 = _FOOTER.unpack(f.read(_FOOTER.size))
+            if magic != MAGIC or magic1 != MAGIC or version & 0xFFFF != self.version:
+                raise AssertionError('CompressedBf found no .bfz version %d in %s' % (self.version, path))
+            f.seek(offset)
+            self.index = [_ENTRY.unpack(f.read(_ENTRY.size)) for _ in range(nchunks)]
+        self.shuffled = bool(version >> 16 & 1)
+
+
+
+def folder_report(folder, decode=True):
+    """
+    :param folder, e.g., a tracer folder, searched recursively for .bfz:
+    :param decode all chunks to measure throughput:
+    :return dict with a report of CompressedBf for each .bfz and their totals:
+    """
+    files = []
+    for dirpath, dirnames, fns in os.walk(folder):
+        for fn in sorted(fns):
+            if fn.endswith(SUFFIX):
+                files.append(CompressedBf(os.path.join(dirpath, fn)).report(decode=decode))
+    raw = sum(r['raw_bytes'] for r in files)
+    stored = sum(r['stored_bytes'] for r in files)
+    secs = sum(r['raw_bytes'] / 1e6 / r['decode_MBps'] for r in files if r['decode_MBps'])
+    return {'folder': folder, 'files': files, 'raw_bytes': raw, 'stored_bytes': stored,
+            'ratio': float(raw) / stored if stored else 0.0,
+            'decode_MBps': raw / 1e6 / secs if decode and secs > 0 else None}
+
+
+
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser(description='compresses, materializes or reports on listmode .bf stored as .bfz')
+    p.add_argument('command', choices=['compress', 'decompress', 'report'])
+    p.add_argument('paths', nargs='+', help='.bf to compress, .bfz to decompress, or folders to report')
+    p.add_argument('--remove', action='store_true', help='removes each .bf after compressing')
+    args = p.parse_args()
+    for path in args.paths:
+        if args.command == 'compress':
+            c = CompressedBf.compress(path, remove=args.remove)
+            print('%s:  %.2f:1' % (c.path, c.ratio))
+        elif args.command == 'decompress':
+            print(CompressedBf(path).decompress())
+        else:
+            rep = folder_report(path)
+            for r in rep['files']:
+                print('%-80s %14d %14d %6.2f:1 %10.1f MB/s' %
+                      (r['path'], r['raw_bytes'], r['stored_bytes'], r['ratio'], r['decode_MBps']))
+            print('%-80s %14d %14d %6.2f:1 %10.1f MB/s' %
+                  (rep['folder'], rep['raw_bytes'], rep['stored_bytes'], rep['ratio'], rep['decode_MBps'] or 0))
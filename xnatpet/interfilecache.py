@@ -0,0 +1,121 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+
+class InterfileCache(object):
+    """Is a bounded, thread-safe LRU cache of parsed Interfile dictionaries, keyed by path, mtime and size, so that a
+       file modified or replaced is parsed again.  Parsing errors are cached as well and raised again on each hit.
+       Cached dictionaries are shared and must not be modified.  The module-level interfile_cache is used by
+       Calibration."""
+
+    __author__ = "John J. Lee"
+    __copyright__ = "Copyright 2019"
+
+    maxsize = 1024 # parsed headers kept
+    nthreads = 8 # for headers_for
+
+    def key(self, path):
+        st = os.stat(path)
+        return os.path.abspath(path), st.st_mtime, st.st_size
+
+    def cached(self, path):
+        """
+        :param path:
+        :return True if the current version of path has been parsed:
+        """
+        try:
+            k = self.key(path)
+        except OSError:
+            return False
+        with self.__lock:
+            return k in self.__cache
+
+    def get(self, path):
+        """
+        :param path of an Interfile header, or a file containing one:
+        :return dictionary of interfile fields from Interfile.load:
+        """
+        k = self.key(path)
+        with self.__lock:
+            if k in self.__cache:
+                self.hits += 1
+                value = self.__cache.pop(k)
+                self.__cache[k] = value # most recently used
+                return self.__result(value)
+        try:
+            value = (self.__load(path), None)
+        except Exception as e:
+            if isinstance(e, (AttributeError, TypeError)):
+                raise # programming errors are not cached
+            value = (None, e)
+        with self.__lock:
+            self.misses += 1
+            self.__cache[k] = value
+            while len(self.__cache) > self.maxsize:
+                self.__cache.popitem(last=False)
+        return self.__result(value)
+
+    def headers_for(self, paths):
+        """
+        parses many files concurrently
+        :param paths:
+        :return OrderedDict of path -> dictionary of interfile fields, or None if path could not be parsed:
+        """
+        from multiprocessing.pool import ThreadPool
+        paths = list(paths)
+        if not paths:
+            return OrderedDict()
+        pool = ThreadPool(max(1, min(self.nthreads, len(paths))))
+        try:
+            values = pool.map(self.__get_or_none, paths)
+        finally:
+            pool.close()
+            pool.join()
+        return OrderedDict(zip(paths, values))
+
+    def clear(self):
+        with self.__lock:
+            self.__cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __get_or_none(self, path):
+        try:
+            return self.get(path)
+        except (AttributeError, TypeError):
+            raise
+        except Exception:
+            return None
+
+    def __load(self, path):
+        if self.loader is None:
+            from interfile import Interfile
+            return Interfile.load(path)
+        return self.loader(path)
+
+    def __result(self, value):
+        if value[1] is not None:
+            raise value[1]
+        return value[0]
+
+    def __len__(self):
+        return len(self.__cache)
+
+    def __init__(self, maxsize=None, loader=None):
+        """
+        :param maxsize; default is InterfileCache.maxsize:
+        :param loader(path) returns a parsed header; default is interfile.Interfile.load:
+        """
+        if maxsize:
+            self.maxsize = maxsize
+        self.loader = loader
+        self.hits = 0
+        self.misses = 0
+        self.__cache = OrderedDict()
+        self.__lock = threading.Lock()
+
+
+
+interfile_cache = InterfileCache()
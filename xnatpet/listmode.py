@@ -0,0 +1,296 @@
+import os
+from collections import namedtuple
+
+# PETLINK 32-bit listmode words, little-endian
+TAG_BIT = 0x80000000 # set in tag words; clear in event words
+PROMPT_BIT = 0x40000000 # of event words; set for prompts, clear for delays
+TAG_MASK = 0xE0000000
+ELAPSED_TIME = 0x80000000 # tag words whose high bits match hold elapsed time
+TIME_MASK = 0x1FFFFFFF # msec of elapsed-time tags
+
+
+
+class CountRates(namedtuple('CountRates', ['prompts', 'delays', 'words', 'tags', 'first_ms', 'last_ms'])):
+    """Is prompts and delays per second of elapsed time, as int64 arrays, with the number of words and tag words read
+       and the first and last elapsed-time tags (msec), or None if the stream has no elapsed-time tag."""
+
+    __slots__ = ()
+
+    @property
+    def duration(self):
+        """
+        :return sec of elapsed time spanned by the stream:
+        """
+        if self.last_ms is None:
+            return 0
+        return (self.last_ms - self.first_ms) / 1000.0
+
+    @property
+    def trues(self):
+        return self.prompts - self.delays
+
+
+
+class Listmode(object):
+    """Reads a PETLINK 32-bit listmode .bf, memory-mapped as uint32 and decoded a chunk of words at a time, so that
+       memory stays bounded for .bf of any size.  A .bf stored only as .bfz by xnatpet.compressedbf is decoded a
+       compressed chunk at a time instead.  The interfile header of the .dcm with the same root, or of a
+       PetlinkHeader passed in, gives the expected number of words and the image duration."""
+
+    __author__ = "John J. Lee"
+    __copyright__ = "Copyright 2019"
+
+    chunk_words = 1 << 22 # 16 MiB of words per chunk
+    index_ms = 1000 # msec between entries of time_index
+
+    @property
+    def compressed(self):
+        """
+        :return xnatpet.compressedbf.CompressedBf if bf is stored only as .bfz, else None:
+        """
+        from compressedbf import CompressedBf, bf_path
+        path = bf_path(self.bf)
+        if path == self.bf:
+            return None
+        return CompressedBf(path)
+
+    @property
+    def nwords(self):
+        from compressedbf import raw_size
+        return raw_size(self.bf) // 4
+
+    @property
+    def header(self):
+        """
+        :return xnatpet.petlink.PetlinkHeader of the .dcm with the root of bf, or None if there is none:
+        """
+        if self.__header is None:
+            from petlink import petlink_cache
+            dcm = os.path.splitext(self.bf)[0] + '.dcm'
+            try:
+                self.__header = petlink_cache.get(dcm)
+            except (AssertionError, OSError):
+                self.__header = False
+        return self.__header or None
+
+    @property
+    def truncated(self):
+        """
+        :return True if bf has fewer words than its header counts, or a trailing partial word:
+        """
+        from compressedbf import raw_size
+        if raw_size(self.bf) % 4:
+            return True
+        h = self.header
+        return bool(h and h.total_words and self.nwords < h.total_words)
+
+    def memmap(self):
+        """
+        :return read-only numpy.memmap of the whole words of bf, or an empty array:
+        """
+        import numpy as np
+        n = self.nwords
+        if n == 0:
+            return np.zeros(0, dtype='<u4')
+        return np.memmap(self.bf, dtype='<u4', mode='r', shape=(n,))
+
+    def chunks(self, start=0, stop=None):
+        """
+        :param start word:
+        :param stop word; default is the end of bf:
+        :return generator of (offset, numpy.ndarray of words) of at most chunk_words each, or of the chunks of
+                compressed:
+        """
+        c = self.compressed
+        if c is not None:
+            for i, w in self.__compressed_chunks(c, start, stop):
+                yield i, w
+            return
+        mm = self.memmap()
+        stop = len(mm) if stop is None else min(stop, len(mm))
+        for i in range(start, stop, self.chunk_words):
+            yield i, mm[i:min(i + self.chunk_words, stop)]
+
+    def count_rates(self):
+        """
+        decodes tag, prompt and delay words; each event is counted in the second of the latest elapsed-time tag
+        preceding it, and events preceding any such tag in second 0
+        :return CountRates:
+        """
+        import numpy as np
+        prompts = np.zeros(0, dtype=np.int64)
+        delays = np.zeros(0, dtype=np.int64)
+        ntags = 0
+        first_ms = None
+        carry_ms = 0
+        for i, w in self.chunks():
+            w = np.asarray(w)
+            is_time = (w & TAG_MASK) == ELAPSED_TIME
+            is_event = w < TAG_BIT
+            ntags += len(w) - int(np.count_nonzero(is_event))
+            times = (w[is_time] & TIME_MASK).astype(np.int64)
+            if len(times) and first_ms is None:
+                first_ms = int(times[0])
+            sec = np.concatenate(([carry_ms], times)) // 1000
+            sec = sec[np.cumsum(is_time)] # second of each word
+            if len(times):
+                carry_ms = int(times[-1])
+            is_prompt = (w & PROMPT_BIT) != 0
+            prompts = self.__accumulate(prompts, sec[is_event & is_prompt])
+            delays = self.__accumulate(delays, sec[is_event & ~is_prompt])
+        n = max(len(prompts), len(delays))
+        prompts = np.pad(prompts, (0, n - len(prompts)), 'constant')
+        delays = np.pad(delays, (0, n - len(delays)), 'constant')
+        return CountRates(prompts, delays, self.nwords, ntags, first_ms, carry_ms if first_ms is not None else None)
+
+    def time_index(self, stop_ms=None):
+        """
+        builds a sparse index of elapsed-time tags, reading chunks in order and stopping after the chunk holding a tag
+        stop_ms after the first tag; tags are assumed not to decrease
+        :param stop_ms, msec after the first tag; default reads all of bf:
+        :return (ms, offsets) as int64 arrays of the elapsed time and word offset of the first tag of each interval
+                of index_ms following the first tag:
+        """
+        import numpy as np
+        ms = []
+        offsets = []
+        first_ms = None
+        last = -1
+        for i, w in self.chunks():
+            w = np.asarray(w)
+            pos = np.flatnonzero((w & TAG_MASK) == ELAPSED_TIME)
+            if not len(pos):
+                continue
+            t = (w[pos] & TIME_MASK).astype(np.int64)
+            if first_ms is None:
+                first_ms = int(t[0])
+            b = (t - first_ms) // self.index_ms
+            keep = np.flatnonzero(np.diff(np.concatenate(([last], b))) > 0)
+            ms.append(t[keep])
+            offsets.append(pos[keep].astype(np.int64) + i)
+            last = b[-1]
+            if stop_ms is not None and t[-1] >= first_ms + stop_ms:
+                break
+        if not ms:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(ms), np.concatenate(offsets)
+
+    def extract(self, dest, start=0, stop=None):
+        """
+        copies the words of bf from the first elapsed-time tag start sec after the first tag of bf until the first
+        tag stop sec after it, sequentially in chunks, to dest; the .dcm with the root of bf, if any, is copied to the
+        .dcm with the root of dest with its interfile image duration and total listmode word counts updated
+        :param dest is the .bf to write, with a root other than that of bf:
+        :param start sec:
+        :param stop sec; default is the end of bf:
+        :return (dest, words written):
+        """
+        import numpy as np
+        if stop is not None and stop <= start:
+            raise AssertionError('Listmode.extract needs start < stop')
+        if os.path.splitext(os.path.realpath(dest))[0] == os.path.splitext(os.path.realpath(self.bf))[0]:
+            # dest would truncate the .bf, .bfz or .dcm being read
+            raise AssertionError('Listmode.extract would overwrite its source %s with %s' % (self.bf, dest))
+        ms, offsets = self.time_index(stop_ms=None if stop is None else 1000 * stop)
+        if not len(ms):
+            raise AssertionError('Listmode.extract found no elapsed-time tags in %s' % self.bf)
+        first_ms = ms[0]
+        i0 = np.searchsorted(ms, first_ms + 1000 * start)
+        if i0 == len(ms):
+            raise AssertionError('Listmode.extract found no data after %s sec in %s' % (start, self.bf))
+        i1 = len(ms) if stop is None else np.searchsorted(ms, first_ms + 1000 * stop)
+        w0 = int(offsets[i0])
+        w1 = int(offsets[i1]) if i1 < len(ms) else self.nwords
+        end_ms = int(ms[i1]) if i1 < len(ms) else self.last_tag_ms(offsets[-1])
+        c = self.compressed
+        with open(dest, 'wb') as g:
+            if c is not None:
+                for i in range(w0, w1, self.chunk_words):
+                    g.write(c.read(4 * i, 4 * min(self.chunk_words, w1 - i)))
+            else:
+                nbytes = 4 * (w1 - w0)
+                with open(self.bf, 'rb') as f:
+                    f.seek(4 * w0)
+                    while nbytes > 0:
+                        block = f.read(min(nbytes, 4 * self.chunk_words))
+                        if not block:
+                            break
+                        g.write(block)
+                        nbytes -= len(block)
+        dcm = os.path.splitext(self.bf)[0] + '.dcm'
+        if os.path.isfile(dcm):
+            from petlink import write_dcm
+            write_dcm(dcm, os.path.splitext(dest)[0] + '.dcm',
+                      image_duration=int(round((end_ms - ms[i0]) / 1000.0)), total_words=w1 - w0)
+        return dest, w1 - w0
+
+    def last_tag_ms(self, offset=0):
+        """
+        :param offset of a word of bf:
+        :return msec of the last elapsed-time tag at or after offset, reading from offset to the end of bf:
+        """
+        import numpy as np
+        last = None
+        for i, w in self.chunks(start=int(offset)):
+            w = np.asarray(w)
+            t = w[(w & TAG_MASK) == ELAPSED_TIME]
+            if len(t):
+                last = int(t[-1] & TIME_MASK)
+        return last
+
+    def __compressed_chunks(self, c, start, stop):
+        import numpy as np
+        stop = self.nwords if stop is None else min(stop, self.nwords)
+        words_per_chunk = c.chunk_bytes // 4
+        first = start // words_per_chunk
+        i = first * words_per_chunk
+        for data in c.chunks(first):
+            if i >= stop:
+                break
+            w = np.frombuffer(data, dtype='<u4', count=len(data) // 4)
+            lo = max(start - i, 0)
+            yield i + lo, w[lo:stop - i]
+            i += len(w)
+
+    def __accumulate(self, curve, sec):
+        import numpy as np
+        if not len(sec):
+            return curve
+        c = np.bincount(sec).astype(np.int64)
+        if len(c) > len(curve):
+            curve = np.pad(curve, (0, len(c) - len(curve)), 'constant')
+        curve[:len(c)] += c
+        return curve
+
+    def __init__(self, bf, header=None):
+        """
+        :param bf is a PETLINK 32-bit listmode file:
+        :param header is a xnatpet.petlink.PetlinkHeader; default reads the .dcm with the root of bf:
+        """
+        self.bf = bf
+        self.__header = header
+
+
+
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser(description='reports prompts and delays per second of PETLINK 32-bit listmode .bf')
+    p.add_argument('bf', nargs='+')
+    p.add_argument('--curves', action='store_true', help='prints counts of each second')
+    p.add_argument('--window', metavar=('<start>', '<stop>'), nargs=2, type=float, default=None,
+                   help='sec after the first elapsed-time tag to extract to <bf>-<start>-<stop>s.bf')
+    args = p.parse_args()
+    if args.window:
+        for bf in args.bf:
+            root = os.path.splitext(bf)[0]
+            dest, n = Listmode(bf).extract('%s-%g-%gs.bf' % (root, args.window[0], args.window[1]), *args.window)
+            print('%s:  %d words' % (dest, n))
+    for bf in args.bf:
+        lm = Listmode(bf)
+        cr = lm.count_rates()
+        print('%s:  %d words, %d tags, %.3f sec, %d prompts, %d delays%s' %
+              (bf, cr.words, cr.tags, cr.duration, cr.prompts.sum(), cr.delays.sum(),
+               ', truncated' if lm.truncated else ''))
+        if args.curves:
+            for s, (pr, de) in enumerate(zip(cr.prompts, cr.delays)):
+                print('%6d %10d %10d' % (s, pr, de))
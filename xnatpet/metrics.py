@@ -0,0 +1,153 @@
+import json
+import time
+import threading
+from functools import wraps
+
+
+
+class Metrics(object):
+    """Records wall time, bytes, requests, retries, cache hits and bytes avoided for nested phases of work, e.g.,
+       stage_session > stage_rawdata > download.  Counts added within a phase accrue to every enclosing phase
+       of the same thread.  Completed records may be emitted as JSON-lines."""
+
+    __author__ = "John J. Lee"
+    __copyright__ = "Copyright 2019"
+
+    counters = ('bytes', 'requests', 'retries', 'cache_hits', 'bytes_avoided')
+
+    @property
+    def open_records(self):
+        if not hasattr(self.__local, 'stack'):
+            self.__local.stack = []
+        return self.__local.stack
+
+    def timer(self, phase, **fields):
+        """
+        :param phase names the work, e.g., 'stage_session', 'download', 'parse', 'move':
+        :param fields are added to the record, e.g., session='CNDA_E248568':
+        :return context manager yielding the open record:
+        """
+        return _Timer(self, phase, fields)
+
+    def count(self, **counts):
+        """
+        adds counts, e.g., bytes=1024, to all open records of the calling thread
+        :param counts are keyed by Metrics.counters:
+        """
+        for rec in self.open_records:
+            for k, v in counts.items():
+                rec[k] = rec.get(k, 0) + v
+
+    def emit(self, rec):
+        with self.__lock:
+            self.records.append(rec)
+            if self.jsonl:
+                with open(self.jsonl, 'a') as f:
+                    f.write(json.dumps(rec) + '\n')
+
+    def export(self, fname):
+        """
+        :param fname is a JSON-lines file to write with all completed records:
+        """
+        with open(fname, 'w') as f:
+            for rec in self.records:
+                f.write(json.dumps(rec) + '\n')
+        return fname
+
+    def summary(self, records=None):
+        """
+        :param records; default is all completed records:
+        :return dict keyed by phase with calls, wall time and totals of counters:
+        """
+        if records is None:
+            records = self.records
+        summ = {}
+        for rec in records:
+            s = summ.setdefault(rec['phase'], dict([('calls', 0), ('wall', 0.0)] + [(c, 0) for c in self.counters]))
+            s['calls'] += 1
+            s['wall'] += rec['wall']
+            for c in self.counters:
+                s[c] += rec.get(c, 0)
+        return summ
+
+    def slowest(self, phase, n=10):
+        """
+        :param phase:
+        :param n:
+        :return the n completed records of phase having the greatest wall time:
+        """
+        recs = [r for r in self.records if r['phase'] == phase]
+        return sorted(recs, key=lambda r: -r['wall'])[:n]
+
+    def print_summary(self, records=None):
+        summ = self.summary(records)
+        print('\n%-24s %8s %12s %14s %10s %8s %10s %14s' %
+              ('phase', 'calls', 'wall (s)', 'bytes', 'requests', 'retries', 'cache hits', 'bytes avoided'))
+        for phase in sorted(summ, key=lambda p: -summ[p]['wall']):
+            s = summ[phase]
+            print('%-24s %8d %12.3f %14d %10d %8d %10d %14d' %
+                  (phase, s['calls'], s['wall'], s['bytes'], s['requests'], s['retries'], s['cache_hits'],
+                   s['bytes_avoided']))
+        if self.jsonl:
+            with self.__lock:
+                with open(self.jsonl, 'a') as f:
+                    f.write(json.dumps({'summary': summ, 'time': time.time()}) + '\n')
+        return summ
+
+    def __init__(self, jsonl=None):
+        """
+        :param jsonl is a file to which completed records are appended as JSON-lines:
+        """
+        self.jsonl = jsonl
+        self.records = []
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+
+
+class _Timer(object):
+
+    def __enter__(self):
+        self.rec = dict(self.fields)
+        self.rec['phase'] = self.phase
+        self.rec['time'] = time.time()
+        self.rec['depth'] = len(self.metrics.open_records)
+        for c in Metrics.counters:
+            self.rec[c] = 0
+        self.metrics.open_records.append(self.rec)
+        self.__t0 = time.time()
+        return self.rec
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.rec['wall'] = time.time() - self.__t0
+        if exc_type is not None:
+            self.rec['error'] = exc_type.__name__
+        stack = self.metrics.open_records
+        del stack[[id(r) for r in stack].index(id(self.rec))]
+        self.metrics.emit(self.rec)
+        return False
+
+    def __init__(self, metrics, phase, fields):
+        self.metrics = metrics
+        self.phase = phase
+        self.fields = fields
+
+
+
+def timed(phase):
+    """
+    decorates methods of objects having a Metrics attribute named metrics;
+    records are updated with the dict returned by the object's metrics_fields(), if defined
+    :param phase names the work:
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.timer(phase) as rec:
+                try:
+                    return method(self, *args, **kwargs)
+                finally:
+                    if hasattr(self, 'metrics_fields'):
+                        rec.update(self.metrics_fields())
+        return wrapper
+    return decorator
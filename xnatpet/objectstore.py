@@ -0,0 +1,140 @@
+import os
+import errno
+
+
+
+class ObjectStore(object):
+    """Keeps each staged file once, as <root>/<digest[:2]>/<digest>, and hardlinks it into the BIDS-like layout of
+       cachedir, e.g., ses-*/FDG_DT*-Converted-NAC/LM.  Files staged through the store share inodes and must be
+       treated as read-only.  Objects no longer linked from cachedir are removed by gc()."""
+
+    __author__ = "John J. Lee"
+    __copyright__ = "Copyright 2019"
+
+    hash_name = 'sha1'
+    block_size = 1048576 # bytes read per update of the digest
+
+    def digest(self, fname):
+        """
+        :param fname:
+        :return hex digest of the contents of fname:
+        """
+        import hashlib
+        h = hashlib.new(self.hash_name)
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(self.block_size), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def object_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, src, dest):
+        """
+        moves src into the store, or removes src if the store already has its contents, then hardlinks the object to
+        dest, replacing any existing dest
+        :param src is a regular file:
+        :param dest is a filename:
+        :return dest:
+        """
+        import shutil
+        obj = self.object_path(self.digest(src))
+        self.__ensuredir(os.path.dirname(obj))
+        if os.path.exists(obj):
+            os.remove(src)
+        elif os.path.islink(src):
+            shutil.copy2(src, obj)
+            os.remove(src)
+        else:
+            shutil.move(src, obj)
+        self.__ensuredir(os.path.dirname(dest))
+        if os.path.lexists(dest):
+            if os.path.exists(dest) and os.path.samefile(obj, dest):
+                return dest
+            os.remove(dest)
+        try:
+            os.link(obj, dest)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copy2(obj, dest) # the store is not on the filesystem of dest
+        return dest
+
+    def objects(self):
+        """
+        :return generator of object filenames:
+        """
+        if not os.path.isdir(self.root):
+            return
+        for d in sorted(os.listdir(self.root)):
+            for o in sorted(os.listdir(os.path.join(self.root, d))):
+                yield os.path.join(self.root, d, o)
+
+    def report(self):
+        """
+        :return dict with counts of objects, links into cachedir, bytes stored and bytes saved by deduplication:
+        """
+        rep = {'objects': 0, 'links': 0, 'bytes': 0, 'bytes_saved': 0, 'unreferenced': 0}
+        for o in self.objects():
+            st = os.stat(o)
+            links = st.st_nlink - 1
+            rep['objects'] += 1
+            rep['links'] += links
+            rep['bytes'] += st.st_size
+            rep['bytes_saved'] += max(links - 1, 0) * st.st_size
+            rep['unreferenced'] += links == 0
+        return rep
+
+    def gc(self, dry_run=False):
+        """
+        removes objects having no hardlinks remaining in cachedir
+        :param dry_run only counts:
+        :return (objects removed, bytes freed):
+        """
+        nobjs = 0
+        nbytes = 0
+        for o in list(self.objects()):
+            st = os.stat(o)
+            if st.st_nlink > 1:
+                continue
+            nobjs += 1
+            nbytes += st.st_size
+            if not dry_run:
+                os.remove(o)
+        if not dry_run and os.path.isdir(self.root):
+            for d in os.listdir(self.root):
+                if not os.listdir(os.path.join(self.root, d)):
+                    os.rmdir(os.path.join(self.root, d))
+        return nobjs, nbytes
+
+    def __ensuredir(self, d):
+        try:
+            os.makedirs(d)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def __init__(self, cachedir, root=None):
+        """
+        :param cachedir is the staging cache directory, e.g., StageXnat.cachedir:
+        :param root of objects; default is <cachedir>/.objects, on the filesystem of cachedir as hardlinks require:
+        """
+        self.cachedir = cachedir
+        self.root = root if root else os.path.join(cachedir, '.objects')
+
+
+
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser(description='reports on or garbage-collects the object store of a staging cachedir')
+    p.add_argument('command', choices=['report', 'gc'])
+    p.add_argument('-c', '--cachedir', metavar='<path>', required=True, help='path containing project-level data')
+    p.add_argument('-n', '--dry-run', action='store_true', help='gc only counts unreferenced objects')
+    args = p.parse_args()
+    store = ObjectStore(args.cachedir)
+    if args.command == 'gc':
+        nobjs, nbytes = store.gc(dry_run=args.dry_run)
+        print('%s %d unreferenced objects, %d bytes.' % ('Found' if args.dry_run else 'Removed', nobjs, nbytes))
+    rep = store.report()
+    print('%d objects, %d links, %d bytes stored, %d bytes saved by deduplication.' %
+          (rep['objects'], rep['links'], rep['bytes'], rep['bytes_saved']))
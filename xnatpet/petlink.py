@@ -0,0 +1,164 @@
+import os
+import re
+import struct
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+from interfilecache import InterfileCache
+
+PETLINK_TAG = (0x0029, 0x1010) # [CSA Data Info] of listmode and norm .dcm, holding the PETLINK interfile header
+_EXPLICIT = b'\x29\x00\x10\x10OB\x00\x00' # tag, VR, reserved; then uint32 length
+_IMPLICIT = b'\x29\x00\x10\x10' # tag; then uint32 length
+_INTERFILE = b'!INTERFILE'
+_UNITS = re.compile(r'\s*[\(\[].*$') # e.g., (sec), (yyyy:mm:dd), [1]
+
+
+
+def _date(s):
+    return datetime.strptime(s, '%Y:%m:%d').date()
+
+def _time(s):
+    return datetime.strptime(s[:8], '%H:%M:%S').time()
+
+# record field -> (interfile key without '!', '%' or units, converter)
+FIELDS = OrderedDict([
+    ('study_date', ('study date', _date)),
+    ('study_time', ('study time', _time)),
+    ('tracer', ('radiopharmaceutical', str)),
+    ('isotope', ('isotope name', str)),
+    ('halflife', ('isotope gamma halflife', float)), # sec
+    ('branching_factor', ('isotope branching factor', float)),
+    ('injected_activity', ('tracer activity at time of injection', float)), # Bq
+    ('injection_date', ('tracer injection date', _date)),
+    ('injection_time', ('tracer injection time', _time)),
+    ('image_duration', ('image duration', int)), # sec
+    ('total_words', ('total listmode word counts', int)),
+    ('word_bits', ('lm event and tag words format', int)),
+    ('tag_interval', ('timing tagwords interval', int)), # msec
+    ('data_format', ('data format', str)),
+    ('data_file', ('name of data file', str))])
+_KEYS = dict((key, (field, conv)) for field, (key, conv) in FIELDS.items())
+
+
+
+class PetlinkHeader(namedtuple('PetlinkHeader', list(FIELDS))):
+    """Is a typed record of the PETLINK interfile header embedded in listmode and norm .dcm files, e.g., as in
+       tests/pet_listmode.l.hdr.  Fields missing from a header are None."""
+
+    __slots__ = ()
+
+    @property
+    def study_datetime(self):
+        if self.study_date is None or self.study_time is None:
+            return None
+        return datetime.combine(self.study_date, self.study_time)
+
+    @classmethod
+    def parse(cls, text):
+        """
+        converts only the key := value lines of FIELDS
+        :param text of an interfile header, bytes or str:
+        :return PetlinkHeader:
+        """
+        if isinstance(text, bytes):
+            text = text.decode('latin-1')
+        values = dict.fromkeys(FIELDS)
+        for line in text.splitlines():
+            k, sep, v = line.partition(':=')
+            if not sep:
+                continue
+            k = _UNITS.sub('', k.strip().lstrip('!%').strip()).lower()
+            if k not in _KEYS:
+                continue
+            field, conv = _KEYS[k]
+            v = v.strip()
+            try:
+                values[field] = conv(str(v)) if v else None
+            except (ValueError, UnicodeEncodeError):
+                values[field] = None
+        return cls(**values)
+
+    @classmethod
+    def read(cls, dcm):
+        """
+        :param dcm is a listmode or norm .dcm, or an interfile .hdr:
+        :return PetlinkHeader:
+        """
+        blob = interfile_blob(dcm)
+        if blob is None:
+            raise AssertionError('PetlinkHeader.read found no interfile header in %s' % dcm)
+        return cls.parse(blob)
+
+
+
+def interfile_blob(fname):
+    """
+    locates the PETLINK interfile header in DICOM element (0029,1010), explicit or implicit VR, without parsing
+    other elements; files that are not DICOM, e.g., .hdr, are returned from !INTERFILE to their first NUL
+    :param fname:
+    :return bytes of the interfile header, or None:
+    """
+    import mmap
+    size = os.path.getsize(fname)
+    if size == 0:
+        return None
+    with open(fname, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            i = mm.find(_EXPLICIT)
+            while i >= 0:
+                if mm[i+12:i+12+len(_INTERFILE)] == _INTERFILE:
+                    length = struct.unpack('<I', mm[i+8:i+12])[0]
+                    return mm[i+12:i+12+length].rstrip(b'\x00')
+                i = mm.find(_EXPLICIT, i + 1)
+            i = mm.find(_IMPLICIT)
+            while i >= 0:
+                if mm[i+8:i+8+len(_INTERFILE)] == _INTERFILE:
+                    length = struct.unpack('<I', mm[i+4:i+8])[0]
+                    return mm[i+8:i+8+length].rstrip(b'\x00')
+                i = mm.find(_IMPLICIT, i + 1)
+            i = mm.find(_INTERFILE)
+            if i < 0:
+                return None
+            j = mm.find(b'\x00', i)
+            return mm[i:j if j >= 0 else size]
+        finally:
+            mm.close()
+
+def replace_fields(text, **values):
+    """
+    :param text of an interfile header, bytes:
+    :param values keyed by fields of FIELDS, e.g., image_duration=900, formatted with str:
+    :return bytes of text with the values of those keys replaced, other lines and line endings unchanged:
+    """
+    keys = dict((FIELDS[f][0], str(v).encode('ascii')) for f, v in values.items())
+    lines = text.split(b'\n')
+    for i, line in enumerate(lines):
+        k, sep, v = line.partition(b':=')
+        if not sep:
+            continue
+        key = _UNITS.sub('', k.decode('latin-1').strip().lstrip('!%').strip()).lower()
+        if key in keys:
+            lines[i] = k + sep + keys[key] + (b'\r' if v.endswith(b'\r') else b'')
+    return b'\n'.join(lines)
+
+def write_dcm(dcm, dest, **values):
+    """
+    copies dcm to dest with fields of its PETLINK interfile header replaced, as by replace_fields
+    :param dcm is a listmode .dcm:
+    :param dest is the .dcm to write:
+    :param values keyed by fields of FIELDS:
+    :return dest:
+    """
+    from pydicom import dcmread
+    ds = dcmread(dcm)
+    if PETLINK_TAG not in ds:
+        raise AssertionError('write_dcm found no PETLINK header in %s' % dcm)
+    elem = ds[PETLINK_TAG]
+    text = replace_fields(elem.value.rstrip(b'\x00'), **values)
+    elem.value = text + b'\x00' * (len(text) % 2) # even length
+    ds.save_as(dest)
+    return dest
+
+
+
+petlink_cache = InterfileCache(loader=PetlinkHeader.read) # bounded LRU of PetlinkHeader, keyed by path, mtime and size
@@ -0,0 +1,144 @@
+import os
+import json
+from warnings import warn
+
+
+
+class Sidecar(object):
+    """Is the staged metadata of a tracer folder, e.g., ses-*/FDG_DT*-Converted-NAC, kept as <folder>/<name>.
+       StageXnat.move_rawdata records each listmode or norm .dcm together with its .bf once both are in the folder.
+       Entries are keyed by basename and hold size, mtime and checksum of the file and, for .dcm, the DICOM fields
+       and PETLINK interfile fields consumers such as Calibration would otherwise parse again.  An entry is current
+       while its file keeps its size and mtime, so files may later be arranged into LM/ or norm/ subfolders."""
+
+    __author__ = "John J. Lee"
+    __copyright__ = "Copyright 2019"
+
+    name = 'xnatpet_sidecar.json'
+    version = 1
+    checksums = True # sha1 of each file, as ObjectStore.digest
+    dicom_fields = ('StudyDate', 'StudyTime', 'SeriesDate', 'SeriesTime', 'AcquisitionTime', 'InstanceCreationTime',
+                    'SeriesDescription', 'ImageType', 'Modality')
+
+    @classmethod
+    def find(cls, fname):
+        """
+        :param fname of a file in a tracer folder or in one of its subfolders, e.g., LM/:
+        :return Sidecar of the tracer folder, or None if none has been written:
+        """
+        d = os.path.dirname(os.path.abspath(fname))
+        for folder in (d, os.path.dirname(d)):
+            if os.path.isfile(os.path.join(folder, cls.name)):
+                return cls(folder)
+        return None
+
+    @property
+    def path(self):
+        return os.path.join(self.folder, self.name)
+
+    def entry(self, fname):
+        """
+        :param fname:
+        :return dict recorded for fname if fname has not changed since, else None:
+        """
+        ent = self.entries.get(os.path.basename(fname))
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return None
+        if not ent or ent['size'] != st.st_size or ent['mtime'] != st.st_mtime:
+            return None
+        return ent
+
+    def record(self, fname):
+        """
+        parses and checksums fname, replacing any entry for its basename
+        :param fname is a .dcm, .bf or other file of the folder:
+        :return dict recorded:
+        """
+        from objectstore import ObjectStore
+        st = os.stat(fname)
+        ent = {'size': st.st_size, 'mtime': st.st_mtime}
+        if self.checksums:
+            store = ObjectStore(self.folder)
+            ent[store.hash_name] = store.digest(fname)
+        if fname.endswith('.dcm'):
+            ent['dicom'] = self.__dicom_fields(fname)
+            ent['petlink'] = self.__petlink_fields(fname)
+        self.entries[os.path.basename(fname)] = ent
+        return ent
+
+    def update(self):
+        """
+        records each .dcm of the folder having a .bf, or a .bfz from xnatpet.compressedbf, and that .bf, unless
+        already current, then saves
+        :return list of basenames recorded:
+        """
+        from compressedbf import bf_path
+        recorded = []
+        for f in sorted(os.listdir(self.folder)):
+            root, ext = os.path.splitext(f)
+            bf = bf_path(os.path.join(self.folder, root + '.bf'))
+            if ext != '.dcm' or not os.path.isfile(bf):
+                continue
+            for g in (f, os.path.basename(bf)):
+                if self.entry(os.path.join(self.folder, g)) is None:
+                    self.record(os.path.join(self.folder, g))
+                    recorded.append(g)
+        if recorded:
+            self.save()
+        return recorded
+
+    def load(self):
+        """
+        :return self.entries, read from self.path if it exists and has the current version:
+        """
+        try:
+            with open(self.path, 'r') as f:
+                js = json.load(f)
+        except IOError:
+            return self.entries
+        except ValueError as e:
+            warn('Sidecar.load ignored %s: %s' % (self.path, e))
+            return self.entries
+        if js.get('version') == self.version:
+            self.entries = js.get('files', {})
+        return self.entries
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'version': self.version, 'files': self.entries}, f, indent=1, sort_keys=True)
+        os.rename(self.path + '.tmp', self.path)
+
+    def __dicom_fields(self, fname):
+        from pydicom import dcmread
+        from pydicom.errors import InvalidDicomError
+        from pydicom.multival import MultiValue
+        try:
+            d = dcmread(fname, stop_before_pixels=True, specific_tags=list(self.dicom_fields))
+        except (InvalidDicomError, IOError) as e:
+            warn('Sidecar.record could not read DICOM %s: %s' % (fname, e))
+            return {}
+        fields = {}
+        for k in self.dicom_fields:
+            v = d.get(k)
+            if v is None:
+                continue
+            fields[k] = [str(x) for x in v] if isinstance(v, MultiValue) else str(v)
+        return fields
+
+    def __petlink_fields(self, fname):
+        from petlink import petlink_cache
+        try:
+            h = petlink_cache.get(fname)
+        except AssertionError:
+            return {}
+        return dict((k, v.isoformat() if hasattr(v, 'isoformat') else v) for k, v in h._asdict().items())
+
+    def __init__(self, folder):
+        """
+        :param folder is a tracer folder, e.g., ses-*/FDG_DT*-Converted-NAC:
+        """
+        self.folder = folder
+        self.entries = {}
+        self.load()
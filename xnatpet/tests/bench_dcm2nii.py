@@ -0,0 +1,53 @@
+"""
+Benchmarks dcm2nii_wholeSession.dcm2niiNative, which converts in-process, against dcm2nii_wholeSession.dcm2nii, which
+runs Dcm2nii through nipype, on the umap series of tests/umap; e.g.:
+
+    python -m xnatpet.tests.bench_dcm2nii --repeats 3 --threads 1 4
+"""
+
+import os
+import shutil
+import tempfile
+import dcm2nii_wholeSession
+from xnatpet.tests.bench_xnatcal import bench
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tests')
+
+
+
+def convert(converter, sources, outdir, **kwargs):
+    """converts into an emptied outdir"""
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.mkdir(outdir)
+    return converter(sources, outdir, True, True, **kwargs)
+
+def main():
+    import argparse
+    p = argparse.ArgumentParser(description='benchmarks DICOM to NIfTI conversion of a umap series')
+    p.add_argument('--repeats', type=int, default=3)
+    p.add_argument('--threads', type=int, nargs='+', default=[1, 4], help='threads of dcm2niiNative')
+    args = p.parse_args()
+
+    umap = os.path.join(FIXTURES, 'umap')
+    sources = sorted(os.path.join(umap, f) for f in os.listdir(umap) if f.endswith('.dcm'))
+    mb = sum(os.path.getsize(s) for s in sources) / 1e6
+    tmp = tempfile.mkdtemp(prefix='bench_dcm2nii_')
+    try:
+        print('%d slices, %.1f MB' % (len(sources), mb))
+        t0 = None
+        try:
+            v, t0 = bench(convert, (dcm2nii_wholeSession.dcm2nii, sources, os.path.join(tmp, 'dcm2nii')), args.repeats)
+            print('%-12s %10.3f s %10.1f MB/s  %s' % ('Dcm2nii', t0, mb / t0, ', '.join(map(os.path.basename, v))))
+        except (ImportError, IOError, OSError) as e:
+            print('%-12s unavailable:  %s' % ('Dcm2nii', e))
+        for n in args.threads:
+            v, t = bench(lambda *a: convert(*a, nthreads=n),
+                         (dcm2nii_wholeSession.dcm2niiNative, sources, os.path.join(tmp, 'native')), args.repeats)
+            print('%-12s %10.3f s %10.1f MB/s %8s  %s' % ('native x%d' % n, t, mb / t,
+                                                         '%.1fx' % (t0 / t) if t0 else '',
+                                                         ', '.join(map(os.path.basename, v))))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Benchmarks xnatpet.petlink.PetlinkHeader.read, which locates the PETLINK interfile header in DICOM element (0029,1010)
+and converts only the fields it needs, against the former paths:  Interfile.load, which raises ParsingError on
+listmode DICOM, and whole-file regexes over the printable runs found by Calibration.bin2str; e.g.:
+
+    python -m xnatpet.tests.bench_petlink --size 64 --repeats 5
+"""
+
+import os
+import re
+import shutil
+import tempfile
+from xnatpet.petlink import PetlinkHeader
+from xnatpet.tests.bench_xnatcal import make_padded, bench
+
+FIXTURES = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'tests'))
+
+
+
+def interfile_load(fname):
+    """Interfile.load; returns None on ParsingError, as for listmode .dcm"""
+    from interfile import Interfile
+    try:
+        d = Interfile.load(fname)
+    except Interfile.ParsingError:
+        return None
+    return d['image duration']['value'], d['radiopharmaceutical']['value']
+
+def legacy_regex(cal, fname):
+    """former whole-file search, with the patterns of Calibration.search_image_duration_value and StageXnat.is_tracer"""
+    with open(fname, 'rb') as f:
+        string = '\n'.join(cal.bin2str(f))
+    dur = re.search('image duration \(sec\) :=(\d+)', string)
+    tracer = re.search('(?<=radiopharmaceutical :=)[A-Za-z\-]+', string)
+    return int(dur.group(1)), tracer.group(0)
+
+def petlink(fname):
+    h = PetlinkHeader.read(fname)
+    return h.image_duration, h.tracer
+
+def main():
+    import argparse
+    from xnatpet.xnatcal import Calibration
+    p = argparse.ArgumentParser(description='benchmarks extraction of PETLINK interfile headers')
+    p.add_argument('--size', type=int, default=64, help='MB of padding preceding the header of a synthetic .dcm')
+    p.add_argument('--repeats', type=int, default=5)
+    args = p.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='bench_petlink_')
+    cwd = os.getcwd()
+    try:
+        cal = Calibration(None, None, cachedir=tmp, prj='CCIR_00754')
+        fixtures = [os.path.join(FIXTURES, f) for f in ('listmode.dcm', 'norm.dcm', 'pet_listmode.l.hdr')]
+        fixtures.append(make_padded(fixtures[0], os.path.join(tmp, 'padded.dcm'), args.size))
+        print('%-30s %12s %12s %12s %10s' % ('file', 'Interfile (s)', 'regex (s)', 'petlink (s)', 'vs regex'))
+        for fname in fixtures:
+            v0, t0 = bench(interfile_load, (fname,), args.repeats)
+            try:
+                v1, t1 = bench(legacy_regex, (cal, fname), args.repeats)
+            except AttributeError: # norm.dcm has no listmode fields
+                v1, t1 = None, float('nan')
+            v2, t2 = bench(petlink, (fname,), args.repeats)
+            assert(v1 is None or v1 == v2)
+            label = '%s (%.1f MB)' % (os.path.basename(fname), os.path.getsize(fname) / 1e6)
+            print('%-30s %12.5f %12.5f %12.5f %10.1f' % (label, t0, t1, t2, t1 / t2 if t2 else float('inf')))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
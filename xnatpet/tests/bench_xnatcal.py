@@ -0,0 +1,79 @@
+"""
+Benchmarks Calibration.search_image_duration_value, which scans memory-mapped files for an interfile key,
+against the former path, which extracted every printable run of the whole file with Calibration.bin2str; e.g.:
+
+    python -m xnatpet.tests.bench_xnatcal --size 64 --repeats 5
+"""
+
+import os
+import re
+import time
+import shutil
+import tempfile
+from xnatpet.xnatcal import Calibration
+
+FIXTURE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'tests', 'listmode.dcm'))
+
+
+
+def legacy_image_duration(cal, dcm):
+    """former search_image_duration_value, searching the joined runs found by bin2str"""
+    p = re.compile("image duration \(sec\) :=(\d+)")
+    with open(dcm, 'rb') as d:
+        string = '\n'.join(cal.bin2str(d))
+    result = p.search(string)
+    assert(result.group(1))
+    return int(result.group(1))
+
+def make_padded(dcm, fname, size):
+    """
+    writes fname with size MB of binary padding before the contents of dcm, so that the interfile header
+    lies at the end of a multi-MB file
+    :return fname:
+    """
+    block = os.urandom(1048576)
+    with open(fname, 'wb') as f:
+        for _ in range(size):
+            f.write(block)
+        with open(dcm, 'rb') as g:
+            shutil.copyfileobj(g, f)
+    return fname
+
+def bench(fun, args, repeats):
+    """
+    :return (value, best wall time of repeats):
+    """
+    best = None
+    value = None
+    for _ in range(repeats):
+        t0 = time.time()
+        value = fun(*args)
+        dt = time.time() - t0
+        best = dt if best is None else min(best, dt)
+    return value, best
+
+def main():
+    import argparse
+    p = argparse.ArgumentParser(description='benchmarks interfile key search in listmode DICOM')
+    p.add_argument('--size', type=int, default=64, help='MB of padding preceding the interfile header')
+    p.add_argument('--repeats', type=int, default=5)
+    args = p.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='bench_xnatcal_')
+    cwd = os.getcwd()
+    try:
+        cal = Calibration(None, None, cachedir=tmp, prj='CCIR_00754')
+        padded = make_padded(FIXTURE, os.path.join(tmp, 'padded.dcm'), args.size)
+        print('%-34s %10s %10s %12s' % ('file', 'legacy (s)', 'mmap (s)', 'speedup'))
+        for fname in (FIXTURE, padded):
+            v0, t0 = bench(legacy_image_duration, (cal, fname), args.repeats)
+            v1, t1 = bench(cal.search_image_duration_value, (fname,), args.repeats)
+            assert(v0 == v1)
+            label = '%s (%.1f MB)' % (os.path.basename(fname), os.path.getsize(fname) / 1e6)
+            print('%-34s %10.4f %10.4f %12.1f' % (label, t0, t1, t0 / t1 if t1 else float('inf')))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""
+Benchmarks staging throughput of StageXnat against a local xnatpet.tests.fakexnat.FakeXnat
+with configurable latency and bandwidth; e.g.:
+
+    python -m xnatpet.tests.bench_xnatpet -m stage_session --latency 0.05 --bandwidth 20 --sessions 2
+    python -m xnatpet.tests.bench_xnatpet -m startup --latency 0.05
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import warnings
+from xnatpet.xnatpet import StageXnat
+from xnatpet.tests.fakexnat import FakeXnat
+
+
+
+def staged_totals(d):
+    """
+    :param d is a directory tree written by StageXnat:
+    :return (nfiles, nbytes) of regular files, not following symlinks:
+    """
+    nfiles = 0
+    nbytes = 0
+    for dirpath, dirnames, files in os.walk(d):
+        for f in files:
+            fn = os.path.join(dirpath, f)
+            if not os.path.islink(fn):
+                nfiles += 1
+                nbytes += os.path.getsize(fn)
+    return nfiles, nbytes
+
+def bench_stage(fake, method, prj, sbj=None, ses=None, tracers=None):
+    """
+    :param fake is a started FakeXnat:
+    :param method is 'stage_session' or 'stage_project':
+    :param prj, sbj, ses are IDs known to fake:
+    :param tracers overrides StageXnat.tracers:
+    :return dict with wall time, files/s, MB/s, request counts and StageXnat.metrics per phase:
+    """
+    cachedir = tempfile.mkdtemp(prefix='bench_xnatpet_')
+    try:
+        cwd = os.getcwd()
+        sx = StageXnat('fake', 'fake', cachedir=cachedir, prj=prj, sbj=sbj, ses=ses, host=fake.url)
+        if tracers:
+            sx.tracers = list(tracers)
+        fake.reset_counts()
+        t0 = time.time()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            getattr(sx, method)()
+        wall = time.time() - t0
+        os.chdir(cwd)
+        nfiles, nbytes = staged_totals(os.path.join(cachedir, prj))
+    finally:
+        shutil.rmtree(cachedir, ignore_errors=True)
+    report = {'method': method,
+              'latency': fake.latency,
+              'bandwidth': fake.bandwidth,
+              'wall_time': wall,
+              'files': nfiles,
+              'bytes': nbytes,
+              'files_per_sec': nfiles / wall if wall else None,
+              'MB_per_sec': nbytes / 1e6 / wall if wall else None}
+    report.update(fake.report())
+    report['phases'] = sx.metrics.summary()
+    return report
+
+def bench_startup(fake, prj, sbj=None, ses=None, ntrials=5):
+    """
+    :param fake is a started FakeXnat:
+    :param prj, sbj, ses are IDs known to fake:
+    :param ntrials of construction:
+    :return dict with mean secs and requests to construct StageXnat, and to first resolve its session:
+    """
+    cachedir = tempfile.mkdtemp(prefix='bench_xnatpet_')
+    cwd = os.getcwd()
+    construct = 0.0
+    resolve = 0.0
+    requests = {'construct': 0, 'resolve': 0}
+    try:
+        for _ in range(ntrials):
+            fake.reset_counts()
+            t0 = time.time()
+            sx = StageXnat('fake', 'fake', cachedir=cachedir, prj=prj, sbj=sbj, ses=ses, host=fake.url)
+            construct += time.time() - t0
+            requests['construct'] += fake.report()['requests_total']
+            fake.reset_counts()
+            t0 = time.time()
+            sx.session
+            resolve += time.time() - t0
+            requests['resolve'] += fake.report()['requests_total']
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(cachedir, ignore_errors=True)
+    return {'method': 'startup',
+            'latency': fake.latency,
+            'trials': ntrials,
+            'construct_time': construct / ntrials,
+            'construct_requests': float(requests['construct']) / ntrials,
+            'resolve_time': resolve / ntrials,
+            'resolve_requests': float(requests['resolve']) / ntrials}
+
+def print_report(report):
+    if report['method'] == 'startup':
+        print('startup:  latency %s s, mean of %d trials' % (report['latency'], report['trials']))
+        print('    construct     %10.3f s %8.1f requests' % (report['construct_time'], report['construct_requests']))
+        print('    first session %10.3f s %8.1f requests' % (report['resolve_time'], report['resolve_requests']))
+        return
+    print('%s:  latency %s s, bandwidth %s B/s' % (report['method'], report['latency'], report['bandwidth']))
+    print('    wall time     %10.3f s' % report['wall_time'])
+    print('    files         %10d' % report['files'])
+    print('    MB            %10.3f' % (report['bytes'] / 1e6))
+    print('    files/s       %10.3f' % report['files_per_sec'])
+    print('    MB/s          %10.3f' % report['MB_per_sec'])
+    print('    requests      %10d  %s' % (report['requests_total'], report['requests']))
+
+
+
+def main():
+    import argparse
+    p = argparse.ArgumentParser(description='benchmarks StageXnat staging against a local fake XNAT')
+    p.add_argument('-m', '--method',
+                   metavar='stage_session|stage_project|startup|all',
+                   default='all')
+    p.add_argument('--latency', type=float, default=0.0, help='secs added to every request')
+    p.add_argument('--bandwidth', type=float, default=None, help='MB/s for file bodies; default is unthrottled')
+    p.add_argument('--subjects', type=int, default=1)
+    p.add_argument('--sessions', type=int, default=1, help='sessions per subject')
+    p.add_argument('--tracers', nargs='+', default=['Fluorodeoxyglucose'])
+    p.add_argument('--nslices', type=int, default=None, help='umap slices; default is all of tests/umap')
+    p.add_argument('--bf-size', type=int, default=16*1048576, help='bytes per .bf')
+    p.add_argument('--fs-size', type=int, default=1048576, help='bytes per freesurfer file')
+    p.add_argument('--json', metavar='<file>', default=None, help='also writes reports as JSON')
+    args = p.parse_args()
+
+    fake = FakeXnat()
+    prj = 'CCIR_00754'
+    reports = []
+    try:
+        eids = fake.seed(prj=prj, nsubjects=args.subjects, nsessions=args.sessions, tracers=args.tracers,
+                         nslices=args.nslices, bf_size=args.bf_size, fs_size=args.fs_size)
+        fake.latency = args.latency
+        fake.bandwidth = args.bandwidth * 1e6 if args.bandwidth else None
+        fake.start()
+        sid = list(fake.projects[prj])[0]
+        if args.method in ('stage_session', 'all'):
+            reports.append(bench_stage(fake, 'stage_session', prj, sbj=sid, ses=eids[0], tracers=args.tracers))
+        if args.method in ('stage_project', 'all'):
+            reports.append(bench_stage(fake, 'stage_project', prj, tracers=args.tracers))
+        if args.method in ('startup', 'all'):
+            reports.append(bench_startup(fake, prj, sbj=sid, ses=eids[0]))
+    finally:
+        fake.stop()
+        fake.cleanup()
+    for r in reports:
+        print_report(r)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,661 @@
+"""
+Local fake of the XNAT REST API, sufficient for StageXnat and pyxnat to stage synthetic PET/MR sessions.
+Sessions are seeded from the DICOM fixtures in tests/:  listmode.dcm, norm.dcm and the umap series.
+"""
+
+import os
+import csv
+import json
+import time
+import shutil
+import threading
+from collections import OrderedDict
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+    from StringIO import StringIO
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, unquote
+    from io import StringIO
+
+FIXTURES = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'tests'))
+
+
+
+def write_listmode(fn, prompts, delays, seed=0, start_ms=0):
+    """
+    writes a PETLINK 32-bit listmode stream with an elapsed-time tag each msec and events at random msec
+    :param fn is the .bf to write:
+    :param prompts per second, a sequence:
+    :param delays per second, a sequence of the length of prompts:
+    :param seed of numpy.random:
+    :param start_ms is the elapsed time of the first tag:
+    :return number of words written:
+    """
+    import numpy as np
+    rng = np.random.RandomState(seed)
+    prompts = np.asarray(prompts, dtype=np.int64)
+    delays = np.asarray(delays, dtype=np.int64)
+    nms = 1000 * len(prompts)
+    tag_ms = np.arange(nms, dtype=np.int64)
+    ev_sec = np.concatenate((np.repeat(np.arange(len(prompts)), prompts), np.repeat(np.arange(len(delays)), delays)))
+    ev_ms = 1000 * ev_sec + rng.randint(0, 1000, len(ev_sec))
+    ev_words = rng.randint(0, 1 << 30, len(ev_sec)).astype(np.uint32)
+    ev_words[:prompts.sum()] |= 0x40000000
+    times = np.concatenate((tag_ms, ev_ms))
+    words = np.concatenate((0x80000000 | (tag_ms + start_ms).astype(np.uint32), ev_words))
+    order = np.lexsort((np.arange(len(times)), times)) # each tag precedes the events of its msec
+    words[order].astype('<u4').tofile(fn)
+    return len(words)
+
+
+
+class FakeXnat(object):
+    """Serves projects, subjects, experiments, scans, resources, files and freesurfer assessors from a local
+       archive directory, and a container service under /xapi.  Latency (secs per request) and bandwidth
+       (bytes/sec for file bodies) are adjustable; requests and bytes served are counted by kind:
+       jsession, listing, object, file, zip, upload, commands, launch, container."""
+
+    __author__ = "John J. Lee"
+    __copyright__ = "Copyright 2019"
+
+    latency = 0.0 # secs
+    bandwidth = None # bytes/sec; None is unthrottled
+    chunk_size = 65536 # bytes
+    container_secs = 0.0 # secs from launch until a container completes
+    jsessionid = 'FAKEXNATJSESSIONID0123456789ABCDEF'
+    failing = () # substrings of paths answered with 500
+    tracer_times = {
+        'Fluorodeoxyglucose': '140741.000000',
+        'Carbon': '114714.000000',
+        'Oxygen': '123025.000000',
+        'Oxygen-water': '133140.000000'}
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server.server_address[:2]
+
+    @property
+    def dir_archive(self):
+        return os.path.join(self.rootdir, 'archive')
+
+
+
+    # SEEDING #########################################################################
+
+    def seed(self, prj='CCIR_00754', nsubjects=1, nsessions=1, tracers=('Fluorodeoxyglucose',),
+             nslices=None, bf_size=1048576, fs_size=1048576):
+        """
+        creates synthetic subjects and PET/MR sessions for a project
+        :param prj is the project ID:
+        :param nsubjects per project:
+        :param nsessions per subject:
+        :param tracers from StageXnat.tracers:
+        :param nslices is the number of umap slices; None uses all of tests/umap:
+        :param bf_size is bytes per .bf file:
+        :param fs_size is bytes per freesurfer file:
+        :return list of experiment IDs:
+        """
+        project = self.projects.setdefault(prj, OrderedDict())
+        eids = []
+        for isbj in range(nsubjects):
+            sid = 'CNDA_S9%04d' % (len(project) + 1)
+            slabel = 'FAKE%02d' % (len(project) + 1)
+            subject = project.setdefault(sid, {'label': slabel, 'experiments': OrderedDict()})
+            for ises in range(nsessions):
+                self.__count_experiments += 1
+                eid = 'CNDA_E9%04d' % self.__count_experiments
+                elabel = '%s_V%d' % (slabel, ises + 1)
+                subject['experiments'][eid] = self.__seed_experiment(
+                    prj, sid, eid, elabel, tracers, nslices, bf_size, fs_size)
+                eids.append(eid)
+        return eids
+
+    def __seed_experiment(self, prj, sid, eid, elabel, tracers, nslices, bf_size, fs_size):
+        edir = os.path.join(self.dir_archive, prj, elabel)
+        date = '2018%02d%02d' % (1 + self.__count_experiments % 12, 1 + self.__count_experiments % 28)
+        exp = {'ID': eid, 'label': elabel, 'project': prj, 'subject': sid, 'date': date, 'dir': edir,
+               'scans': OrderedDict(), 'resources': OrderedDict(), 'assessors': OrderedDict()}
+
+        umaps = sorted(os.listdir(os.path.join(FIXTURES, 'umap')))
+        if nslices:
+            umaps = umaps[:nslices]
+        self.__seed_scan(exp, '1', 'localizer', 'MR', umaps[:3])
+        self.__seed_scan(exp, '2', 'Head_MPRAGE', 'MR', umaps[:3])
+        self.__seed_scan(exp, '3', 'Head_MRAC_Brain_HiRes_in_UMAP', 'MR', umaps)
+        self.__seed_scan(exp, '4', 'Phoenix Document', 'SC', umaps[:2])
+
+        rawdata = exp['resources'].setdefault('RawData', [])
+        for it, t in enumerate(tracers):
+            stime = self.tracer_times.get(t, '1%02d000.000000' % it)
+            for fixture, uid in [('norm.dcm', '%d%02d1' % (self.__count_experiments, it)),
+                                 ('listmode.dcm', '%d%02d2' % (self.__count_experiments, it))]:
+                name = '1.3.12.2.1107.5.2.38.51010.300000%s' % uid
+                self.__write_rawdata_dcm(os.path.join(edir, 'RESOURCES', 'RawData', name + '.dcm'),
+                                         os.path.join(FIXTURES, fixture), t, date, stime)
+                self.__write_bytes(os.path.join(edir, 'RESOURCES', 'RawData', name + '.bf'), bf_size)
+                rawdata += [name + '.dcm', name + '.bf']
+
+        alabel = '%s_freesurfer_%s120000' % (eid, date)
+        afiles = []
+        for f in ['mri/T1.mgz', 'mri/brain.mgz', 'mri/aparc+aseg.mgz',
+                  'surf/lh.white', 'surf/rh.white', 'label/lh.cortex.label', 'stats/aseg.stats',
+                  'scripts/recon-all.log']:
+            rel = os.path.join(elabel, f)
+            self.__write_bytes(os.path.join(edir, 'ASSESSORS', alabel, 'DATA', rel), fs_size)
+            afiles.append(rel)
+        exp['assessors'][alabel] = {'ID': alabel, 'label': alabel, 'resources': {'DATA': afiles}}
+        return exp
+
+    def __seed_scan(self, exp, scanid, desc, modality, fixtures):
+        from pydicom import dcmread
+        from pydicom.uid import generate_uid
+        sdir = os.path.join(exp['dir'], 'SCANS', scanid, 'DICOM')
+        self.__ensuredir(sdir)
+        series_uid = generate_uid()
+        names = []
+        for i, f in enumerate(fixtures):
+            ds = dcmread(os.path.join(FIXTURES, 'umap', f))
+            ds.SeriesDescription = desc
+            ds.Modality = modality
+            ds.SeriesNumber = scanid
+            ds.SeriesInstanceUID = series_uid
+            ds.SOPInstanceUID = generate_uid()
+            ds.SeriesDate = exp['date']
+            name = '%s.MR.CCIR-00754.%s.%d.%s.%s.dcm' % (exp['label'], scanid, i + 1, exp['date'], exp['ID'])
+            ds.save_as(os.path.join(sdir, name))
+            names.append(name)
+        xsitype = 'xnat:scScanData' if modality == 'SC' else 'xnat:mrScanData'
+        exp['scans'][scanid] = {'ID': scanid, 'type': desc, 'series_description': desc, 'xsiType': xsitype,
+                                'resources': {'DICOM': names}}
+
+    def __write_rawdata_dcm(self, fn, fixture, tracer, date, stime):
+        from io import BytesIO
+        from pydicom import dcmread
+        ds = dcmread(fixture)
+        ds.StudyDate = date
+        ds.SeriesDate = date
+        ds.SeriesTime = stime
+        bio = BytesIO()
+        ds.save_as(bio)
+        content = bio.getvalue()
+        # same-length substitution keeps element lengths of CSA and interfile headers valid
+        tra = tracer.encode('ascii')[:18]
+        content = content.replace(b'Fluorodeoxyglucose', tra + b' ' * (18 - len(tra)))
+        self.__ensuredir(os.path.dirname(fn))
+        with open(fn, 'wb') as f:
+            f.write(content)
+
+    def __write_bytes(self, fn, size):
+        self.__ensuredir(os.path.dirname(fn))
+        block = os.urandom(min(size, self.chunk_size))
+        with open(fn, 'wb') as f:
+            remaining = size
+            while remaining > 0:
+                f.write(block[:remaining])
+                remaining -= len(block)
+
+    def __ensuredir(self, d):
+        if not os.path.exists(d):
+            os.makedirs(d)
+
+
+
+    # CONTAINER SERVICE #########################################################################
+
+    def add_wrapper(self, name, wrapper_id, root_element_name, xsi_type, enabled=True):
+        """
+        adds a command wrapper to /xapi/commands/available
+        """
+        self.wrappers.append({'wrapper-name': name, 'wrapper-id': wrapper_id, 'command-id': wrapper_id,
+                              'root-element-name': root_element_name, 'xsiType': xsi_type, 'enabled': enabled})
+
+    def bulklaunch(self, prj, wrapper_id, params):
+        """
+        launches containers, except for params listed in self.launch_failures, which fail that many times
+        :param prj:
+        :param wrapper_id:
+        :param params is a list of dicts keyed by the root element name:
+        :return launch report as XNAT's container service:
+        """
+        successes = []
+        failures = []
+        with self.__lock:
+            self.launch_sizes.append(len(params))
+            for p in params:
+                key = list(p.values())[0]
+                if self.launch_failures.get(key, 0) > 0:
+                    self.launch_failures[key] -= 1
+                    failures.append({'status': 'failure', 'params': p, 'message': 'fake launch failure'})
+                    continue
+                cid = 'fake%04d' % (len(self.containers) + 1)
+                self.containers[cid] = {'id': len(self.containers) + 1, 'container-id': cid, 'project': prj,
+                                        'wrapper-id': wrapper_id, 'params': p, 'created': time.time(),
+                                        'fails': key in self.failing_containers}
+                successes.append({'status': 'success', 'params': p, 'container-id': cid})
+            self.max_running = max(self.max_running, self.__running())
+        return {'successes': successes, 'failures': failures}
+
+    def container(self, cid):
+        """
+        :return container as XNAT's container service, with status Running until container_secs have elapsed:
+        """
+        c = self.containers[cid]
+        status = 'Running'
+        if time.time() - c['created'] >= self.container_secs:
+            status = 'Failed' if c['fails'] else 'Complete'
+        return dict([(k, v) for k, v in c.items() if k not in ('created', 'fails')] + [('status', status)])
+
+    def __running(self):
+        return len([c for c in self.containers if self.container(c)['status'] == 'Running'])
+
+
+
+    # STATISTICS #########################################################################
+
+    def count(self, kind, nbytes=0):
+        with self.__lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            self.bytes_served += nbytes
+
+    def add_bytes(self, nbytes):
+        with self.__lock:
+            self.bytes_served += nbytes
+
+    def reset_counts(self):
+        with self.__lock:
+            self.requests = {}
+            self.bytes_served = 0
+
+    def report(self):
+        return {'requests': dict(self.requests),
+                'requests_total': sum(self.requests.values()),
+                'bytes_served': self.bytes_served}
+
+
+
+    # SERVER #########################################################################
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.server.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.server.stopped = True
+        self.server.shutdown()
+        self.server.server_close()
+
+    def cleanup(self):
+        shutil.rmtree(self.rootdir, ignore_errors=True)
+
+    def find_experiment(self, eid):
+        for prj, subjects in self.projects.items():
+            for sid, sbj in subjects.items():
+                for e, exp in sbj['experiments'].items():
+                    if eid in (e, exp['label']):
+                        return exp
+        return None
+
+    def find_subject(self, prj, sid):
+        for s, sbj in self.projects.get(prj, {}).items():
+            if sid in (s, sbj['label']):
+                return s, sbj
+        return None, None
+
+    def absolute_path(self, fn):
+        return '/data/CNDA/archive/' + os.path.relpath(fn, self.dir_archive)
+
+    def __init__(self, rootdir=None, host='127.0.0.1', port=0):
+        """
+        :param rootdir for the fake archive; default is a new temporary directory:
+        :param host:
+        :param port; 0 selects any free port:
+        """
+        import tempfile
+        self.rootdir = rootdir if rootdir else tempfile.mkdtemp(prefix='fakexnat_')
+        self.projects = OrderedDict()
+        self.requests = {}
+        self.bytes_served = 0
+        self.wrappers = []
+        self.containers = OrderedDict()
+        self.launch_failures = {} # root element value -> number of launches to fail
+        self.failing_containers = set() # root element values of containers ending as Failed
+        self.launch_sizes = []
+        self.max_running = 0
+        self.__count_experiments = 0
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.server = _ThreadingHTTPServer((host, port), _FakeXnatHandler)
+        self.server.fake = self
+
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    stopped = False
+
+    def handle_error(self, request, client_address):
+        """keep-alive connections of clients may outlive FakeXnat.stop()"""
+        if not self.stopped:
+            HTTPServer.handle_error(self, request, client_address)
+
+
+
+class _FakeXnatHandler(BaseHTTPRequestHandler):
+    """Routes /data (and legacy /REST) URIs onto FakeXnat.projects."""
+
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def log_message(self, format, *args):
+        return
+
+    def do_GET(self):
+        self.__dispatch('GET')
+
+    def do_HEAD(self):
+        self.__dispatch('HEAD')
+
+    def do_POST(self):
+        self.__dispatch('POST')
+
+    def do_PUT(self):
+        self.__dispatch('PUT')
+
+    def do_DELETE(self):
+        self.__dispatch('DELETE')
+
+    def __dispatch(self, method):
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else b''
+        u = urlparse(self.path)
+        self.query = dict((k, v[-1]) for k, v in parse_qs(u.query).items())
+        segs = [unquote(s) for s in u.path.split('/') if s]
+        if not segs or segs[0] not in ('data', 'REST', 'xapi'):
+            return self.__send_error(404)
+        if any(f in u.path for f in self.fake.failing):
+            return self.__send_error(500)
+        try:
+            if segs[0] == 'xapi':
+                return self.__route_xapi(method, segs[1:])
+            return self.__route_data(method, segs[1:])
+        except KeyError:
+            return self.__send_error(404)
+
+    def __route_xapi(self, method, segs):
+        if segs == ['commands', 'available'] and method == 'GET':
+            self.fake.count('commands')
+            xsi = self.query.get('xsiType')
+            return self.__send_json([w for w in self.fake.wrappers if not xsi or w['xsiType'] == xsi])
+        if len(segs) == 5 and segs[0] == 'projects' and segs[2] == 'wrappers' and segs[4] == 'bulklaunch' \
+                and method == 'POST':
+            self.fake.count('launch')
+            return self.__send_json(self.fake.bulklaunch(segs[1], int(segs[3]), json.loads(self.body)))
+        if len(segs) == 2 and segs[0] == 'containers' and method == 'GET':
+            self.fake.count('container')
+            return self.__send_json(self.fake.container(segs[1]))
+        return self.__send_error(404)
+
+    def __route_data(self, method, segs):
+        if segs == ['JSESSION']:
+            self.fake.count('jsession')
+            if method == 'DELETE':
+                return self.__send_text('')
+            return self.__send_text(self.fake.jsessionid)
+        if method not in ('GET', 'HEAD') and not (method in ('PUT', 'DELETE') and 'resources' in segs):
+            return self.__send_error(405)
+        if segs[0] == 'projects':
+            return self.__route_projects(segs[1:])
+        if segs[0] in ('experiments', 'experiments_list') and len(segs) > 1:
+            return self.__route_experiment(self.fake.find_experiment(segs[1]), segs[2:])
+        return self.__send_error(404)
+
+    def __route_projects(self, segs):
+        projects = self.fake.projects
+        if not segs:
+            return self.__send_table([{'ID': p, 'secondary_ID': p, 'name': p, 'URI': '/data/projects/' + p}
+                                      for p in projects])
+        prj = segs[0]
+        subjects = projects[prj]
+        if len(segs) == 1:
+            return self.__send_object({'ID': prj, 'label': prj})
+        if segs[1] == 'experiments':
+            if len(segs) == 2:
+                return self.__send_table(self.__experiment_rows(prj))
+            return self.__route_experiment(self.fake.find_experiment(segs[2]), segs[3:])
+        if segs[1] != 'subjects':
+            return self.__send_error(404)
+        if len(segs) == 2:
+            return self.__send_table([{'ID': s, 'label': sbj['label'], 'project': prj,
+                                       'URI': '/data/subjects/' + s} for s, sbj in subjects.items()])
+        sid, sbj = self.fake.find_subject(prj, segs[2])
+        if not sbj:
+            return self.__send_error(404)
+        if len(segs) == 3:
+            return self.__send_object({'ID': sid, 'label': sbj['label'], 'project': prj})
+        if segs[3] != 'experiments':
+            return self.__send_error(404)
+        if len(segs) == 4:
+            return self.__send_table(self.__experiment_rows(prj, sid))
+        return self.__route_experiment(self.fake.find_experiment(segs[4]), segs[5:])
+
+    def __experiment_rows(self, prj, sid=None):
+        rows = []
+        for s, sbj in self.fake.projects[prj].items():
+            if sid and s != sid:
+                continue
+            for eid, exp in sbj['experiments'].items():
+                rows.append({'ID': eid, 'label': exp['label'], 'project': prj, 'date': exp['date'],
+                             'xsiType': 'xnat:petSessionData', 'URI': '/data/experiments/' + eid})
+        return rows
+
+    def __route_experiment(self, exp, segs):
+        if not exp:
+            return self.__send_error(404)
+        base = '/data/experiments/' + exp['ID']
+        if not segs:
+            return self.__send_object({'ID': exp['ID'], 'label': exp['label'], 'project': exp['project']})
+        if segs[0] == 'scans':
+            if len(segs) == 1:
+                return self.__send_table(
+                    [dict((k, v) for k, v in s.items() if k != 'resources') for s in exp['scans'].values()],
+                    uri=base + '/scans/%(ID)s')
+            scan = exp['scans'][segs[1]]
+            if len(segs) == 2:
+                return self.__send_object({'ID': scan['ID'], 'type': scan['type']})
+            return self.__route_resources(scan['resources'], segs[2:],
+                                          os.path.join(exp['dir'], 'SCANS', scan['ID']),
+                                          base + '/scans/' + scan['ID'])
+        if segs[0] == 'resources':
+            return self.__route_resources(exp['resources'], segs, os.path.join(exp['dir'], 'RESOURCES'), base)
+        if segs[0] == 'assessors':
+            return self.__route_assessors(exp, segs[1:], base + '/assessors')
+        return self.__send_error(404)
+
+    def __route_assessors(self, exp, segs, base):
+        if not segs:
+            return self.__send_table([{'ID': a['ID'], 'label': a['label'], 'xsiType': 'fs:fsData',
+                                       'URI': base + '/' + a['ID']} for a in exp['assessors'].values()])
+        if segs[0] == 'ALL' and segs[1:] == ['files'] and self.query.get('format') == 'zip':
+            return self.__send_file(self.__assessors_zip(exp), kind='zip')
+        assessor = exp['assessors'][segs[0]]
+        if len(segs) == 1:
+            return self.__send_object({'ID': assessor['ID'], 'label': assessor['label']})
+        rest = segs[1:]
+        if rest[0] == 'out':
+            rest = rest[1:]
+        return self.__route_resources(assessor['resources'], rest,
+                                      os.path.join(exp['dir'], 'ASSESSORS', assessor['ID']),
+                                      base + '/' + assessor['ID'] + '/out')
+
+    def __route_resources(self, resources, segs, rdir, base):
+        """files of resources are kept in <rdir>/<label>/<name>, as XNAT does for scans:  SCANS/<id>/DICOM/<name>"""
+        if segs[0] != 'resources':
+            return self.__send_error(404)
+        if len(segs) == 1:
+            return self.__send_table([{'xnat_abstractresource_id': str(i + 1), 'label': label, 'format': label,
+                                       'file_count': str(len(fs)),
+                                       'file_size': str(sum(os.path.getsize(os.path.join(rdir, label, n))
+                                                            for n in fs)),
+                                       'URI': base + '/resources/' + label}
+                                      for i, (label, fs) in enumerate(resources.items())])
+        label = segs[1]
+        if self.command == 'PUT' and len(segs) > 3 and segs[2] == 'files':
+            return self.__put_file(resources, label, os.path.join(rdir, label), '/'.join(segs[3:]))
+        if label not in resources and label.isdigit():
+            label = list(resources)[int(label) - 1] # xnat_abstractresource_id
+        names = resources[label]
+        if self.command == 'DELETE' and len(segs) == 2:
+            shutil.rmtree(os.path.join(rdir, label), ignore_errors=True)
+            del resources[label]
+            return self.__send_text('')
+        if len(segs) == 2:
+            return self.__send_object({'label': label, 'file_count': len(names)})
+        if segs[2] != 'files':
+            return self.__send_error(404)
+        fdir = os.path.join(rdir, label)
+        if len(segs) == 3:
+            rows = []
+            for n in names:
+                fn = os.path.join(fdir, n)
+                row = {'Name': os.path.basename(n), 'Size': str(os.path.getsize(fn)), 'collection': label,
+                       'file_tags': '', 'file_format': '', 'file_content': '',
+                       'URI': base + '/resources/' + label + '/files/' + n,
+                       'cat_ID': label}
+                if self.query.get('locator') == 'absolutePath':
+                    row['absolutePath'] = self.fake.absolute_path(fn)
+                rows.append(row)
+            return self.__send_table(rows, uri=None)
+        name = '/'.join(segs[3:])
+        if name not in names:
+            return self.__send_error(404)
+        return self.__send_file(os.path.join(fdir, name))
+
+    def __put_file(self, resources, label, fdir, name):
+        """stores the body, or the file of a multipart body, creating the resource as needed"""
+        import cgi
+        from io import BytesIO
+        content = self.body
+        ctype = self.headers.get('Content-Type') or ''
+        if ctype.startswith('multipart/form-data'):
+            form = cgi.FieldStorage(fp=BytesIO(self.body), headers=self.headers,
+                                    environ={'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': ctype})
+            content = form['file'].value
+        self.fake.count('upload')
+        fn = os.path.join(fdir, name)
+        if not os.path.isdir(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        with open(fn, 'wb') as f:
+            f.write(content)
+        names = resources.setdefault(label, [])
+        if name not in names:
+            names.append(name)
+        return self.__send_text('', status=200)
+
+    def __assessors_zip(self, exp):
+        from zipfile import ZipFile, ZIP_STORED
+        z = os.path.join(exp['dir'], 'assessors_ALL_files.zip')
+        if os.path.exists(z):
+            return z
+        with ZipFile(z, 'w', ZIP_STORED) as zf:
+            for a in exp['assessors'].values():
+                for label, names in a['resources'].items():
+                    for n in names:
+                        zf.write(os.path.join(exp['dir'], 'ASSESSORS', a['ID'], label, n),
+                                 '/'.join([a['label'], 'out', 'resources', label, 'files', n]))
+        return z
+
+
+
+    # RESPONSES #########################################################################
+
+    def __send_text(self, text, status=200, content_type='text/plain'):
+        body = text.encode('utf-8') if not isinstance(text, bytes) else text
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def __send_error(self, status):
+        self.__send_text('', status=status)
+
+    def __send_json(self, obj):
+        self.__send_text(json.dumps(obj), content_type='application/json')
+
+    def __send_object(self, obj):
+        self.fake.count('object')
+        self.__send_table([obj], uri=None, count=False)
+
+    def __send_table(self, rows, uri=None, count=True):
+        """
+        :param rows are dicts, written as json or as csv according to the format query:
+        :param uri is a template for a URI column:
+        """
+        if count:
+            self.fake.count('listing')
+        if uri:
+            rows = [dict(r, URI=uri % r) for r in rows]
+        if self.query.get('format') == 'csv':
+            columns = []
+            for r in rows:
+                columns += [k for k in r if k not in columns]
+            sio = StringIO()
+            w = csv.writer(sio)
+            w.writerow(columns)
+            for r in rows:
+                w.writerow([r.get(c, '') for c in columns])
+            return self.__send_text(sio.getvalue(), content_type='text/csv')
+        return self.__send_text(
+            json.dumps({'ResultSet': {'Result': rows, 'totalRecords': str(len(rows))}}),
+            content_type='application/json')
+
+    def __send_file(self, fn, kind='file'):
+        size = os.path.getsize(fn)
+        start, stop = 0, size - 1
+        rng = self.headers.get('Range')
+        status = 200
+        if rng and rng.startswith('bytes='):
+            first, last = rng[len('bytes='):].split(',')[0].split('-')
+            if first:
+                start = int(first)
+                stop = min(int(last), size - 1) if last else size - 1
+            else:
+                start = max(size - int(last), 0)
+            status = 206
+        nbytes = stop - start + 1
+        self.fake.count(kind)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(nbytes))
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, stop, size))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        with open(fn, 'rb') as f:
+            f.seek(start)
+            remaining = nbytes
+            while remaining > 0:
+                block = f.read(min(self.fake.chunk_size, remaining))
+                if not block:
+                    break
+                self.wfile.write(block)
+                remaining -= len(block)
+                self.fake.add_bytes(len(block))
+                if self.fake.bandwidth:
+                    time.sleep(float(len(block)) / self.fake.bandwidth)
@@ -0,0 +1,85 @@
+import unittest
+import os
+import time
+from xnatpet.cachemanager import CacheManager
+
+class TestCacheManager(unittest.TestCase):
+    """evicts folders of a synthetic cachedir to fit a quota"""
+
+    def setUp(self):
+        import tempfile
+        self._cachedir = tempfile.mkdtemp()
+        self.cm = CacheManager(self._cachedir)
+        self.done = self._folder('ses-E1', 'FDG_DT20180101120000.000000-Converted-NAC', 1000, finished=True)
+        self.done_umaps = self._folder('ses-E1', 'umaps', 100)
+        self.pending = self._folder('ses-E2', 'FDG_DT20180202120000.000000-Converted-NAC', 1000)
+        self.pending_umaps = self._folder('ses-E2', 'umaps', 100)
+        self.newer = self._folder('ses-E3', 'FDG_DT20180303120000.000000-Converted-NAC', 1000, finished=True)
+        now = time.time()
+        for i, f in enumerate([self.done, self.done_umaps, self.pending, self.pending_umaps, self.newer]):
+            os.utime(f, (now - 3600 + i, now - 3600 + i))
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self._cachedir, ignore_errors=True)
+
+    def _folder(self, ses, folder, nbytes, finished=False):
+        path = os.path.join(self._cachedir, 'CCIR_00754', ses, folder)
+        os.makedirs(path)
+        with open(os.path.join(path, 'data.bf'), 'wb') as f:
+            f.write(b'\0' * nbytes)
+        if finished:
+            os.makedirs(os.path.join(path, 'output', 'PET'))
+            open(os.path.join(path, self.cm.finished), 'w').close()
+        return path
+
+    def test_folders(self):
+        flds = dict((os.path.relpath(f['path'], self._cachedir), f) for f in self.cm.folders())
+        self.assertEqual(5, len(flds))
+        pinned = sorted(k for k, f in flds.items() if f['pinned'])
+        self.assertEqual([os.path.relpath(self.pending, self._cachedir),
+                          os.path.relpath(self.pending_umaps, self._cachedir)], pinned)
+        self.assertEqual(1100, self.cm.sessions()['CCIR_00754/ses-E2']['pinned_bytes'])
+        self.assertEqual(3200, self.cm.usage())
+
+    def test_ensure_space(self):
+        self.cm.quota = 3200 + 500
+        self.assertTrue(self.cm.ensure_space(500))
+        self.assertEqual([], self.cm.evicted)
+
+        self.assertTrue(self.cm.ensure_space(1600))
+        self.assertEqual([self.done, self.done_umaps], self.cm.evicted)
+        self.assertFalse(os.path.exists(os.path.dirname(self.done)))
+
+        self.cm.touch(self.pending)
+        self.cm.pin(self.newer)
+        self.assertFalse(self.cm.ensure_space(10000))
+        self.assertTrue(os.path.exists(self.newer))
+        self.assertTrue(os.path.exists(self.pending))
+        self.cm.unpin(self.newer)
+        self.assertTrue(self.cm.ensure_space(2600))
+        self.assertFalse(os.path.exists(self.newer))
+
+    def test_ensure_space_keep(self):
+        self.cm.quota = 3200 + 500
+        ses = os.path.dirname(self.done)
+        self.assertFalse(self.cm.ensure_space(1600, keep=ses))
+        self.assertTrue(os.path.exists(self.done))
+        self.assertTrue(os.path.exists(self.done_umaps))
+        self.assertTrue(self.cm.ensure_space(1000, keep=ses))
+        self.assertEqual([self.newer], self.cm.evicted)
+
+    def test_ensure_space_hardlinks(self):
+        from xnatpet.objectstore import ObjectStore
+        store = ObjectStore(self._cachedir)
+        for d in (self.done, self.pending):
+            tmp = os.path.join(self._cachedir, 'shared.tmp')
+            with open(tmp, 'wb') as f:
+                f.write(b'\1' * 2000)
+            store.put(tmp, os.path.join(d, 'shared.bf'))
+            os.utime(d, (time.time() - 7200, time.time() - 7200) if d == self.done else None)
+        self.assertEqual(5200, self.cm.usage())
+        self.cm.free_bytes = lambda: 6000 - self.cm.usage()
+        self.assertTrue(self.cm.ensure_space(2500)) # evicting done frees 1000, as pending still links shared.bf
+        self.assertEqual([self.done, self.done_umaps, self.newer], self.cm.evicted)
+        self.assertEqual(2900, self.cm.free_bytes())
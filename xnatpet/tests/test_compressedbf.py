@@ -0,0 +1,71 @@
+import unittest
+import os
+import numpy as np
+from xnatpet.compressedbf import CompressedBf, folder_report, raw_size, bf_path
+from xnatpet.listmode import Listmode
+from xnatpet.tests.fakexnat import write_listmode
+
+class TestCompressedBf(unittest.TestCase):
+    """stores synthetic PETLINK listmode as .bfz in small chunks"""
+
+    def setUp(self):
+        import tempfile
+        self._tmpdir = tempfile.mkdtemp()
+        self.bf = os.path.join(self._tmpdir, 'LM', 'listmode.bf')
+        os.makedirs(os.path.dirname(self.bf))
+        write_listmode(self.bf, np.full(20, 500), np.full(20, 50))
+        with open(self.bf, 'rb') as f:
+            self.raw = f.read()
+        self.chunk_bytes = CompressedBf.chunk_bytes
+        CompressedBf.chunk_bytes = 4 * 10001
+
+    def tearDown(self):
+        import shutil
+        CompressedBf.chunk_bytes = self.chunk_bytes
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def test_roundtrip(self):
+        c = CompressedBf.compress(self.bf, remove=True)
+        self.assertFalse(os.path.exists(self.bf))
+        self.assertEqual(c.path, bf_path(self.bf))
+        self.assertEqual(len(self.raw), raw_size(self.bf))
+        self.assertEqual((len(self.raw) + c.chunk_bytes - 1) // c.chunk_bytes, len(c.index))
+        self.assertGreater(c.ratio, 1)
+        self.assertEqual(self.raw[12345:98765], c.read(12345, 98765 - 12345))
+        self.assertEqual(self.raw[-7:], c.read(len(self.raw) - 7, 100))
+        self.assertEqual(self.bf, c.decompress())
+        with open(self.bf, 'rb') as f:
+            self.assertEqual(self.raw, f.read())
+
+    def test_unshuffled(self):
+        CompressedBf.shuffle = False
+        try:
+            c = CompressedBf.compress(self.bf, dest=os.path.join(self._tmpdir, 'plain.bfz'))
+        finally:
+            CompressedBf.shuffle = True
+        self.assertFalse(c.shuffled)
+        self.assertEqual(self.raw, b''.join(c.chunks()))
+
+    def test_listmode(self):
+        expected = Listmode(self.bf).count_rates()
+        CompressedBf.compress(self.bf, remove=True)
+        lm = Listmode(self.bf)
+        self.assertIsNotNone(lm.compressed)
+        cr = lm.count_rates()
+        self.assertTrue(np.array_equal(expected.prompts, cr.prompts))
+        self.assertEqual((expected.words, expected.last_ms), (cr.words, cr.last_ms))
+        self.assertFalse(lm.truncated)
+        bf, n = lm.extract(os.path.join(self._tmpdir, 'window.bf'), 5, 10)
+        self.assertEqual(5 * 500, Listmode(bf).count_rates().prompts.sum())
+
+    def test_folder_report(self):
+        CompressedBf.compress(self.bf)
+        rep = folder_report(self._tmpdir)
+        self.assertEqual(1, len(rep['files']))
+        self.assertEqual(len(self.raw), rep['raw_bytes'])
+        self.assertGreater(rep['ratio'], 1)
+        self.assertGreater(rep['decode_MBps'], 0)
+        with open(os.path.join(self._tmpdir, 'bad.bfz'), 'wb') as f:
+            f.write(b'\0' * 64)
+        with self.assertRaises(AssertionError):
+            CompressedBf(os.path.join(self._tmpdir, 'bad.bfz'))
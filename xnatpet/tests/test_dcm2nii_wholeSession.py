@@ -0,0 +1,166 @@
+import unittest
+import os
+import dcm2nii_wholeSession
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tests')
+
+def fake_converter(sourceNames, outputDir, makenii, gzip):
+    fn = os.path.join(outputDir, 'scan_%d.nii' % len(sourceNames))
+    with open(fn, 'wb') as f:
+        for s in sourceNames:
+            f.write(os.path.basename(s).encode('ascii'))
+    return [fn]
+
+class TestSessionPipeline(unittest.TestCase):
+    """converts and uploads scans of a session from xnatpet.tests.fakexnat; needs no credentials"""
+
+    def setUp(self):
+        import tempfile
+        from xnatpet.tests.fakexnat import FakeXnat
+        self._tmpdir = tempfile.mkdtemp()
+        self.fake = FakeXnat()
+        self.eid = self.fake.seed(nsubjects=1, nsessions=1, nslices=4, bf_size=1024, fs_size=1024)[0]
+        self.fake.start()
+        self.dicomdir = os.path.join(self._tmpdir, 'dicom')
+        self.niftidir = os.path.join(self._tmpdir, 'nifti')
+        os.mkdir(self.dicomdir)
+        os.mkdir(self.niftidir)
+
+    def tearDown(self):
+        import shutil
+        self.fake.stop()
+        self.fake.cleanup()
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def _pipeline(self, overwrite=False):
+        return dcm2nii_wholeSession.SessionPipeline(
+            self.fake.url, self.eid, self.dicomdir, self.niftidir, {'Cookie': 'JSESSIONID=' + self.fake.jsessionid},
+            overwrite=overwrite, converter=fake_converter, nworkers=(2, 2, 2))
+
+    def test_run(self):
+        timing = self._pipeline().run()
+        self.assertEqual(['1', '2', '3', '4'], sorted(timing))
+        self.assertEqual(['uploaded', 'uploaded', 'uploaded', 'skipped'], [timing[s]['status'] for s in '1234'])
+        self.assertGreater(timing['3']['bytes'], 0)
+        exp = self.fake.find_experiment(self.eid)
+        self.assertEqual(['scan_4.nii'], exp['scans']['3']['resources']['NIFTI'])
+        self.assertNotIn('NIFTI', exp['scans']['4']['resources'])
+        self.assertEqual(3, self.fake.requests['upload'])
+
+        timing = self._pipeline().run()
+        self.assertEqual(['skipped'] * 4, [timing[s]['status'] for s in '1234'])
+        timing = self._pipeline(overwrite=True).run()
+        self.assertEqual(['uploaded', 'uploaded', 'uploaded', 'skipped'], [timing[s]['status'] for s in '1234'])
+        self.assertEqual(6, self.fake.requests['upload'])
+
+    def test_probe_modality(self):
+        exp = self.fake.find_experiment(self.eid)
+        sc = sum(os.path.getsize(os.path.join(exp['dir'], 'SCANS', '4', 'DICOM', n))
+                 for n in exp['scans']['4']['resources']['DICOM'])
+        pipeline = self._pipeline()
+        timing = pipeline.run()
+        self.assertEqual('skipped', timing['4']['status'])
+        self.assertEqual(sc, timing['4']['avoided'])
+        self.assertEqual(sc, pipeline.bytes_avoided)
+        self.assertFalse(os.path.exists(os.path.join(self.dicomdir, '4')))
+
+        # without xsiType in the scan listing, only the leading bytes of one DICOM are read
+        del exp['scans']['4']['xsiType']
+        self.fake.reset_counts()
+        timing = self._pipeline(overwrite=True).run(['4'])
+        self.assertEqual('skipped', timing['4']['status'])
+        self.assertEqual(1, self.fake.requests['file'])
+        self.assertEqual(sc, timing['4']['avoided'] + timing['4']['bytes'])
+        self.assertLess(self.fake.bytes_served, sc)
+
+    def test_probe_unknown_size(self):
+        umap = os.path.join(FIXTURES, 'umap')
+        dcm = os.path.join(umap, sorted(os.listdir(umap))[0])
+        pipeline = self._pipeline()
+        pipeline.probe_bytes = 16 # within the preamble
+        self.assertEqual(('MR', 0), pipeline.probe_modality({'URI': '', 'absolutePath': dcm, 'Size': 0}))
+        self.assertEqual((None, 0), pipeline.probe_modality({'URI': '', 'absolutePath': dcm, 'Size': 16}))
+
+    def test_native_converter(self):
+        pipeline = dcm2nii_wholeSession.SessionPipeline(
+            self.fake.url, self.eid, self.dicomdir, self.niftidir, {'Cookie': 'JSESSIONID=' + self.fake.jsessionid},
+            converter=dcm2nii_wholeSession.dcm2niiNative, makenii=True, gzip=True, nworkers=(2, 2, 2))
+        timing = pipeline.run()
+        self.assertEqual(['uploaded', 'uploaded', 'uploaded', 'skipped'], [timing[s]['status'] for s in '1234'])
+        exp = self.fake.find_experiment(self.eid)
+        self.assertEqual(['Head_MRAC_Brain_HiRes_in_UMAP_3.nii.gz'], exp['scans']['3']['resources']['NIFTI'])
+
+class TestNativeConverter(unittest.TestCase):
+    """converts the first 12 instances of tests/umap in-process and reads the NIfTI-1 back"""
+
+    def setUp(self):
+        import tempfile
+        self._tmpdir = tempfile.mkdtemp()
+        umap = os.path.join(FIXTURES, 'umap')
+        names = sorted((f for f in os.listdir(umap) if f.endswith('.dcm')), key=lambda f: int(f.split('.')[4]))[:12]
+        self.sources = [os.path.join(umap, f) for f in names]
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def _read(self, fn):
+        import gzip
+        import struct
+        import numpy as np
+        with (gzip.open if fn.endswith('.gz') else open)(fn, 'rb') as f:
+            data = f.read()
+        h = struct.unpack(dcm2nii_wholeSession.NIFTI_HEADER, data[:348])
+        dim = h[7:15]
+        datatype, vox_offset = h[19], int(h[30])
+        srow = np.array(h[-14:-2]).reshape(3, 4)
+        dtype = dict((v[0], k) for k, v in dcm2nii_wholeSession.NIFTI_DATATYPES.items())[datatype]
+        vol = np.frombuffer(data[vox_offset:], dtype=dtype).reshape(dim[1:dim[0] + 1], order='F')
+        return h, vol, srow
+
+    def test_nii_gz(self):
+        import numpy as np
+        from pydicom import dcmread
+        outfiles = dcm2nii_wholeSession.dcm2niiNative(self.sources, self._tmpdir, True, True)
+        self.assertEqual([os.path.join(self._tmpdir, 'Head_MRAC_Brain_HiRes_in_UMAP_84.nii.gz')], outfiles)
+        h, vol, srow = self._read(outfiles[0])
+        self.assertEqual(348, h[0])
+        self.assertEqual(b'n+1\0', h[-1])
+        self.assertEqual((240, 126, 12), vol.shape)
+        ds = sorted((dcmread(s) for s in self.sources), key=lambda d: float(d.ImagePositionPatient[1]))
+        for k, d in enumerate(ds):
+            np.testing.assert_array_equal(d.pixel_array.T, vol[:, :, k])
+            ipp = np.array([float(x) for x in d.ImagePositionPatient]) * [-1, -1, 1]
+            np.testing.assert_allclose(ipp, srow.dot([0, 0, k, 1]), atol=1e-3)
+
+    def test_hdr_img(self):
+        outfiles = dcm2nii_wholeSession.dcm2niiNative(self.sources, self._tmpdir, False, False)
+        self.assertEqual(['.hdr', '.img'], [os.path.splitext(f)[1] for f in outfiles])
+        self.assertEqual(348, os.path.getsize(outfiles[0]))
+        self.assertEqual(240 * 126 * 12 * 2, os.path.getsize(outfiles[1]))
+
+    def test_frames(self):
+        from pydicom import dcmread
+        sources = []
+        for t in range(2):
+            for i, s in enumerate(self.sources[:3]):
+                d = dcmread(s)
+                d.InstanceNumber = str(100 * t + i)
+                d.RescaleSlope = str(t + 1)
+                sources.append(os.path.join(self._tmpdir, '%d_%d.dcm' % (t, i)))
+                d.save_as(sources[-1])
+        outfiles = dcm2nii_wholeSession.dcm2niiNative(sources, self._tmpdir, True, False)
+        h, vol, srow = self._read(outfiles[0])
+        self.assertEqual((240, 126, 3, 2), vol.shape)
+        self.assertEqual(16, h[19]) # float32, as the rescale differs by frame
+        self.assertEqual(2 * vol[:, :, :, 0].sum(), vol[:, :, :, 1].sum())
+
+    def test_quaternion(self):
+        import numpy as np
+        for R in (np.eye(3), np.diag([1.0, -1, -1]), np.array([[0.0, -1, 0], [1, 0, 0], [0, 0, 1]])):
+            b, c, d = dcm2nii_wholeSession.quaternion(R)
+            a = np.sqrt(max(1 - b * b - c * c - d * d, 0))
+            Q = np.array([[a*a+b*b-c*c-d*d, 2*(b*c-a*d), 2*(b*d+a*c)],
+                          [2*(b*c+a*d), a*a+c*c-b*b-d*d, 2*(c*d-a*b)],
+                          [2*(b*d-a*c), 2*(c*d+a*b), a*a+d*d-c*c-b*b]])
+            np.testing.assert_allclose(R, Q, atol=1e-6)
@@ -0,0 +1,49 @@
+import unittest
+import os
+from xnatpet.interfilecache import InterfileCache
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tests')
+
+class TestInterfileCache(unittest.TestCase):
+    """parses tests/pet_listmode.l.hdr and tests/listmode.dcm at most once per version of each file"""
+
+    def setUp(self):
+        import tempfile
+        import shutil
+        self._tmpdir = tempfile.mkdtemp()
+        self.hdr = os.path.join(self._tmpdir, 'pet_listmode.l.hdr')
+        self.dcm = os.path.join(self._tmpdir, 'listmode.dcm')
+        shutil.copy(os.path.join(FIXTURES, 'pet_listmode.l.hdr'), self.hdr)
+        shutil.copy(os.path.join(FIXTURES, 'listmode.dcm'), self.dcm)
+        self.cache = InterfileCache(maxsize=2)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def test_get(self):
+        from interfile import Interfile
+        d = self.cache.get(self.hdr)
+        self.assertEqual(6586.2, d['isotope gamma halflife']['value'])
+        self.assertIs(d, self.cache.get(self.hdr))
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+        with self.assertRaises(Interfile.ParsingError):
+            self.cache.get(self.dcm)
+        with self.assertRaises(Interfile.ParsingError):
+            self.cache.get(self.dcm)
+        self.assertEqual((2, 2), (self.cache.hits, self.cache.misses))
+
+        st = os.stat(self.hdr)
+        os.utime(self.hdr, (st.st_atime, st.st_mtime + 10))
+        self.assertFalse(self.cache.cached(self.hdr))
+        self.cache.get(self.hdr)
+        self.assertEqual(3, self.cache.misses)
+        self.assertEqual(2, len(self.cache))
+
+    def test_headers_for(self):
+        hdrs = self.cache.headers_for([self.hdr, self.dcm, os.path.join(self._tmpdir, 'missing.hdr')])
+        self.assertEqual([self.hdr, self.dcm, os.path.join(self._tmpdir, 'missing.hdr')], list(hdrs))
+        self.assertEqual('time', hdrs[self.hdr]['preset type']['value'])
+        self.assertIsNone(hdrs[self.dcm])
+        self.assertIsNone(hdrs[os.path.join(self._tmpdir, 'missing.hdr')])
@@ -0,0 +1,96 @@
+import unittest
+import os
+import numpy as np
+from xnatpet.listmode import Listmode
+from xnatpet.petlink import PetlinkHeader
+from xnatpet.tests.fakexnat import write_listmode
+
+class TestListmode(unittest.TestCase):
+    """decodes synthetic PETLINK 32-bit listmode streams"""
+
+    def setUp(self):
+        import tempfile
+        self._tmpdir = tempfile.mkdtemp()
+        self.bf = os.path.join(self._tmpdir, 'listmode.bf')
+        self.prompts = [100, 200, 0, 50, 75]
+        self.delays = [10, 20, 5, 0, 7]
+        self.nwords = write_listmode(self.bf, self.prompts, self.delays, start_ms=2000)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def test_count_rates(self):
+        cr = Listmode(self.bf).count_rates()
+        self.assertEqual([0, 0] + self.prompts, list(cr.prompts))
+        self.assertEqual([0, 0] + self.delays, list(cr.delays))
+        self.assertEqual(self.nwords, cr.words)
+        self.assertEqual(5000, cr.tags)
+        self.assertEqual((2000, 6999), (cr.first_ms, cr.last_ms))
+        self.assertAlmostEqual(4.999, cr.duration)
+
+        lm = Listmode(self.bf)
+        lm.chunk_words = 777 # chunks split seconds and msec
+        self.assertTrue(np.array_equal(cr.prompts, lm.count_rates().prompts))
+        self.assertTrue(np.array_equal(cr.delays, lm.count_rates().delays))
+
+    def test_truncated(self):
+        h = PetlinkHeader.parse('%%total listmode word counts :=%d\n' % self.nwords)
+        self.assertFalse(Listmode(self.bf, header=h).truncated)
+        with open(self.bf, 'r+b') as f:
+            f.truncate(4 * (self.nwords - 1000) + 2)
+        lm = Listmode(self.bf, header=h)
+        self.assertTrue(lm.truncated)
+        self.assertEqual(self.nwords - 1000, lm.count_rates().words)
+
+    def test_empty(self):
+        open(self.bf, 'w').close()
+        cr = Listmode(self.bf).count_rates()
+        self.assertEqual((0, 0, None), (cr.words, len(cr.prompts), cr.last_ms))
+        self.assertEqual(0, cr.duration)
+
+    def test_time_index(self):
+        lm = Listmode(self.bf)
+        lm.chunk_words = 777
+        ms, offsets = lm.time_index()
+        self.assertEqual(list(range(2000, 7000, 1000)), list(ms))
+        w = lm.memmap()
+        self.assertTrue(all(w[o] == 0x80000000 | t for o, t in zip(offsets, ms)))
+        ms, offsets = lm.time_index(stop_ms=1000)
+        self.assertLess(len(ms), 5)
+
+    def test_extract(self):
+        import shutil
+        from xnatpet.petlink import PetlinkHeader
+        shutil.copy(os.path.join(os.path.dirname(__file__), '..', '..', 'tests', 'listmode.dcm'),
+                    os.path.join(self._tmpdir, 'listmode.dcm'))
+        dest = os.path.join(self._tmpdir, 'window', 'listmode.bf')
+        os.makedirs(os.path.dirname(dest))
+        lm = Listmode(self.bf)
+        lm.chunk_words = 777
+        bf, n = lm.extract(dest, 1, 3)
+        cr = Listmode(bf).count_rates()
+        self.assertEqual([0, 0, 0] + self.prompts[1:3], list(cr.prompts))
+        self.assertEqual(self.delays[1:3], list(cr.delays[3:]))
+        self.assertEqual((3000, 4999), (cr.first_ms, cr.last_ms))
+        self.assertEqual(os.path.getsize(bf) // 4, n)
+        h = PetlinkHeader.read(os.path.splitext(bf)[0] + '.dcm')
+        self.assertEqual((2, n), (h.image_duration, h.total_words))
+        self.assertFalse(Listmode(bf).truncated)
+
+        bf, n = lm.extract(dest, 3)
+        self.assertEqual(self.prompts[3:], list(Listmode(bf).count_rates().prompts[5:]))
+        self.assertEqual(2, PetlinkHeader.read(os.path.splitext(bf)[0] + '.dcm').image_duration)
+        with self.assertRaises(AssertionError):
+            lm.extract(dest, 10)
+
+    def test_extract_onto_source(self):
+        import shutil
+        dcm = os.path.join(self._tmpdir, 'listmode.dcm')
+        shutil.copy(os.path.join(os.path.dirname(__file__), '..', '..', 'tests', 'listmode.dcm'), dcm)
+        sizes = (os.path.getsize(self.bf), os.path.getsize(dcm))
+        lm = Listmode(self.bf)
+        for dest in (self.bf, os.path.join(self._tmpdir, '.', 'listmode.bf'), dcm):
+            with self.assertRaises(AssertionError):
+                lm.extract(dest, 0, 1)
+        self.assertEqual(sizes, (os.path.getsize(self.bf), os.path.getsize(dcm)))
@@ -0,0 +1,51 @@
+import unittest
+import os
+from xnatpet.objectstore import ObjectStore
+
+class TestObjectStore(unittest.TestCase):
+    """deduplicates files staged into a temporary cachedir"""
+
+    def setUp(self):
+        import tempfile
+        self._cachedir = tempfile.mkdtemp()
+        self.store = ObjectStore(self._cachedir)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self._cachedir, ignore_errors=True)
+
+    def _write(self, name, content):
+        fn = os.path.join(self._cachedir, 'downloads', name)
+        if not os.path.isdir(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        with open(fn, 'wb') as f:
+            f.write(content)
+        return fn
+
+    def test_put(self):
+        norm = os.urandom(4096)
+        a = os.path.join(self._cachedir, 'CCIR_00559', 'ses-E1', 'FDG_DT1-Converted-NAC', 'norm.bf')
+        b = os.path.join(self._cachedir, 'CCIR_00754', 'ses-E2', 'FDG_DT2-Converted-NAC', 'norm.bf')
+        c = os.path.join(self._cachedir, 'CCIR_00754', 'ses-E2', 'FDG_DT2-Converted-NAC', 'lm.bf')
+        self.assertEqual(a, self.store.put(self._write('norm.bf', norm), a))
+        self.store.put(self._write('norm.bf', norm), b)
+        self.store.put(self._write('lm.bf', os.urandom(1024)), c)
+        self.assertFalse(os.listdir(os.path.join(self._cachedir, 'downloads')))
+        self.assertTrue(os.path.samefile(a, b))
+        with open(b, 'rb') as f:
+            self.assertEqual(norm, f.read())
+        rep = self.store.report()
+        self.assertEqual(2, rep['objects'])
+        self.assertEqual(3, rep['links'])
+        self.assertEqual(4096 + 1024, rep['bytes'])
+        self.assertEqual(4096, rep['bytes_saved'])
+
+    def test_gc(self):
+        a = self.store.put(self._write('a', b'a' * 100), os.path.join(self._cachedir, 'ses-E1', 'a'))
+        b = self.store.put(self._write('b', b'b' * 10), os.path.join(self._cachedir, 'ses-E1', 'b'))
+        os.remove(a)
+        self.assertEqual((1, 100), self.store.gc(dry_run=True))
+        self.assertEqual((1, 100), self.store.gc())
+        self.assertEqual((0, 0), self.store.gc())
+        self.assertEqual(1, self.store.report()['objects'])
+        self.assertTrue(os.path.exists(b))
@@ -0,0 +1,90 @@
+import unittest
+import os
+import orchestrate
+
+class TestOrchestrate(unittest.TestCase):
+    """launches containers on the container service of xnatpet.tests.fakexnat; needs no credentials"""
+
+    def setUp(self):
+        import tempfile
+        from xnatpet.tests.fakexnat import FakeXnat
+        self._tmpdir = tempfile.mkdtemp()
+        self.fake = FakeXnat()
+        self.eids = self.fake.seed(nsubjects=1, nsessions=2, nslices=2, bf_size=1024, fs_size=1024)
+        self.eid = self.eids[0]
+        self.fake.add_wrapper('dcm2niix-scan', 3, 'scan', 'xnat:imageScanData')
+        self.fake.add_wrapper('dcm2niix-scan', 7, 'scan', 'xnat:imageScanData')
+        self.fake.add_wrapper('dcm2niix-scan', 9, 'scan', 'xnat:imageScanData', enabled=False)
+        self.fake.container_secs = 0.2
+        self.fake.start()
+        self.report = os.path.join(self._tmpdir, 'report.json')
+        self.cache = os.path.join(self._tmpdir, 'cache.json')
+
+    def tearDown(self):
+        import shutil
+        self.fake.stop()
+        self.fake.cleanup()
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def _argv(self, *opts):
+        return ['scans', self.fake.url, 'fake', 'fake', 'dcm2niix-scan', self.eid, 'CCIR_00754',
+                '--poll=0.05', '--report=' + self.report, '--cache=' + self.cache] + list(opts)
+
+    def _scan(self, scanid):
+        return '/experiments/%s/scans/%s' % (self.eid, scanid)
+
+    def test_launch(self):
+        import json
+        self.fake.launch_failures[self._scan('2')] = 1
+        self.fake.failing_containers.add(self._scan('4'))
+        report = orchestrate.main(self._argv('--chunk=2', '--max-running=2'))
+        self.assertEqual(7, report['wrapperId'])
+        self.assertEqual({'Complete': 3, 'Failed': 1}, report['counts'])
+        self.assertEqual([1, 2, 1, 1], [r['attempts'] for r in report['launches']])
+        self.assertEqual(2, self.fake.max_running)
+        self.assertTrue(all(n <= 2 for n in self.fake.launch_sizes))
+        with open(self.report) as f:
+            self.assertEqual(report['counts'], json.load(f)['counts'])
+
+    def test_retries(self):
+        self.fake.launch_failures[self._scan('1')] = 5
+        report = orchestrate.main(self._argv('--retries=2', '--no-wait'))
+        self.assertEqual(['launch failed', 'launched', 'launched', 'launched'],
+                         [r['status'] for r in report['launches']])
+        self.assertEqual(3, report['launches'][0]['attempts'])
+        self.assertEqual('fake launch failure', report['launches'][0]['message'])
+
+    def test_parents(self):
+        parents = os.path.join(self._tmpdir, 'parents.txt')
+        with open(parents, 'w') as f:
+            f.write(self.eids[1] + '\n')
+        argv = self._argv('--parents=' + parents)
+        argv[5] = self.eid + ',CNDA_E_MISSING'
+        report = orchestrate.main(argv)
+        self.assertEqual([self.eid, 'CNDA_E_MISSING', self.eids[1]], report['parents'])
+        self.assertEqual({'Complete': 8}, report['counts'])
+        self.assertEqual(1, self.fake.requests['jsession'])
+        self.assertEqual(1, self.fake.requests['commands'])
+
+        report = orchestrate.main(self._argv())
+        self.assertEqual(7, report['wrapperId'])
+        self.assertEqual(1, self.fake.requests['commands']) # cached
+        orchestrate.main(self._argv('--ttl=0'))
+        self.assertEqual(2, self.fake.requests['commands'])
+
+    def test_poll_failures(self):
+        s = orchestrate.connect(self.fake.url, 'fake', 'fake')
+        args = [{'scan': self._scan(i)} for i in '12']
+        records = orchestrate.launch(s, self.fake.url, 'CCIR_00754', 7, 'scan', args, poll=0.01, wait=False)
+        self.assertEqual(['launched', 'launched'], [r['status'] for r in records])
+        self.fake.containers.clear() # polls now fail
+        running = list(records)
+        for _ in range(2):
+            running = orchestrate.poll_containers(s, self.fake.url, running, maxFailures=3)
+        self.assertEqual(2, len(running))
+        self.assertEqual([], orchestrate.poll_containers(s, self.fake.url, running, maxFailures=3))
+        self.assertEqual(['poll failed', 'poll failed'], [r['status'] for r in records])
+
+        records[0]['status'] = 'Running'
+        self.assertEqual([], orchestrate.poll_containers(s, 'http://127.0.0.1:1', records[:1], maxFailures=1))
+        self.assertEqual('poll failed', records[0]['status'])
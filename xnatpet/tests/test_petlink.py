@@ -0,0 +1,58 @@
+import unittest
+import os
+from datetime import date, time, datetime
+from xnatpet.petlink import PetlinkHeader, interfile_blob
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tests')
+
+class TestPetlink(unittest.TestCase):
+    """reads the PETLINK interfile headers of tests/listmode.dcm, tests/norm.dcm and tests/pet_listmode.l.hdr"""
+
+    def test_listmode_dcm(self):
+        h = PetlinkHeader.read(os.path.join(FIXTURES, 'listmode.dcm'))
+        self.assertEqual('Fluorodeoxyglucose', h.tracer)
+        self.assertEqual(3599, h.image_duration)
+        self.assertEqual(date(2018, 5, 17), h.study_date)
+        self.assertEqual(datetime(2018, 5, 17, 21, 58, 19), h.study_datetime)
+        self.assertEqual(1527957817, h.total_words)
+
+    def test_norm_dcm(self):
+        h = PetlinkHeader.read(os.path.join(FIXTURES, 'norm.dcm'))
+        self.assertEqual('PHARM_TEST', h.tracer)
+        self.assertEqual(7200, h.image_duration)
+
+    def test_hdr(self):
+        h = PetlinkHeader.read(os.path.join(FIXTURES, 'pet_listmode.l.hdr'))
+        self.assertEqual(60, h.image_duration)
+        self.assertEqual(6586.2, h.halflife)
+        self.assertTrue(interfile_blob(os.path.join(FIXTURES, 'pet_listmode.l.hdr')).startswith(b'!INTERFILE'))
+
+    def test_parse(self):
+        h = PetlinkHeader.parse('!INTERFILE:=\n!study time (hh:mm:ss GMT+00:00):=09:30:00\n'
+                                '!image duration (sec):=\n%total listmode word counts:=12\n')
+        self.assertEqual(time(9, 30, 0), h.study_time)
+        self.assertIsNone(h.image_duration)
+        self.assertIsNone(h.study_datetime)
+        self.assertEqual(12, h.total_words)
+
+    def test_no_header(self):
+        import tempfile
+        with tempfile.NamedTemporaryFile(suffix='.dcm') as f:
+            f.write(b'\0' * 256)
+            f.flush()
+            with self.assertRaises(AssertionError):
+                PetlinkHeader.read(f.name)
+
+    def test_explicit_not_interfile(self):
+        import struct
+        import tempfile
+        other = b'\x29\x00\x10\x10OB\x00\x00' + struct.pack('<I', 8) + b'CSA1\0\0\0\0'
+        header = b'!INTERFILE:=\n!image duration (sec):=900\n'
+        with tempfile.NamedTemporaryFile(suffix='.dcm') as f:
+            f.write(b'\0' * 132 + other)
+            f.flush()
+            with self.assertRaises(AssertionError):
+                PetlinkHeader.read(f.name)
+            f.write(b'\x29\x00\x10\x10OB\x00\x00' + struct.pack('<I', len(header)) + header)
+            f.flush()
+            self.assertEqual(900, PetlinkHeader.read(f.name).image_duration)
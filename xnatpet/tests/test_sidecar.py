@@ -0,0 +1,53 @@
+import unittest
+import os
+from xnatpet.sidecar import Sidecar
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tests')
+
+class TestSidecar(unittest.TestCase):
+    """records tests/listmode.dcm and a synthetic .bf in the sidecar of a tracer folder"""
+
+    def setUp(self):
+        import tempfile
+        import shutil
+        self._tmpdir = tempfile.mkdtemp()
+        self.folder = os.path.join(self._tmpdir, 'FDG_DT20180517155818.000000-Converted-NAC')
+        os.makedirs(self.folder)
+        self.dcm = os.path.join(self.folder, 'listmode.dcm')
+        self.bf = os.path.join(self.folder, 'listmode.bf')
+        shutil.copy(os.path.join(FIXTURES, 'listmode.dcm'), self.dcm)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def test_update(self):
+        sc = Sidecar(self.folder)
+        self.assertEqual([], sc.update()) # no .bf yet
+        self.assertIsNone(Sidecar.find(self.dcm))
+        with open(self.bf, 'wb') as f:
+            f.write(b'\0' * 1024)
+        self.assertEqual(['listmode.dcm', 'listmode.bf'], sc.update())
+        self.assertEqual([], sc.update())
+
+        ent = Sidecar.find(self.dcm).entry(self.dcm)
+        self.assertEqual(3599, ent['petlink']['image_duration'])
+        self.assertEqual('2018-05-17', ent['petlink']['study_date'])
+        self.assertEqual('Fluorodeoxyglucose', ent['petlink']['tracer'])
+        self.assertEqual(['ORIGINAL', 'PRIMARY', 'PET_LISTMODE'], ent['dicom']['ImageType'])
+        self.assertEqual('155819.000000', ent['dicom']['SeriesTime'])
+        bent = Sidecar.find(self.bf).entry(self.bf)
+        self.assertEqual(1024, bent['size'])
+        self.assertEqual('60cacbf3d72e1e7834203da608037b1bf83b40e8', bent['sha1'])
+
+    def test_entry_stale(self):
+        with open(self.bf, 'wb') as f:
+            f.write(b'\0' * 1024)
+        Sidecar(self.folder).update()
+        lm = os.path.join(self.folder, 'LM')
+        os.makedirs(lm)
+        os.rename(self.dcm, os.path.join(lm, 'listmode.dcm'))
+        self.assertIsNotNone(Sidecar.find(os.path.join(lm, 'listmode.dcm')).entry(os.path.join(lm, 'listmode.dcm')))
+        with open(self.bf, 'ab') as f:
+            f.write(b'\0')
+        self.assertIsNone(Sidecar(self.folder).entry(self.bf))
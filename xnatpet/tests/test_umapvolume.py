@@ -0,0 +1,65 @@
+import unittest
+import os
+from xnatpet.umapvolume import UmapVolume, stack_folders
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tests')
+
+class TestUmapVolume(unittest.TestCase):
+    """stacks the first 12 instances of tests/umap, whose filenames do not sort in slice order"""
+
+    def setUp(self):
+        import tempfile
+        import shutil
+        self._tmpdir = tempfile.mkdtemp()
+        self.folder = os.path.join(self._tmpdir, 'Head_MRAC_Brain_HiRes_in_UMAP_DT20180517120412')
+        os.makedirs(self.folder)
+        self.fixtures = sorted((f for f in os.listdir(os.path.join(FIXTURES, 'umap')) if f.endswith('.dcm')),
+                               key=lambda f: int(f.split('.')[4]))[:12]
+        for f in self.fixtures:
+            shutil.copy(os.path.join(FIXTURES, 'umap', f), self.folder)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def test_read(self):
+        import numpy as np
+        from pydicom import dcmread
+        vol, affine = UmapVolume(self.folder).read()
+        self.assertEqual((240, 126, 12), vol.shape)
+        self.assertEqual(np.float32, vol.dtype)
+        ds = [dcmread(os.path.join(self.folder, f)) for f in self.fixtures]
+        ds.sort(key=lambda d: float(d.ImagePositionPatient[1])) # normal of IOP [1,0,0,0,0,-1] is +y
+        for k, d in enumerate(ds):
+            np.testing.assert_array_equal(d.pixel_array.T, vol[:, :, k])
+            ipp = np.array([float(x) for x in d.ImagePositionPatient]) * [-1, -1, 1]
+            np.testing.assert_allclose(ipp, affine.dot([0, 0, k, 1])[:3], atol=1e-3)
+        self.assertAlmostEqual(2.08626, affine[0, 0] * -1, places=5)
+
+    def test_write(self):
+        import numpy as np
+        u = UmapVolume(self.folder)
+        self.assertEqual(u.path, u.write())
+        vol, affine = UmapVolume.load(u.path)
+        self.assertEqual((240, 126, 12), vol.shape)
+        self.assertEqual((4, 4), affine.shape)
+        self.assertTrue(u.current())
+        self.assertIsNone(u.write()) # same slices
+        for f in u.dcms:
+            os.utime(f, None)
+        self.assertFalse(u.current(checksum='stale')) # stamp differs, so the checksum decides
+        self.assertIsNone(u.write()) # same contents; records the new stamp
+        self.assertTrue(u.current(checksum='stale'))
+        self.assertEqual([], stack_folders([self.folder]))
+
+        os.remove(os.path.join(self.folder, self.fixtures[0]))
+        self.assertFalse(u.current())
+        self.assertEqual([u.path], stack_folders([self.folder]))
+        self.assertEqual(11, UmapVolume.load(u.path)[0].shape[2])
+        self.assertEqual(u.path, u.write(force=True))
+
+    def test_empty(self):
+        empty = os.path.join(self._tmpdir, 'empty')
+        os.makedirs(empty)
+        with self.assertRaises(AssertionError):
+            UmapVolume(empty).read()
@@ -20,4 +20,341 @@ class TestCalibrate(unittest.TestCase):
             cachedir=self._cachedir,
             prj='CCIR_00754')
         print(self.cal.create_tracerloc_list())
-        return
\ No newline at end of file
+        return
+
+
+class TestCalibrationCachedir(unittest.TestCase):
+    """selects tracer locations from a synthetic cachedir built from tests/listmode.dcm; needs no credentials"""
+
+    def setUp(self):
+        import tempfile
+        import shutil
+        self._cwd = os.getcwd()
+        self._cachedir = tempfile.mkdtemp()
+        fixture = os.path.join(os.path.dirname(__file__), '..', '..', 'tests', 'listmode.dcm')
+        for ses, dt in [('ses-E1', '20180202140741.000000'), ('ses-E2', '20180303140741.000000')]:
+            lm = os.path.join(self._cachedir, 'CCIR_00754', ses, 'FDG_DT' + dt + '-Converted-NAC', 'LM')
+            os.makedirs(lm)
+            shutil.copy(fixture, lm)
+        os.makedirs(os.path.join(self._cachedir, 'CCIR_00754', 'ses-E3'))
+
+    def tearDown(self):
+        import shutil
+        os.chdir(self._cwd)
+        shutil.rmtree(self._cachedir, ignore_errors=True)
+
+    def test_create_NAC(self):
+        import sys
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754')
+        cal.calibration_duration = 4000
+        cal.batch_poll = 0.05
+        cal.nprocs = 2
+        cal.recon_command = [sys.executable, '-c',
+                             'import os, sys; d = os.path.join(sys.argv[1], "output", "PET"); os.makedirs(d); '
+                             'open(os.path.join(d, "reconstruction_Reconstruction_finished.touch"), "w").close()',
+                             '{path}']
+        tralocs = cal.create_tracerloc_list()
+        done = os.path.join(tralocs[0], 'output', 'PET')
+        os.makedirs(done)
+        open(os.path.join(done, 'reconstruction_Reconstruction_finished.touch'), 'w').close()
+        res = cal.create_NAC(tralocs)
+        self.assertEqual(['skipped', 'ok'], [r['status'] for r in res])
+        self.assertTrue(os.path.exists(os.path.join(tralocs[1], 'output', 'PET', 'reconstruction_Reconstruction_finished.touch')))
+        self.assertEqual(['skipped', 'skipped'], [r['status'] for r in cal.create_NAC(tralocs)])
+
+        cal.recon_outputs = 'never'
+        cal.recon_timeout = 0.5
+        cal.recon_command = [sys.executable, '-c', 'import time; time.sleep(30)']
+        res = cal.create_NAC(tralocs)
+        self.assertEqual(['timeout', 'timeout'], [r['status'] for r in res])
+        self.assertLess(max(r['wall'] for r in res), 5)
+        self.assertEqual([], cal.create_AC(tralocs)) # no AC folders
+
+    def test_timeout_kills_group(self):
+        import sys
+        import time
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754')
+        cal.batch_poll = 0.05
+        cal.kill_grace = 0.5
+        cal.screen_before_recon = False
+        cal.recon_outputs = 'never'
+        cal.recon_timeout = 0.5
+        cal.recon_command = [sys.executable, '-c',
+                             'import signal, subprocess, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); '
+                             'p = subprocess.Popen(["sleep", "30"]); open("child.pid", "w").write(str(p.pid)); '
+                             'time.sleep(30)']
+        nac = os.path.join(self._cachedir, 'CCIR_00754', 'ses-E1', 'FDG_DT20180202140741.000000-Converted-NAC')
+        res = cal.create_NAC([nac])
+        self.assertEqual(['timeout'], [r['status'] for r in res])
+        self.assertLess(res[0]['wall'], 5)
+        with open(os.path.join(nac, 'child.pid')) as f:
+            pid = int(f.read())
+        for _ in range(50):
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                break
+            time.sleep(0.1)
+        else:
+            self.fail('grandchild %d outlived its timed-out job' % pid)
+
+    def test_stage_umaps(self):
+        import sys
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754')
+        cal.batch_poll = 0.05
+        cal.umap_command = [sys.executable, '-c', 'pass']
+        e1 = os.path.join(self._cachedir, 'CCIR_00754', 'ses-E1')
+        e2 = os.path.join(self._cachedir, 'CCIR_00754', 'ses-E2')
+        umap = os.path.join(e1, 'FDG_DT20180202140741.000000-Converted-AC', 'umap')
+        os.makedirs(umap)
+        open(os.path.join(umap, 'umapSynth.v'), 'w').close()
+        tralocs = [os.path.join(e1, 'FDG_DT20180202140741.000000-Converted-NAC'),
+                   os.path.join(e2, 'FDG_DT20180303140741.000000-Converted-NAC')]
+        res = cal.stage_umaps(tralocs)
+        self.assertEqual([(e1, 'skipped'), (e2, 'ok')], [(r['loc'], r['status']) for r in res])
+
+    def test_create_NAC_once(self):
+        import sys
+        import shutil
+        nac = os.path.join(self._cachedir, 'CCIR_00754', 'ses-E1', 'FDG_DT20180202140741.000000-Converted-NAC')
+        ac = nac[:-len('NAC')] + 'AC'
+        shutil.copytree(nac, ac)
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754')
+        cal.batch_poll = 0.05
+        cal.nprocs = 2
+        cal.screen_before_recon = False
+        cal.recon_outputs = 'never'
+        cal.recon_command = [sys.executable, '-c', 'pass']
+        res = cal.create_NAC([nac, ac])
+        self.assertEqual(['ok'], [r['status'] for r in res])
+        self.assertEqual(['ok'], [r['status'] for r in cal.create_AC([ac, nac])])
+
+    def test_crawl(self):
+        e3 = os.path.join(self._cachedir, 'CCIR_00754', 'ses-E3')
+        os.makedirs(os.path.join(e3, 'FDG_DT20150101140741.000000-Converted-NAC'))
+        os.makedirs(os.path.join(e3, 'FDG_DT20180404140741.000000-Converted-AC', 'LM'))
+        os.makedirs(os.path.join(e3, 'OO_DT20180404150741.000000-Converted-NAC'))
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754')
+        cal.nthreads = 1
+        serial = [d for e in cal.select_experiments() for t in cal.select_tracers(e) for d in cal.select_dates(t)]
+        self.assertEqual(3, len(serial))
+        cal.nthreads = 4
+        self.assertEqual(serial, cal.crawl())
+        self.assertEqual(sorted(serial), sorted(cal.crawl(stream=True)))
+        self.assertTrue(cal.lm_dcms[serial[0]].endswith(os.path.join('LM', 'listmode.dcm')))
+        self.assertNotIn(serial[2], cal.lm_dcms)
+        cal.tracers = ['FDG', 'OO']
+        self.assertEqual(4, len(cal.crawl()))
+
+    def test_crawl_stream_threads(self):
+        import gc
+        import threading
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754')
+        cal.nthreads = 4
+        n = threading.active_count()
+        unread = cal.crawl_experiments(stream=True)
+        self.assertEqual(n, threading.active_count())
+        partial = cal.crawl_experiments(stream=True)
+        next(partial)
+        self.assertGreater(threading.active_count(), n)
+        partial.close()
+        del unread
+        gc.collect()
+        self.assertEqual(n, threading.active_count())
+
+    def test_folder_cache(self):
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754')
+        cal.calibration_duration = 4000
+        self.assertEqual(2, len(cal.create_tracerloc_list()))
+        self.assertTrue(os.path.isfile(os.path.join(cal.prjdir, cal.folder_cache_name)))
+
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754')
+        cal.calibration_duration = 4000
+        self.assertEqual(2, len(cal.create_tracerloc_list()))
+        summ = cal.metrics.summary()
+        self.assertEqual(2, summ['folder']['cache_hits'])
+        self.assertNotIn('interfile_search', summ)
+
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754')
+        cal.calibration_duration = 1000
+        self.assertEqual([], cal.create_tracerloc_list())
+        self.assertNotIn('interfile_search', cal.metrics.summary())
+
+        dcm = cal.dcm_for_calibration(cal.crawl()[0])
+        os.utime(dcm, (os.path.getatime(dcm), os.path.getmtime(dcm) + 10))
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754')
+        cal.create_tracerloc_list()
+        self.assertEqual(1, cal.metrics.summary()['interfile_search']['calls'])
+
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754')
+        cal.recompute = True
+        cal.create_tracerloc_list()
+        self.assertEqual(2, cal.metrics.summary()['interfile_search']['calls'])
+
+        from datetime import datetime
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754')
+        traloc = cal.crawl()[0]
+        cal.load_folder_cache()
+        self.assertEqual(cal.calibration_rules(), cal.folder_cache[traloc]['rules']) # no bound of now
+        self.assertFalse(cal.in_daterange(datetime(2100, 1, 1)))
+        cal.folder_cache[traloc]['stamp'][0] = 'moved.dcm' # recorded for another .dcm of the same mtime
+        cal.create_tracerloc_list()
+        self.assertEqual(1, cal.metrics.summary()['interfile_search']['calls'])
+
+    def test_sidecar(self):
+        from xnatpet.sidecar import Sidecar
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754')
+        traloc = cal.crawl()[0]
+        dcm = cal.dcm_for_calibration(traloc)
+        open(cal.bf_for_calibration(dcm), 'w').close()
+        self.assertEqual(['listmode.dcm', 'listmode.bf'], Sidecar(os.path.dirname(dcm)).update())
+        self.assertEqual(3599, cal.image_duration(dcm))
+        self.assertNotIn('interfile_search', cal.metrics.summary())
+        self.assertEqual(1, cal.metrics.summary()['sidecar']['cache_hits'])
+
+        os.utime(dcm, (os.path.getatime(dcm), os.path.getmtime(dcm) + 10))
+        self.assertIsNone(cal.sidecar_entry(dcm))
+        self.assertEqual(3599, cal.image_duration(dcm))
+        self.assertEqual(1, cal.metrics.summary()['interfile_search']['calls'])
+
+    def test_count_rates(self):
+        from xnatpet.tests.fakexnat import write_listmode
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754')
+        traloc = cal.crawl()[0]
+        write_listmode(cal.bf_for_calibration(cal.dcm_for_calibration(traloc)), [30, 40], [3, 4])
+        cr = cal.count_rates(traloc)
+        self.assertEqual([30, 40], list(cr.prompts))
+        self.assertEqual([3, 4], list(cr.delays))
+        self.assertEqual(1, cal.metrics.summary()['listmode']['calls'])
+
+    def _write_listmode(self, bf, prompts, delays):
+        """writes bf and sets the total word count of the interfile header of its .dcm, keeping element lengths"""
+        import re
+        from xnatpet.tests.fakexnat import write_listmode
+        n = write_listmode(bf, prompts, delays)
+        dcm = os.path.splitext(bf)[0] + '.dcm'
+        with open(dcm, 'rb') as f:
+            content = f.read()
+        content = re.sub(b'(total listmode word counts :=)[ 0-9]{10}', b'\\g<1>' + ('%-10d' % n).encode('ascii'),
+                         content)
+        with open(dcm, 'wb') as f:
+            f.write(content)
+
+    def test_screen(self):
+        import sys
+        import numpy as np
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754')
+        cal.calibration_duration = 4000
+        tralocs = cal.create_tracerloc_list()
+        bfs = [cal.bf_for_calibration(cal.dcm_for_calibration(t)) for t in tralocs]
+        rate = 50 + np.arange(3600) // 100 # slowly varying
+        self._write_listmode(bfs[0], rate, rate // 10)
+        self._write_listmode(bfs[1], rate[:600], rate[:600] // 10)
+        res = cal.screen(tralocs)
+        self.assertEqual(['ok', 'aborted'], [r['status'] for r in res])
+        self.assertEqual((3598, 0, 0), (res[0]['seconds'], res[0]['gaps'], res[0]['outliers']))
+        with open(os.path.join(cal.prjdir, cal.screen_log_name)) as f:
+            self.assertEqual([tralocs[1]], [l.split()[0] for l in f])
+
+        gap = rate.copy()
+        gap[1000:1005] = 0
+        self._write_listmode(bfs[0], gap, rate // 10)
+        with open(bfs[1], 'ab') as f:
+            f.write(b'\0\0')
+        self.assertEqual(['abnormal', 'truncated'], [r['status'] for r in cal.screen(tralocs)])
+        spike = rate.copy()
+        spike[::60] *= 3 # a burst each minute
+        self._write_listmode(bfs[0], spike, rate // 10)
+        self.assertEqual('abnormal', cal.screen_status(tralocs[0])['status'])
+
+        cal.batch_poll = 0.05
+        cal.recon_command = [sys.executable, '-c', 'pass']
+        for t in tralocs:
+            os.makedirs(t.replace('-Converted-NAC', '-Converted-AC'))
+        self._write_listmode(bfs[0], rate, rate // 10)
+        self.assertEqual([tralocs[0].replace('-NAC', '-AC')], [r['loc'] for r in cal.create_AC(tralocs)])
+        self.assertEqual(6, cal.metrics.summary()['screen']['calls']) # only changed .bf are read again
+
+    def test_extract_window(self):
+        import numpy as np
+        from xnatpet.listmode import Listmode
+        from xnatpet.petlink import PetlinkHeader
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754')
+        cal.calibration_duration = 60
+        traloc = cal.crawl()[0]
+        rate = np.full(240, 20)
+        self._write_listmode(cal.bf_for_calibration(cal.dcm_for_calibration(traloc)), rate, rate // 10)
+        dest = os.path.join(self._cachedir, 'FDG_DT20180202140741.000000-Converted-NAC', 'LM')
+        bf, n = cal.extract_window(traloc, dest)
+        self.assertEqual(os.path.join(dest, 'listmode.bf'), bf)
+        self.assertEqual(60 * 20, Listmode(bf).count_rates().prompts.sum())
+        self.assertEqual(60, PetlinkHeader.read(os.path.join(dest, 'listmode.dcm')).image_duration)
+        self.assertEqual('ok', Calibration(None, None, cachedir=self._cachedir, prj='CCIR_00754').screen_status(
+            os.path.dirname(dest))['status'])
+
+        bf0 = cal.bf_for_calibration(cal.dcm_for_calibration(traloc))
+        size = os.path.getsize(bf0)
+        with self.assertRaises(AssertionError):
+            cal.extract_window(traloc, os.path.dirname(bf0))
+        self.assertEqual(size, os.path.getsize(bf0))
+
+    def test_materialize(self):
+        import sys
+        import numpy as np
+        from xnatpet.compressedbf import CompressedBf
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754')
+        cal.calibration_duration = 4000
+        tralocs = cal.create_tracerloc_list()
+        rate = np.full(3600, 20)
+        for t in tralocs:
+            bf = cal.bf_for_calibration(cal.dcm_for_calibration(t))
+            self._write_listmode(bf, rate, rate // 10)
+            CompressedBf.compress(bf, remove=True)
+        self.assertEqual(['ok', 'ok'], [r['status'] for r in cal.screen(tralocs)])
+        cal.batch_poll = 0.05
+        cal.recon_command = [sys.executable, '-c', 'import os; assert os.path.isfile("LM/listmode.bf")']
+        self.assertEqual(['ok', 'ok'], [r['status'] for r in cal.create_NAC(tralocs)])
+        self.assertEqual(2, cal.metrics.summary()['materialize']['calls'])
+
+    def test_tracerloc_table(self):
+        from datetime import datetime
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754')
+        cal.calibration_duration = 4000
+        expected = cal.create_tracerloc_list()
+        cal.use_table = True
+        self.assertEqual(expected, cal.create_tracerloc_list())
+
+        table = cal.load_table(cal.save_table(cal.create_tracerloc_table(), os.path.join(self._cachedir, 't.npz')))
+        self.assertEqual(['ses-E1', 'ses-E2'], list(table['session']))
+        self.assertEqual(['FDG', 'FDG'], list(table['tracer']))
+        self.assertEqual([3599, 3599], list(table['duration']))
+        self.assertEqual([True, False], list(cal.calibration_mask(
+            table, daterange=[datetime(2018, 1, 1), datetime(2018, 3, 1)])))
+        self.assertFalse(cal.calibration_mask(table, calibration_duration=900).any())
+        self.assertFalse(cal.calibration_mask(table, max_calibration_filesize=1e9).any()) # no .bf
+
+    def test_search_interfile_value(self):
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754')
+        dcm = cal.dcm_for_calibration(cal.tracer_locations(os.path.join(cal.prjdir, 'ses-E1'), 'FDG')[0])
+        self.assertEqual(3599, cal.search_image_duration_value(dcm))
+        self.assertEqual('1', cal.search_interfile_value(dcm, '%timing tagwords interval (msec)'))
+        self.assertIsNone(cal.search_interfile_value(dcm, 'no such key'))
+        cal.header_scan_bytes = 1024
+        self.assertIsNone(cal.search_interfile_value(dcm, 'image duration (sec)'))
+
+    def test_profile(self):
+        import json
+        report = os.path.join(self._cachedir, 'profile.json')
+        cal = Calibration(user=None, password=None, cachedir=self._cachedir, prj='CCIR_00754', profile=report)
+        cal.calibration_duration = 4000
+        self.assertEqual(2, len(cal.create_tracerloc_list()))
+        with open(report) as f:
+            rep = json.load(f)
+        self.assertEqual(3, len(rep['slowest_experiments']))
+        self.assertEqual(2, len(rep['slowest_folders']))
+        fld = rep['slowest_folders'][0]
+        self.assertTrue(fld['folder'].startswith('FDG_DT'))
+        self.assertGreater(fld['bytes'], 0)
+        self.assertIn('glob', fld['phases'])
+        self.assertIn('interfile_search', fld['phases'])
+        self.assertGreaterEqual(rep['slowest_experiments'][0]['wall'], rep['slowest_experiments'][-1]['wall'])
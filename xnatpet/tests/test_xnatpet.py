@@ -1,5 +1,7 @@
 import unittest
 from xnatpet.xnatpet import StageXnat
+from xnatpet.sidecar import Sidecar
+from xnatpet.umapvolume import UmapVolume
 import os
 from uuid import uuid1
 import urllib3
@@ -394,6 +396,190 @@ class TestRawData(unittest.TestCase):
 
 
 
+class TestFakeXnat(unittest.TestCase):
+    """stages synthetic sessions from xnatpet.tests.fakexnat; needs no credentials"""
+
+    def setUp(self):
+        import tempfile
+        from xnatpet.tests.fakexnat import FakeXnat
+        self._cwd = os.getcwd()
+        self._cachedir = tempfile.mkdtemp()
+        self.fake = FakeXnat()
+        self.eids = self.fake.seed(nsubjects=1, nsessions=2, nslices=4, bf_size=4096, fs_size=1024)
+        self.fake.start()
+        self.sxnat = StageXnat(
+            user='fake', password='fake',
+            cachedir=self._cachedir,
+            prj='CCIR_00754', sbj='CNDA_S90001', ses=self.eids[0], host=self.fake.url)
+        self.sxnat.tracers = ['Fluorodeoxyglucose']
+
+    def tearDown(self):
+        import shutil
+        os.chdir(self._cwd)
+        self.fake.stop()
+        self.fake.cleanup()
+        shutil.rmtree(self._cachedir, ignore_errors=True)
+
+    def test_lazy(self):
+        self.fake.reset_counts()
+        sxnat = StageXnat(
+            user='fake', password='fake',
+            cachedir=self._cachedir,
+            prj='CCIR_00754', sbj='CNDA_S90001', ses=self.eids[0], scn=3, host=self.fake.url)
+        self.assertEqual({}, self.fake.requests)
+        self.assertEqual(os.path.join(self._cachedir, 'CCIR_00754', 'ses-E90001'), sxnat.dir_session)
+        self.assertEqual({'session': self.eids[0], 'scan': '3'}, sxnat.metrics_fields())
+        self.assertEqual({}, self.fake.requests)
+        self.assertIs(sxnat.session, sxnat.session)
+        self.assertEqual(self.eids[0], sxnat.session._urn)
+        self.assertGreater(sum(self.fake.requests.values()), 0)
+
+    def test_stage_session(self):
+        self.sxnat.stage_session()
+        ses = os.path.join(self._cachedir, 'CCIR_00754', 'ses-E90001')
+        fdg = os.path.join(ses, 'FDG_DT20180202140741.000000-Converted-NAC')
+        self.assertEqual(5, len(os.listdir(fdg)))
+        sc = Sidecar.find(os.path.join(fdg, Sidecar.name))
+        self.assertEqual(4, len(sc.entries))
+        self.assertTrue(all(sc.entry(os.path.join(fdg, f)) for f in sc.entries))
+        self.assertEqual(4, len(os.listdir(os.path.join(ses, 'umaps', os.listdir(os.path.join(ses, 'umaps'))[0]))))
+        self.assertTrue(os.path.isdir(os.path.join(ses, 'mri')))
+        self.assertGreater(self.fake.report()['requests']['file'], 0)
+
+    def test_stage_project(self):
+        self.sxnat.stage_project()
+        prj = os.path.join(self._cachedir, 'CCIR_00754')
+        self.assertEqual(['ses-E90001', 'ses-E90002'], sorted(os.listdir(prj)))
+
+    def test_objectstore(self):
+        from xnatpet.objectstore import ObjectStore
+        self.sxnat.use_objectstore = True
+        self.sxnat.stage_session()
+        fdg = os.path.join(self._cachedir, 'CCIR_00754', 'ses-E90001', 'FDG_DT20180202140741.000000-Converted-NAC')
+        for f in os.listdir(fdg):
+            if not os.path.isdir(os.path.join(fdg, f)) and f != Sidecar.name:
+                self.assertEqual(2, os.stat(os.path.join(fdg, f)).st_nlink)
+        rep = ObjectStore(self._cachedir).report()
+        self.assertGreater(rep['objects'], 0)
+        self.assertEqual(0, rep['unreferenced'])
+
+    def test_cache_quota(self):
+        self.sxnat.cache_quota = 2**40
+        self.sxnat.stage_session()
+        fdg = os.path.join(self._cachedir, 'CCIR_00754', 'ses-E90001', 'FDG_DT20180202140741.000000-Converted-NAC')
+        self.assertIn('.last_used', os.listdir(fdg))
+        self.assertEqual(1, self.sxnat.metrics.summary()['ensure_cache_space']['calls'])
+
+        # restaging under a quota that the session already fills evicts none of its folders
+        from xnatpet.cachemanager import CacheManager
+        os.makedirs(os.path.join(fdg, 'output', 'PET'))
+        open(os.path.join(fdg, CacheManager.finished), 'w').close()
+        ses = os.path.dirname(fdg)
+        folders = [os.path.join(ses, f) for f in os.listdir(ses) if os.path.isdir(os.path.join(ses, f))]
+        for f in folders:
+            open(os.path.join(f, 'marker'), 'w').close()
+        self.sxnat.cache_quota = CacheManager(self._cachedir).usage()
+        self.sxnat.stage_session()
+        self.assertTrue(all(os.path.exists(os.path.join(f, 'marker')) for f in folders))
+
+    def test_stack_umaps(self):
+        self.sxnat.stack_umaps = True
+        self.sxnat.stage_session()
+        ses = os.path.join(self._cachedir, 'CCIR_00754', 'ses-E90001')
+        umap = os.path.join(ses, 'umaps', os.listdir(os.path.join(ses, 'umaps'))[0])
+        self.assertEqual(6, len(os.listdir(umap))) # 4 slices, umap.npz and its sidecar
+        self.assertEqual(4, UmapVolume.load(os.path.join(umap, 'umap.npz'))[0].shape[2])
+        self.assertEqual([], self.sxnat.stage_umaps() or []) # cached, and current by stamp
+
+    def test_compress_bf(self):
+        from xnatpet.compressedbf import folder_report
+        self.sxnat.compress_bf = True
+        self.sxnat.stage_session()
+        fdg = os.path.join(self._cachedir, 'CCIR_00754', 'ses-E90001', 'FDG_DT20180202140741.000000-Converted-NAC')
+        exts = sorted(os.path.splitext(f)[1] for f in os.listdir(fdg))
+        self.assertEqual(['.bfz', '.bfz', '.dcm', '.dcm', '.json'], exts)
+        self.assertEqual(4, len(Sidecar(fdg).entries))
+        rep = folder_report(fdg)
+        self.assertEqual(2, len(rep['files']))
+        self.assertEqual(2 * 4096, rep['raw_bytes'])
+
+    def test_stage_freesurfer(self):
+        ses = os.path.join(self._cachedir, 'CCIR_00754', 'ses-E90001')
+        mri = self.sxnat.stage_freesurfer()
+        self.assertEqual(os.path.join(ses, 'mri'), mri)
+        self.assertEqual(['T1.mgz', 'aparc+aseg.mgz', 'brain.mgz'], sorted(os.listdir(mri)))
+        self.assertEqual(3, self.fake.requests['file'])
+        self.assertNotIn('zip', self.fake.requests)
+        fs = [d for d in os.listdir(ses) if '_freesurfer_' in d][0]
+        files = os.path.join(ses, fs, 'out', 'resources', 'DATA', 'files')
+        self.assertEqual(['mri'], os.listdir(os.path.join(files, os.listdir(files)[0])))
+
+    def test_stage_freesurfer_unlisted(self):
+        ses = os.path.join(self._cachedir, 'CCIR_00754', 'ses-E90001')
+        self.fake.failing = ('/out/resources',)
+        self.sxnat.session # staged before counting
+        self.fake.reset_counts()
+        mri = self.sxnat.stage_freesurfer()
+        self.assertEqual(os.path.join(ses, 'mri'), mri)
+        self.assertTrue(os.path.isdir(mri))
+        self.assertEqual(1, self.fake.requests['zip'])
+        self.assertEqual(4, self.fake.requests['jsession']) # each JSESSION requested is expired
+
+    def test_probe_unknown_size(self):
+        umap = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tests', 'umap')
+        name = sorted(os.listdir(umap))[0]
+        self.sxnat.probe_bytes = 16 # within the preamble
+        skip, nbytes = self.sxnat._StageXnat__probe_skip_scan(
+            {}, name, {'URI': '', 'absolutePath': os.path.join(umap, name), 'Size': 0})
+        self.assertFalse(skip) # MR, read by growing the range though Size is unknown
+
+    def test_metrics(self):
+        import json
+        jsonl = os.path.join(self._cachedir, 'metrics.jsonl')
+        sxnat = StageXnat(
+            user='fake', password='fake',
+            cachedir=self._cachedir,
+            prj='CCIR_00754', sbj='CNDA_S90001', ses=self.eids[0], host=self.fake.url, metrics=jsonl)
+        sxnat.tracers = ['Fluorodeoxyglucose']
+        sxnat.stage_session()
+        summ = sxnat.metrics.summary()
+        self.assertEqual(1, summ['stage_session']['calls'])
+        self.assertEqual(self.fake.bytes_served, summ['stage_session']['bytes'])
+        self.assertGreater(summ['stage_session']['requests'], 0)
+        self.assertLessEqual(summ['stage_session']['requests'], sum(self.fake.requests.values()))
+        self.assertGreater(summ['move']['calls'], 0)
+        with open(jsonl) as f:
+            recs = [json.loads(l) for l in f]
+        self.assertEqual('stage_session', recs[-1]['phase'])
+        self.assertEqual(self.eids[0], recs[-1]['session'])
+
+    def test_range(self):
+        import requests
+        u = self.fake.url + '/data/experiments/%s/scans/1/resources/DICOM/files?format=json' % self.eids[0]
+        f = requests.get(u).json()['ResultSet']['Result'][0]
+        r = requests.get(self.fake.url + f['URI'], headers={'Range': 'bytes=128-131'})
+        self.assertEqual(206, r.status_code)
+        self.assertEqual(b'DICM', r.content)
+
+    def test_download_legacy(self):
+        exp = self.fake.find_experiment(self.eids[0])
+        sc = sum(os.path.getsize(os.path.join(exp['dir'], 'SCANS', '4', 'DICOM', n))
+                 for n in exp['scans']['4']['resources']['DICOM'])
+        self.sxnat._StageXnat__download_legacy()
+        self.assertEqual(sc, self.sxnat.metrics.summary()['download']['bytes_avoided'])
+        self.assertFalse([n for n in os.listdir(self._cachedir) if n in exp['scans']['4']['resources']['DICOM']])
+
+        # without xsiType in the scan listing, only the leading bytes of one DICOM are read
+        del exp['scans']['4']['xsiType']
+        for s in ['1', '2', '3']:
+            del exp['scans'][s]
+        self.fake.reset_counts()
+        self.sxnat._StageXnat__download_legacy()
+        self.assertEqual(1, self.fake.requests['file'])
+        self.assertEqual(2*sc - self.fake.bytes_served, self.sxnat.metrics.summary()['download']['bytes_avoided'])
+
+
+
 class TestPyxnat(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,227 @@
+import os
+from warnings import warn
+
+
+
+class UmapVolume(object):
+    """Stacks the per-slice DICOMs of a staged umap series, e.g., ses-*/umaps/Head_MRAC_Brain_HiRes_in_UMAP_DT*, into
+       one volume written next to them as <folder>/<name>.npz, or <name>.nii.gz with nibabel.  Slices are read on
+       a thread pool, sorted by ImagePositionPatient along the slice normal, and rescaled in one vectorized pass.
+       The volume is indexed (column, row, slice), as NIfTI, with a 4x4 affine to RAS mm.  A digest of the slices
+       and a stamp of their sizes and mtimes are kept in the Sidecar of the folder; stacking again is skipped when
+       the stamp matches, or else when the digest does."""
+
+    __author__ = "John J. Lee"
+    __copyright__ = "Copyright 2019"
+
+    name = 'umap'
+    fmt = 'npz' # or 'nii', which needs nibabel
+    nthreads = 8 # slices read concurrently
+    dtype = 'float32'
+
+    @property
+    def dcms(self):
+        return sorted(os.path.join(self.folder, f) for f in os.listdir(self.folder) if f.endswith('.dcm'))
+
+    @property
+    def path(self):
+        return os.path.join(self.folder, self.name + ('.nii.gz' if self.fmt == 'nii' else '.npz'))
+
+    def checksum(self, dcms=None):
+        """
+        :param dcms; default is self.dcms:
+        :return hex digest of the basenames and digests of dcms:
+        """
+        import hashlib
+        from multiprocessing.pool import ThreadPool
+        from objectstore import ObjectStore
+        if dcms is None:
+            dcms = self.dcms
+        store = ObjectStore(self.folder)
+        pool = ThreadPool(max(1, min(self.nthreads, len(dcms))))
+        try:
+            digests = pool.map(store.digest, dcms)
+        finally:
+            pool.close()
+            pool.join()
+        h = hashlib.new(store.hash_name)
+        for fn, d in zip(dcms, digests):
+            h.update(('%s %s\n' % (os.path.basename(fn), d)).encode('ascii'))
+        return h.hexdigest()
+
+    def stamp(self, dcms=None):
+        """
+        :param dcms; default is self.dcms:
+        :return hex digest of the basenames, sizes and mtimes of dcms, cheap to compute:
+        """
+        import hashlib
+        if dcms is None:
+            dcms = self.dcms
+        h = hashlib.sha1()
+        for fn in dcms:
+            st = os.stat(fn)
+            h.update(('%s %d %r\n' % (os.path.basename(fn), st.st_size, st.st_mtime)).encode('ascii'))
+        return h.hexdigest()
+
+    def current(self, checksum=None, stamp=None):
+        """
+        :param checksum of the slices; default computes it unless stamp matches:
+        :param stamp of the slices; default computes it:
+        :return True if self.path was written from the same slices and has not changed since:
+        """
+        from sidecar import Sidecar
+        ent = Sidecar(self.folder).entry(self.path)
+        if ent is None:
+            return False
+        if ent.get('stamp') == (self.stamp() if stamp is None else stamp):
+            return True
+        if checksum is None:
+            checksum = self.checksum()
+        return ent.get('sources') == checksum
+
+    def read(self, dcms=None):
+        """
+        :param dcms; default is self.dcms:
+        :return (volume, affine) as numpy arrays:
+        """
+        import numpy as np
+        from multiprocessing.pool import ThreadPool
+        if dcms is None:
+            dcms = self.dcms
+        if not dcms:
+            raise AssertionError('UmapVolume.read found no .dcm in %s' % self.folder)
+        pool = ThreadPool(max(1, min(self.nthreads, len(dcms))))
+        try:
+            slices = pool.map(self.__read_slice, dcms)
+        finally:
+            pool.close()
+            pool.join()
+        iop = np.array(slices[0][1], dtype=float)
+        normal = np.cross(iop[:3], iop[3:])
+        ipp = np.array([s[0] for s in slices], dtype=float)
+        order = np.argsort(ipp.dot(normal), kind='mergesort')
+        if len(set(s[4].shape for s in slices)) > 1:
+            raise AssertionError('UmapVolume.read found slices of differing shapes in %s' % self.folder)
+
+        pixels = np.stack([slices[i][4] for i in order]) # (slice, row, column)
+        slope = np.array([slices[i][2] for i in order], dtype=self.dtype).reshape(-1, 1, 1)
+        inter = np.array([slices[i][3] for i in order], dtype=self.dtype).reshape(-1, 1, 1)
+        vol = pixels * slope + inter
+        return vol.transpose(2, 1, 0), self.__affine(iop, normal, ipp[order], slices[order[0]][5])
+
+    def write(self, force=False):
+        """
+        stacks the slices of self.folder unless self.path is current
+        :param force writing even if current:
+        :return self.path, or None if the stack was current:
+        """
+        from sidecar import Sidecar
+        dcms = self.dcms
+        stamp = self.stamp(dcms)
+        sc = Sidecar(self.folder)
+        ent = None if force else sc.entry(self.path)
+        if ent and ent.get('stamp') == stamp:
+            return None
+        checksum = self.checksum(dcms)
+        if ent and ent.get('sources') == checksum:
+            ent['stamp'] = stamp # slices touched but unchanged
+            sc.save()
+            return None
+        vol, affine = self.read(dcms)
+        tmp = self.path + '.tmp'
+        if self.fmt == 'nii':
+            import nibabel as nib
+            nib.save(nib.Nifti1Image(vol, affine), tmp + '.nii.gz')
+            os.rename(tmp + '.nii.gz', self.path)
+        else:
+            import numpy as np
+            with open(tmp, 'wb') as f:
+                np.savez(f, volume=vol, affine=affine, checksum=checksum)
+            os.rename(tmp, self.path)
+        ent = sc.record(self.path)
+        ent['sources'] = checksum
+        ent['stamp'] = stamp
+        sc.save()
+        return self.path
+
+    @staticmethod
+    def load(path):
+        """
+        :param path of a .npz written by UmapVolume:
+        :return (volume, affine):
+        """
+        import numpy as np
+        with np.load(path) as z:
+            return z['volume'], z['affine']
+
+    def __affine(self, iop, normal, ipp, spacing):
+        """
+        :return 4x4 affine from (column, row, slice) indices to RAS mm:
+        """
+        import numpy as np
+        dr, dc = spacing # PixelSpacing is (between rows, between columns)
+        if len(ipp) > 1:
+            step = (ipp[-1] - ipp[0]) / (len(ipp) - 1)
+            gaps = np.linalg.norm(np.diff(ipp, axis=0), axis=1)
+            if np.ptp(gaps) > 0.01 * np.linalg.norm(step):
+                warn('UmapVolume found nonuniform slice spacing in %s' % self.folder)
+        else:
+            step = normal * self.__thickness
+        affine = np.eye(4)
+        affine[:3, 0] = iop[:3] * dc
+        affine[:3, 1] = iop[3:] * dr
+        affine[:3, 2] = step
+        affine[:3, 3] = ipp[0]
+        return np.diag([-1, -1, 1, 1]).dot(affine) # LPS to RAS
+
+    def __read_slice(self, dcm):
+        from pydicom import dcmread
+        d = dcmread(dcm)
+        if self.__thickness is None:
+            self.__thickness = float(d.get('SliceThickness') or 1)
+        return ([float(x) for x in d.ImagePositionPatient],
+                [float(x) for x in d.ImageOrientationPatient],
+                float(d.get('RescaleSlope') or 1),
+                float(d.get('RescaleIntercept') or 0),
+                d.pixel_array,
+                [float(x) for x in d.PixelSpacing])
+
+    def __init__(self, folder):
+        """
+        :param folder of the .dcm of one umap series:
+        """
+        self.folder = folder
+        self.__thickness = None
+
+
+
+def stack_folders(folders, force=False):
+    """
+    :param folders of umap series, e.g., from StageXnat.stage_umaps:
+    :param force writing even if current:
+    :return list of volumes written:
+    """
+    written = []
+    for folder in folders:
+        try:
+            path = UmapVolume(folder).write(force=force)
+        except (AssertionError, AttributeError, IOError) as e:
+            warn('stack_folders skipped %s: %s' % (folder, e))
+            continue
+        if path:
+            written.append(path)
+    return written
+
+
+
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser(description='stacks the .dcm of umap series into one volume per folder')
+    p.add_argument('folders', nargs='+', help='folders of umap series, e.g., ses-*/umaps/*')
+    p.add_argument('--nii', action='store_true', help='writes .nii.gz with nibabel rather than .npz')
+    p.add_argument('--force', action='store_true', help='writes even if a stack of the same slices exists')
+    args = p.parse_args()
+    if args.nii:
+        UmapVolume.fmt = 'nii'
+    for path in stack_folders(args.folders, force=args.force):
+        print(path)
@@ -3,8 +3,13 @@ import errno
 import pyxnat
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from collections import OrderedDict
 from datetime import datetime
 from warnings import warn
+from metrics import Metrics, timed
+from interfilecache import interfile_cache
+from sidecar import Sidecar
+from compressedbf import CompressedBf, bf_path, raw_size
 
 class Calibration(object):
     """Calibrates PET stored on XNAT server"""
@@ -13,48 +18,319 @@ class Calibration(object):
     __copyright__ = "Copyright 2019"
 
     calibration_duration = 900 # sec
-    daterange = [datetime(2016, 7, 18, 0, 0, 0, 0), datetime.now()]
+    daterange = [datetime(2016, 7, 18, 0, 0, 0, 0), None] # upper bound None is now, when dates are checked
+    folder_cache_name = '.calibration_cache.json' # in prjdir; values and verdicts per tracer location
+    header_scan_bytes = None # leading bytes of files searched for interfile keys; None searches whole files
     max_calibration_filesize = 1e9 # bytes
+    batch_poll = 1.0 # sec between polls of running processes
+    kill_grace = 10.0 # sec between SIGTERM and SIGKILL of the process group of a job past its timeout
+    nprocs = 1 # concurrent processes of create_NAC, create_AC and stage_umaps
+    nslowest = 20 # entries per section of the profile report
+    nthreads = 8 # threads crawling experiments; 1 crawls serially with select_tracers and select_dates
     project = None
+    recon_command = ['singularity', 'exec', '--nv',
+                     '--bind', '{home}/hardwareumaps:/hardwareumaps',
+                     '--bind', '{home}:/SubjectsDir',
+                     '{home}/niftypetr-image_reconstruction.sif',
+                     'python', '/work/NiftyPETy/respet/recon/reconstruction.py',
+                     '-p', '/SubjectsDir/{relpath}', '-g', '0', '-v', 'false'] # formatted per tracer location
+    recon_outputs = os.path.join('output', 'PET', 'reconstruction_Reconstruction_finished.touch')
+    recon_timeout = 18*3600 # sec per tracer location
+    materialize_bf = True # create_NAC and create_AC decompress .bfz of xnatpet.compressedbf lacking their .bf
+    recompute = False # ignores the folder cache, e.g., after changing how values are extracted
+    screen_before_recon = True # create_NAC and create_AC skip tracer locations flagged by screen
+    screen_flags = ('aborted', 'truncated', 'abnormal') # statuses of screen_status flagged by screen
+    screen_log_name = 'list_screen_flagged.log' # in prjdir; tracer locations flagged by screen
+    screen_min_fraction = 0.95 # of interfile image duration spanned by elapsed-time tags; less is aborted
+    screen_outlier_fraction = 0.01 # of seconds with prompts far from their rolling median; more is abnormal
+    screen_rate_tolerance = 0.5 # relative distance of prompts from their rolling median marking an outlier
+    screen_window = 15 # sec of the rolling median
     tracers = ['FDG']
+    umap_command = ['singularity', 'exec',
+                    '--bind', '{home}:/SubjectsDir',
+                    '--bind', '/export:/export',
+                    '{home}/niftyumaps-image_construct_umaps.sif',
+                    '/work/run_ConstructUmapsApp.sh', '/export/matlab/MCR/R2018b/v95',
+                    '{prj}', '{ses}'] # formatted per session
+    umap_outputs = os.path.join('*-Converted-AC', 'umap', '*') # glob relative to the session marking completed umaps
+    umap_timeout = 3*3600 # sec per session
     use_only_cachedir = True
+    use_table = False # selects with vectorized masks over create_tracerloc_table
 
 
 
     def create_tracerloc_list(self):
         """containing calibration listmode, norm data"""
 
+        if self.use_table:
+            table = self.create_tracerloc_table()
+            return [str(f) for f in table['folder'][self.calibration_mask(table)]]
         elist = []
-        if self.use_only_cachedir:
-            for e in self.select_experiments():
-                for t in self.select_tracers(e):
-                    for d in self.select_dates(t):
-                        if self.consistent_duration(d): # and self.consistent_filesize(d):
-                            elist.append(d)
-        else:
-            raise NotImplementedError
+        self.load_folder_cache()
+        try:
+            if self.use_only_cachedir:
+                with self.metrics.timer('create_tracerloc_list', project=os.path.basename(self.prjdir)):
+                    if self.nthreads > 1:
+                        crawled = OrderedDict(self.crawl_experiments())
+                        exps = list(crawled.keys())
+                    else:
+                        crawled = None
+                        exps = self.select_experiments()
+                    for e in exps:
+                        self.exploc = e
+                        self.traloc = None
+                        with self.metrics.timer('experiment', experiment=os.path.basename(e)):
+                            if crawled is not None:
+                                tralocs = crawled[e]
+                            else:
+                                tralocs = [d for t in self.select_tracers(e) for d in self.select_dates(t)]
+                            for d in tralocs:
+                                self.traloc = d
+                                with self.metrics.timer('folder', experiment=os.path.basename(e),
+                                                        folder=os.path.basename(d)):
+                                    if self.is_calibration(d):
+                                        elist.append(d)
+                                self.traloc = None
+            else:
+                raise NotImplementedError
+        finally:
+            self.exploc = None
+            self.traloc = None
+            self.save_folder_cache()
+            if self.profile:
+                self.write_profile(self.profile)
         return elist
 
-    def create_NAC(self):
-        return None
+    def create_tracerloc_table(self):
+        """
+        extracts one row per tracer location of self.tracers, for all dates, using crawl and self.folder_cache
+        :return table as dict of equal-length numpy arrays:  session, tracer, folder, datetime (datetime64[s]),
+                duration (sec; nan without LM data), bf_size (bytes; -1 without .bf):
+        """
+        import numpy as np
+        rows = []
+        self.load_folder_cache()
+        try:
+            with self.metrics.timer('create_tracerloc_table', project=os.path.basename(self.prjdir)):
+                for e, tralocs in self.crawl_experiments(select_dates=False):
+                    for d in tralocs:
+                        try:
+                            v = self.calibration_values(d)
+                            dur = v['duration']
+                            bfs = v['bf_size'] if v['bf_size'] is not None else -1
+                        except IndexError: # no LM dcm
+                            dur = np.nan
+                            bfs = -1
+                        rows.append((os.path.basename(e), os.path.basename(d).split('_DT')[0], d,
+                                     self.traloc2datetime(d), dur, bfs))
+        finally:
+            self.save_folder_cache()
+        cols = list(zip(*rows)) if rows else [[]] * 6
+        return {'session':  np.array(cols[0], dtype=str),
+                'tracer':   np.array(cols[1], dtype=str),
+                'folder':   np.array(cols[2], dtype=str),
+                'datetime': np.array(cols[3], dtype='datetime64[s]'),
+                'duration': np.array(cols[4], dtype=float),
+                'bf_size':  np.array(cols[5], dtype=np.int64)}
 
-    def create_AC(self):
-        return None
+    def calibration_mask(self, table, daterange=None, calibration_duration=None, max_calibration_filesize=None):
+        """
+        applies the rules of is_calibration to all rows of table at once
+        :param table from create_tracerloc_table or load_table:
+        :param daterange; default is self.daterange:
+        :param calibration_duration; default is self.calibration_duration:
+        :param max_calibration_filesize; if given, also requires .bf size below it:
+        :return boolean numpy array:
+        """
+        import numpy as np
+        if daterange is None:
+            daterange = self.daterange
+        if calibration_duration is None:
+            calibration_duration = self.calibration_duration
+        dt = table['datetime']
+        mask = (dt >= np.datetime64(daterange[0], 's')) & (dt <= np.datetime64(daterange[1] or datetime.now(), 's'))
+        with np.errstate(invalid='ignore'):
+            mask &= table['duration'] < calibration_duration
+        if max_calibration_filesize is not None:
+            mask &= (table['bf_size'] >= 0) & (table['bf_size'] < max_calibration_filesize)
+        return mask
+
+    def save_table(self, table, fname):
+        """
+        :param table from create_tracerloc_table:
+        :param fname ending with .npz or, with pandas and pyarrow installed, .parquet:
+        :return fname:
+        """
+        if fname.endswith('.parquet'):
+            import pandas as pd
+            pd.DataFrame(table).to_parquet(fname)
+        else:
+            import numpy as np
+            np.savez(fname, **table)
+        return fname
+
+    def load_table(self, fname):
+        """
+        :param fname written by save_table:
+        :return table as dict of numpy arrays:
+        """
+        if fname.endswith('.parquet'):
+            import pandas as pd
+            df = pd.read_parquet(fname)
+            table = dict((c, df[c].values) for c in df.columns)
+            table['datetime'] = table['datetime'].astype('datetime64[s]')
+            return table
+        import numpy as np
+        with np.load(fname) as npz:
+            return dict((k, npz[k]) for k in npz.files)
+
+    def create_NAC(self, tralocs=None):
+        """
+        reconstructs the NAC tracer locations corresponding to tralocs with self.recon_command,
+        running self.nprocs processes at a time
+        :param tralocs; default is create_tracerloc_list():
+        :return list of results from run_batch:
+        """
+        return self.__create_recon(tralocs, 'NAC')
+
+    def create_AC(self, tralocs=None):
+        """
+        reconstructs the AC tracer locations corresponding to tralocs with self.recon_command, which needs umaps
+        :param tralocs; default is create_tracerloc_list():
+        :return list of results from run_batch:
+        """
+        return self.__create_recon(tralocs, 'AC')
 
     def stage_rawdata(self):
         return
 
-    def stage_umaps(self):
-        return
+    def stage_umaps(self, tralocs=None):
+        """
+        constructs umaps with self.umap_command for each session containing tralocs
+        :param tralocs; default is create_tracerloc_list():
+        :return list of results from run_batch:
+        """
+        if tralocs is None:
+            tralocs = self.create_tracerloc_list()
+        sessions = []
+        for t in tralocs:
+            ses = os.path.dirname(os.path.normpath(t))
+            if ses not in sessions:
+                sessions.append(ses)
+        jobs = [self.batch_job('stage_umaps', ses, self.umap_command, self.umap_outputs) for ses in sessions]
+        return self.run_batch(jobs, self.umap_timeout)
 
+    def batch_job(self, name, loc, command, outputs=None):
+        """
+        :param name of the job, also naming its log in loc:
+        :param loc is a session or tracer location within self.prjdir:
+        :param command is a list of str formatted with home, prj, ses, tracer, relpath and path of loc:
+        :param outputs is a glob relative to loc; if matched, the job is skipped:
+        :return dict describing the job for run_batch:
+        """
+        from glob2 import glob
+        path = os.path.abspath(loc)
+        relpath = os.path.relpath(path, os.path.abspath(self.cachedir))
+        parts = relpath.split(os.sep) + ['', '']
+        fields = {'home': os.path.abspath(self.cachedir), 'prj': parts[0], 'ses': parts[1],
+                  'tracer': parts[2], 'relpath': relpath, 'path': path}
+        return {'name': name,
+                'loc': path,
+                'args': [c.format(**fields) for c in command],
+                'log': os.path.join(path, name + '.log'),
+                'done': bool(outputs) and len(glob(os.path.join(path, outputs))) > 0}
+
+    def run_batch(self, jobs, timeout=None):
+        """
+        runs jobs from batch_job as local processes, no more than self.nprocs at a time, killing any
+        running longer than timeout; jobs already done are skipped
+        :param jobs:
+        :param timeout in sec per job; None waits indefinitely:
+        :return list of dicts with loc, status ('skipped', 'ok', 'failed', 'timeout'), returncode and wall,
+                ordered as jobs:
+        """
+        import subprocess
+        import time
+        results = []
+        pending = []
+        for j in jobs:
+            results.append({'name': j['name'], 'loc': j['loc'], 'status': 'skipped', 'returncode': None, 'wall': 0.0})
+            if not j['done']:
+                pending.append((len(results) - 1, j))
+        pending.reverse()
+        running = []
+        while pending or running:
+            while pending and len(running) < max(1, self.nprocs):
+                i, j = pending.pop()
+                log = open(j['log'], 'w')
+                try:
+                    proc = subprocess.Popen(j['args'], cwd=j['loc'], stdout=log, stderr=subprocess.STDOUT,
+                                            preexec_fn=os.setsid) # own process group, e.g., with singularity's children
+                except OSError as e:
+                    log.close()
+                    warn('Calibration.run_batch could not start %s: %s' % (j['args'][0], e))
+                    results[i]['status'] = 'failed'
+                    continue
+                running.append((i, proc, log, time.time()))
+            time.sleep(self.batch_poll)
+            still = []
+            for i, proc, log, t0 in running:
+                rc = proc.poll()
+                wall = time.time() - t0
+                if rc is None and timeout is not None and wall > timeout:
+                    rc = self.__kill_group(proc)
+                    results[i]['status'] = 'timeout'
+                elif rc is None:
+                    still.append((i, proc, log, t0))
+                    continue
+                else:
+                    results[i]['status'] = 'ok' if rc == 0 else 'failed'
+                log.close()
+                results[i]['returncode'] = rc
+                results[i]['wall'] = wall
+                print('%s:  %s %s after %.1f s' % (results[i]['name'], results[i]['loc'], results[i]['status'], wall))
+            running = still
+        return results
 
 
+
+    def crawl(self, stream=False):
+        """
+        finds the tracer locations of select_experiments, select_tracers and select_dates
+        using scandir on a pool of self.nthreads threads, one task per experiment
+        :param stream; if True, returns a generator yielding tracer locations as each experiment is crawled:
+        :return tracer locations, consistent with calibration dates, as list ordered as select_experiments:
+        """
+        if stream:
+            return (d for e, tralocs in self.crawl_experiments(stream=True) for d in tralocs)
+        return [d for e, tralocs in self.crawl_experiments() for d in tralocs]
+
+    def crawl_experiments(self, stream=False, select_dates=True):
+        """
+        :param stream; if True, returns a generator yielding pairs as experiments complete, in no fixed order:
+        :param select_dates; if False, includes tracer locations inconsistent with self.daterange:
+        :return (experiment location, tracer locations) pairs as list ordered as select_experiments:
+        """
+        from functools import partial
+        from multiprocessing.pool import ThreadPool
+        exps = self.select_experiments()
+        crawl1 = partial(self.__crawl_experiment, select_dates=select_dates)
+        if stream:
+            return self.__stream_experiments(crawl1, exps)
+        pool = ThreadPool(max(1, min(self.nthreads, len(exps))))
+        try:
+            return pool.map(crawl1, exps)
+        finally:
+            pool.close()
+            pool.join()
+
+    @timed('glob')
     def select_experiments(self):
         """
-        :return experiment locations as list:
+        :return experiment locations as list, sorted:
         """
         selection = []
-        listprj = os.listdir(self.prjdir)
+        listprj = sorted(os.listdir(self.prjdir))
         for l in listprj:
             if "ses-" in l:
                 selection.append(os.path.join(self.prjdir, l))
@@ -100,22 +376,17 @@ class Calibration(object):
         return os.path.splitext(dcmloc)[0] + '.bf'
 
     def consistent_date(self, traloc):
-        import re
-        p = re.compile("\w+_DT(\d+).(\d+)\w*")
-        trafld = os.path.basename(traloc)
-        result = p.search(trafld)
-        dt = datetime.strptime(result.group(1), '%Y%m%d%H%M%S')
-        return self.daterange[0] <= dt and dt <= self.daterange[1]
+        return self.in_daterange(self.traloc2datetime(traloc))
+
+    def in_daterange(self, dt):
+        """
+        :param dt is a datetime:
+        :return bool; an upper bound of self.daterange that is None is now:
+        """
+        return self.daterange[0] <= dt and dt <= (self.daterange[1] or datetime.now())
 
     def consistent_duration(self, traloc):
-        dcm = self.dcm_for_calibration(traloc)
-        try:
-            dur = self.ifh_imageduration(dcm)
-            if not dur:
-                dur = self.dcm2duration(dcm)
-        except TypeError:
-            dur = self.dcm2duration(dcm)
-        assert(self.isnumeric(dur))
+        dur = self.image_duration(self.dcm_for_calibration(traloc))
         return dur < self.calibration_duration
 
     def consistent_filesize(self, traloc):
@@ -125,6 +396,186 @@ class Calibration(object):
 
 
 
+    # SCREENING ########################################################
+
+    def screen(self, tralocs=None):
+        """
+        screens the LM .bf of tralocs for aborted, truncated or abnormal acquisitions before reconstruction, on a pool
+        of self.nthreads threads, and lists flagged tracer locations in prjdir/screen_log_name
+        :param tralocs; default is create_tracerloc_list():
+        :return list of dicts from screen_status, ordered as tralocs:
+        """
+        from multiprocessing.pool import ThreadPool
+        if tralocs is None:
+            tralocs = self.create_tracerloc_list()
+        if not tralocs:
+            return []
+        self.load_folder_cache()
+        pool = ThreadPool(max(1, min(self.nthreads, len(tralocs))))
+        try:
+            results = pool.map(self.screen_status, tralocs)
+        finally:
+            pool.close()
+            pool.join()
+            self.save_folder_cache()
+        flagged = [r for r in results if r['status'] in self.screen_flags]
+        if os.path.isdir(self.prjdir):
+            with open(os.path.join(self.prjdir, self.screen_log_name), 'w') as f:
+                for r in flagged:
+                    f.write('%s %s duration %.1f of %s sec, %d gaps, %d outliers\n' %
+                            (r['traloc'], r['status'], r['duration'], r['image_duration'], r['gaps'], r['outliers']))
+        for r in flagged:
+            warn('Calibration.screen flagged %s as %s' % (r['traloc'], r['status']))
+        return results
+
+    def screen_status(self, traloc):
+        """
+        :param traloc is the tracer location:
+        :return dict with traloc, status ('ok', 'aborted', 'truncated', 'abnormal' or 'unscreened' without LM data),
+                image_duration and the measures of screen_measures:
+        """
+        res = {'traloc': traloc, 'status': 'unscreened', 'image_duration': None, 'duration': 0.0, 'gaps': 0,
+               'outliers': 0, 'seconds': 0, 'truncated': False, 'words': 0, 'prompts': 0, 'delays': 0}
+        try:
+            ent = self.calibration_values(traloc)
+        except IndexError: # no LM dcm
+            return res
+        if ent['bf_size'] is None:
+            res['image_duration'] = ent['duration']
+            return res
+        if 'screen' not in ent:
+            ent['screen'] = self.screen_measures(self.bf_for_calibration(ent['dcm']))
+            self.__folder_cache_dirty = True
+        res.update(ent['screen'])
+        res['image_duration'] = ent['duration']
+        if res['truncated']:
+            res['status'] = 'truncated'
+        elif res['duration'] < self.screen_min_fraction * ent['duration']:
+            res['status'] = 'aborted'
+        elif res['gaps'] or res['outliers'] > self.screen_outlier_fraction * max(res['seconds'], 1):
+            res['status'] = 'abnormal'
+        else:
+            res['status'] = 'ok'
+        return res
+
+    @timed('screen')
+    def screen_measures(self, bf):
+        """
+        :param bf is the LM .bf:
+        :return dict with duration spanned by elapsed-time tags (sec), truncated, words, prompts, delays, and, for the
+                whole seconds of the acquisition, their number, gaps without prompts and outliers, whose prompts
+                differ from their rolling median of screen_window sec by more than screen_rate_tolerance:
+        """
+        import numpy as np
+        from listmode import Listmode
+        lm = Listmode(bf)
+        self.metrics.count(bytes=os.path.getsize(bf_path(bf)))
+        cr = lm.count_rates()
+        m = {'duration': cr.duration, 'truncated': lm.truncated, 'words': cr.words,
+             'prompts': int(cr.prompts.sum()), 'delays': int(cr.delays.sum()), 'seconds': 0, 'gaps': 0, 'outliers': 0}
+        if cr.last_ms is None:
+            return m
+        p = cr.prompts[cr.first_ms // 1000 + 1:cr.last_ms // 1000] # whole seconds
+        m['seconds'] = len(p)
+        m['gaps'] = int(np.count_nonzero(p == 0))
+        if len(p) >= self.screen_window:
+            from numpy.lib.stride_tricks import as_strided
+            h = self.screen_window // 2
+            padded = np.pad(p, (h, self.screen_window - 1 - h), 'edge')
+            windows = as_strided(padded, shape=(len(p), self.screen_window), strides=padded.strides * 2)
+            med = np.median(windows, axis=1)
+            m['outliers'] = int(np.count_nonzero(np.abs(p - med) > self.screen_rate_tolerance * med))
+        return m
+
+
+
+    # FOLDER CACHE #####################################################
+
+    def is_calibration(self, traloc):
+        """
+        evaluates consistent_date and consistent_duration using self.folder_cache;
+        consistent_filesize is recorded but not required
+        :param traloc is the tracer location:
+        :return bool:
+        """
+        ent = self.calibration_values(traloc)
+        rules = self.calibration_rules()
+        if ent.get('rules') != rules:
+            ent['verdicts'] = {
+                'date': self.in_daterange(datetime.strptime(ent['date'], '%Y%m%d%H%M%S')),
+                'duration': ent['duration'] < self.calibration_duration,
+                'filesize': ent['bf_size'] is not None and ent['bf_size'] < self.max_calibration_filesize}
+            ent['rules'] = rules
+            self.__folder_cache_dirty = True
+        v = ent['verdicts']
+        return v['date'] and v['duration'] # and v['filesize']
+
+    def calibration_values(self, traloc):
+        """
+        :param traloc is the tracer location:
+        :return dict with date, image duration (sec) and .bf size (bytes) of the LM data of traloc, read from
+                self.folder_cache unless the mtimes of the LM .dcm/.bf have changed or self.recompute:
+        """
+        dcm = self.dcm_for_calibration(traloc)
+        bf = self.bf_for_calibration(dcm)
+        stamp = [dcm, self.__mtime(dcm), self.__mtime(bf_path(bf))]
+        ent = self.folder_cache.get(traloc)
+        if not self.recompute and ent and ent['stamp'] == stamp:
+            self.metrics.count(cache_hits=1)
+            return ent
+        ent = {'stamp': stamp,
+               'dcm': dcm,
+               'date': self.traloc2datetime(traloc).strftime('%Y%m%d%H%M%S'),
+               'duration': self.image_duration(dcm),
+               'bf_size': self.size_of_bf(bf) if stamp[2] is not None else None}
+        self.folder_cache[traloc] = ent
+        self.__folder_cache_dirty = True
+        return ent
+
+    def calibration_rules(self):
+        """
+        :return the settings of verdicts in self.folder_cache, as serialized:
+        """
+        return {'daterange': [d.strftime('%Y%m%d%H%M%S') if d else None for d in self.daterange],
+                'calibration_duration': self.calibration_duration,
+                'max_calibration_filesize': self.max_calibration_filesize}
+
+    def load_folder_cache(self):
+        """
+        reads self.folder_cache from prjdir/folder_cache_name, if it exists
+        :return self.folder_cache:
+        """
+        import json
+        fname = os.path.join(self.prjdir, self.folder_cache_name)
+        if os.path.isfile(fname) and not self.folder_cache:
+            try:
+                with open(fname, 'r') as f:
+                    self.folder_cache = json.load(f)
+            except ValueError as e:
+                warn('Calibration.load_folder_cache ignored %s: %s' % (fname, e))
+        return self.folder_cache
+
+    def save_folder_cache(self):
+        """
+        writes self.folder_cache to prjdir/folder_cache_name, if changed
+        """
+        import json
+        if not self.__folder_cache_dirty or not os.path.isdir(self.prjdir):
+            return
+        fname = os.path.join(self.prjdir, self.folder_cache_name)
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(self.folder_cache, f, indent=1, sort_keys=True)
+        os.rename(fname + '.tmp', fname)
+        self.__folder_cache_dirty = False
+
+    def __mtime(self, fn):
+        try:
+            return os.path.getmtime(fn)
+        except OSError:
+            return None
+
+
+
     # UTITILIES ########################################################
 
     def bin2str(self, stream):
@@ -137,13 +588,27 @@ class Calibration(object):
         data = stream.read()
         return pattern.findall(data)
 
+    @timed('listmode')
+    def count_rates(self, traloc):
+        """
+        :param traloc is the tracer location:
+        :return xnatpet.listmode.CountRates of the LM .bf of traloc, as prompts and delays per second:
+        """
+        from listmode import Listmode
+        bf = self.bf_for_calibration(self.dcm_for_calibration(traloc))
+        self.metrics.count(bytes=os.path.getsize(bf_path(bf)))
+        return Listmode(bf).count_rates()
+
+    @timed('glob')
     def dcm_for_calibration(self, traloc):
         """
         :param traloc is the tracer location:
         :return dcm filename:
         """
+        if traloc in self.lm_dcms:
+            return self.lm_dcms[traloc]
         from glob2 import glob
-        dcms = glob(os.path.join(traloc, 'LM', '*.dcm'))
+        dcms = sorted(glob(os.path.join(traloc, 'LM', '*.dcm')))
         return dcms[-1] # non-last elements may have been aborted early
 
     def dcm2duration0(self, dcm):
@@ -153,6 +618,7 @@ class Calibration(object):
         result = pattern.search(dcmob.SeriesDescription)
         return int(result.group(1))
 
+    @timed('dicom')
     def dcm2duration(self, dcm):
         """https://stackoverflow.com/questions/7852855/in-python-how-do-you-convert-a-datetime-object-to-seconds"""
         from datetime import datetime
@@ -161,15 +627,41 @@ class Calibration(object):
         t0 = datetime.strptime(dcmobj.AcquisitionTime, '%H%M%S.%f')
         return (t1 - t0).total_seconds()
 
+    @timed('extract')
+    def extract_window(self, traloc, dest, start=0, stop=None):
+        """
+        writes the LM data of traloc within a time window to dest, so that calibrations reconstruct only the leading
+        calibration_duration instead of the whole acquisition
+        :param traloc is the tracer location:
+        :param dest is a directory for the .bf and .dcm, other than the LM folder of traloc, e.g., the LM folder of a
+                    new tracer location for calibration:
+        :param start sec after the first elapsed-time tag:
+        :param stop sec after the first elapsed-time tag; default is start + self.calibration_duration:
+        :return (.bf written, words written):
+        """
+        from listmode import Listmode
+        if stop is None:
+            stop = start + self.calibration_duration
+        bf = self.bf_for_calibration(self.dcm_for_calibration(traloc))
+        if not os.path.isdir(dest):
+            os.makedirs(dest)
+        bf1, nwords = Listmode(bf).extract(os.path.join(dest, os.path.basename(bf)), start, stop)
+        self.metrics.count(bytes=4 * nwords)
+        return bf1, nwords
+
+    @timed('interfile')
     def get_interfile(self, dcm):
         """
         :param dcm:
         :return lm_dict, a dictionary of interfile fields:
         """
-        from interfile import Interfile
         try:
-            lm_dict = Interfile.load(dcm)
-        except (AttributeError, TypeError):
+            if interfile_cache.cached(dcm):
+                self.metrics.count(cache_hits=1)
+            else:
+                self.metrics.count(bytes=os.path.getsize(dcm))
+            lm_dict = interfile_cache.get(dcm)
+        except (AttributeError, TypeError, OSError):
             raise AssertionError('dcm must be a filename')
         return lm_dict
 
@@ -181,33 +673,218 @@ class Calibration(object):
         except Interfile.ParsingError:
             return self.search_image_duration_value(dcm)
 
+    def image_duration(self, dcm):
+        """
+        :param dcm:
+        :return image duration in sec from the Sidecar of its tracer folder, else from interfile, else from DICOM times:
+        """
+        ent = self.sidecar_entry(dcm)
+        if ent and ent.get('petlink', {}).get('image_duration'):
+            return ent['petlink']['image_duration']
+        try:
+            dur = self.ifh_imageduration(dcm)
+            if not dur:
+                dur = self.dcm2duration(dcm)
+        except TypeError:
+            dur = self.dcm2duration(dcm)
+        assert(self.isnumeric(dur))
+        return dur
+
     def isnumeric(self, x):
         # https://stackoverflow.com/questions/4187185/how-can-i-check-if-my-python-object-is-a-number
         import numbers
         import decimal
         return bool([isinstance(x, numbers.Number) for x in (0, 0.0, 0j, decimal.Decimal(0))])
 
+    @timed('materialize')
+    def materialize(self, loc):
+        """
+        decompresses each .bfz within loc lacking its .bf, e.g., before reconstruction
+        :param loc is a tracer location:
+        :return list of .bf written:
+        """
+        bfs = []
+        for dirpath, dirnames, files in os.walk(loc):
+            for f in sorted(files):
+                bf = os.path.join(dirpath, os.path.splitext(f)[0] + '.bf')
+                if f.endswith('.bfz') and not os.path.exists(bf):
+                    bfs.append(CompressedBf(os.path.join(dirpath, f)).decompress(bf))
+                    self.metrics.count(bytes=os.path.getsize(bf))
+        return bfs
+
     def search_image_duration_value(self, dcm):
+        """
+        :param dcm containing an interfile header, e.g., in a private tag:
+        :return image duration in sec:
+        """
         import re
-        p = re.compile("image duration \(sec\) :=(\d+)")
-        d = open(dcm, mode='rb')
-        string = self.bin2str(d)
-        result = p.search(string)
-        assert(result.group(1))
+        value = self.search_interfile_value(dcm, 'image duration (sec)')
+        result = re.match('(\d+)', value or '')
+        assert(result), 'image duration not found in %s' % dcm
         return int(result.group(1))
 
+    @timed('interfile_search')
+    def search_interfile_value(self, fname, key):
+        """
+        scans memory-mapped fname for the first occurrence of 'key :=', reading no more than self.header_scan_bytes
+        :param fname is any file containing interfile lines, e.g., DICOM with private tag (0029,1010):
+        :param key, e.g., 'image duration (sec)':
+        :return value string following 'key :=' up to the end of its line, or None:
+        """
+        import mmap
+        token = (key + ' :=').encode('ascii')
+        with open(fname, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return None
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                end = min(size, self.header_scan_bytes) if self.header_scan_bytes else size
+                i = mm.find(token, 0, end)
+                if i < 0:
+                    self.metrics.count(bytes=end)
+                    return None
+                i += len(token)
+                line = mm[i:min(i + 256, size)]
+                self.metrics.count(bytes=i + len(line))
+            finally:
+                mm.close()
+        for eol in (b'\r', b'\n', b'\x00'):
+            line = line.split(eol)[0]
+        return line.strip().decode('ascii', 'replace')
+
+    @timed('sidecar')
+    def sidecar_entry(self, fn):
+        """
+        :param fn is a file of a tracer folder, or of its LM/ or norm/ subfolders:
+        :return dict recorded for fn by StageXnat.move_rawdata in xnatpet.sidecar.Sidecar, if fn is unchanged since,
+                else None:
+        """
+        sc = Sidecar.find(fn)
+        ent = sc.entry(fn) if sc else None
+        if ent:
+            self.metrics.count(cache_hits=1)
+        return ent
+
+    @timed('stat')
     def size_of_bf(self, fn):
         """
         :param fileprefix with any single extension:
-        :return size of bf file in bytes:
+        :return size of bf file in bytes, decompressed if stored as .bfz:
         """
-        sinfo = os.stat(os.path.splitext(fn)[0] + '.bf')
-        return sinfo.st_size
+        return raw_size(os.path.splitext(fn)[0] + '.bf')
 
+    def traloc2datetime(self, traloc):
+        """
+        :param traloc, e.g., /path/to/FDG_DT20180202140741.000000-Converted-NAC:
+        :return datetime:
+        """
+        import re
+        p = re.compile("\w+_DT(\d+).(\d+)\w*")
+        trafld = os.path.basename(traloc)
+        result = p.search(trafld)
+        return datetime.strptime(result.group(1), '%Y%m%d%H%M%S')
+
+    @timed('glob')
     def tracer_locations(self, exploc, tracer):
         from glob2 import glob
         assert (os.path.exists(exploc))
-        return glob(os.path.join(exploc, tracer.upper() + '_DT*.*-Converted-*AC'))
+        return sorted(glob(os.path.join(exploc, tracer.upper() + '_DT*.*-Converted-*AC')))
+
+    def __kill_group(self, proc):
+        """
+        sends SIGTERM to the process group of proc, then, after proc exits or self.kill_grace passes, SIGKILL to any
+        of the group remaining
+        :param proc is a subprocess.Popen started by run_batch in its own process group:
+        :return returncode of proc:
+        """
+        import signal
+        import time
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except OSError:
+            pass # the group has exited
+        t0 = time.time()
+        while proc.poll() is None and time.time() - t0 < self.kill_grace:
+            time.sleep(min(self.batch_poll, 0.1))
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        return proc.wait()
+
+    def __create_recon(self, tralocs, ac):
+        """
+        :param tralocs; default is create_tracerloc_list():
+        :param ac is 'NAC' or 'AC':
+        :return list of results from run_batch:
+        """
+        import re
+        if tralocs is None:
+            tralocs = self.create_tracerloc_list()
+        if self.screen_before_recon:
+            flagged = [r['traloc'] for r in self.screen(tralocs) if r['status'] in self.screen_flags]
+            tralocs = [t for t in tralocs if t not in flagged]
+        locs = []
+        for t in tralocs:
+            loc = re.sub('-Converted-N?AC$', '-Converted-' + ac, os.path.normpath(t))
+            if loc not in locs: # -Converted-NAC and -Converted-AC of one scan name the same loc
+                locs.append(loc)
+        jobs = []
+        for loc in locs:
+            if not os.path.isdir(loc):
+                warn('Calibration.create_%s found no %s' % (ac, loc))
+                continue
+            j = self.batch_job('create_' + ac, loc, self.recon_command, self.recon_outputs)
+            if self.materialize_bf and not j['done']:
+                self.materialize(loc)
+            started = os.path.join(loc, 'output', 'PET', 'reconstruction_Reconstruction_started.touch')
+            if not j['done'] and os.path.exists(started):
+                os.remove(started) # stale from an interrupted reconstruction
+            jobs.append(j)
+        return self.run_batch(jobs, self.recon_timeout)
+
+    def __crawl_experiment(self, exp, select_dates=True):
+        """
+        scans exp and the LM folders of its tracer locations once each, recording the last LM dcm in self.lm_dcms
+        :param exp is experiment location:
+        :param select_dates:
+        :return (exp, tracer locations, consistent with calibration dates if select_dates):
+        """
+        import fnmatch
+        try:
+            from os import scandir
+        except ImportError:
+            from scandir import scandir
+        with self.metrics.timer('glob', experiment=os.path.basename(exp)):
+            names = sorted(ent.name for ent in scandir(exp))
+            tralocs = []
+            for t in self.tracers:
+                pattern = t.upper() + '_DT*.*-Converted-*AC'
+                for n in names:
+                    if fnmatch.fnmatchcase(n, pattern) and (not select_dates or self.consistent_date(n)):
+                        tralocs.append(os.path.join(exp, n))
+            for d in tralocs:
+                try:
+                    dcms = sorted(ent.path for ent in scandir(os.path.join(d, 'LM')) if ent.name.endswith('.dcm'))
+                except OSError:
+                    dcms = []
+                if dcms:
+                    self.lm_dcms[d] = dcms[-1]
+        return exp, tralocs
+
+    def __stream_experiments(self, crawl1, exps):
+        """
+        owns its pool, so that the pool starts with the first pair requested and terminates when the generator is
+        exhausted, closed or collected
+        """
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(max(1, min(self.nthreads, len(exps))))
+        try:
+            for pair in pool.imap_unordered(crawl1, exps):
+                yield pair
+        finally:
+            pool.terminate()
 
     def __get_dicom(self, dcm):
         """
@@ -216,20 +893,90 @@ class Calibration(object):
         """
         from pydicom import dcmread
         try:
+            self.metrics.count(bytes=os.path.getsize(dcm))
             dcm_datset = dcmread(dcm)
-        except (AttributeError, TypeError):
+        except (AttributeError, TypeError, OSError):
             raise AssertionError('dcm must be a filename')
         return dcm_datset
 
 
 
-    def __init__(self, user, password, cachedir="/scratch/jjlee/Singularity", prj="CCIR_00754"):
+    # PROFILING ########################################################
+
+    def metrics_fields(self):
+        """
+        :return fields identifying the current experiment and tracer folder for records of self.metrics:
+        """
+        fields = {}
+        if self.exploc:
+            fields['experiment'] = os.path.basename(self.exploc)
+        if self.traloc:
+            fields['folder'] = os.path.basename(self.traloc)
+        return fields
+
+    def profile_report(self, nslowest=None):
+        """
+        :param nslowest is the number of entries reported for experiments and folders; default is self.nslowest:
+        :return dict with totals per phase and the slowest experiments and tracer folders,
+                each with wall time, bytes and the wall time of its glob, interfile, dicom and stat calls:
+        """
+        if not nslowest:
+            nslowest = self.nslowest
+        records = self.metrics.records
+        calls = [r for r in records if r['phase'] not in ('create_tracerloc_list', 'experiment', 'folder')]
+
+        def entry(rec, keys):
+            e = dict((k, rec[k]) for k in keys)
+            e['wall'] = rec['wall']
+            e['bytes'] = rec['bytes']
+            if 'error' in rec:
+                e['error'] = rec['error']
+            sub = [r for r in calls if all(r.get(k) == rec[k] for k in keys)]
+            e['phases'] = dict((p, s['wall']) for p, s in self.metrics.summary(sub).items())
+            return e
+
+        exps = self.metrics.slowest('experiment', nslowest)
+        flds = self.metrics.slowest('folder', nslowest)
+        return {'project': os.path.basename(self.prjdir),
+                'phases': self.metrics.summary(),
+                'slowest_experiments': [entry(r, ('experiment',)) for r in exps],
+                'slowest_folders': [entry(r, ('experiment', 'folder')) for r in flds]}
+
+    def write_profile(self, fname, nslowest=None):
+        """
+        writes self.profile_report() as JSON and prints the slowest tracer folders
+        :param fname is the report filename:
+        :param nslowest:
+        :return fname:
+        """
+        import json
+        rep = self.profile_report(nslowest)
+        with open(fname, 'w') as f:
+            json.dump(rep, f, indent=2, sort_keys=True)
+        self.metrics.print_summary()
+        print('\n%-40s %-60s %10s %14s' % ('experiment', 'folder', 'wall (s)', 'bytes'))
+        for e in rep['slowest_folders']:
+            print('%-40s %-60s %10.3f %14d' % (e['experiment'], e['folder'], e['wall'], e['bytes']))
+        print('\nwrote profile of %s to %s' % (rep['project'], fname))
+        return fname
+
+
+
+    def __init__(self, user, password, cachedir="/scratch/jjlee/Singularity", prj="CCIR_00754", profile=None):
         """
         :param user:
         :param password:
         :param cachedir is the preferred cache directory:
         :param prj:
+        :param profile is a JSON report, written by create_tracerloc_list, of time and I/O per experiment and folder:
         """
+        self.profile  = os.path.abspath(profile) if profile else None
+        self.metrics  = Metrics()
+        self.exploc   = None
+        self.traloc   = None
+        self.lm_dcms  = {} # tracer location -> last LM dcm, found by crawl
+        self.folder_cache = {} # tracer location -> values and verdicts, persisted in prjdir
+        self.__folder_cache_dirty = False
         self.host     = 'https://cnda.wustl.edu'
         self.user     = user #os.getenv('CNDA_UID')
         self.password = password #os.getenv('CNDA_PWD')
@@ -267,7 +1014,7 @@ def main():
         '''),
         formatter_class=argparse.RawTextHelpFormatter)
     p.add_argument('-m', '--method',
-                   metavar='create_tracerloc_list|create_NAC|create_AC',
+                   metavar='create_tracerloc_list|create_tracerloc_table|screen|create_NAC|create_AC',
                    type=str,
                    default='create_tracerloc_list')
     p.add_argument('-c', '--cachedir',
@@ -279,15 +1026,43 @@ def main():
                    metavar='CCIR_00754',
                    type=str,
                    default='CCIR_00754')
+    p.add_argument('-n', '--nprocs',
+                   help='concurrent processes of create_NAC, create_AC',
+                   type=int,
+                   default=1)
+    p.add_argument('--recompute',
+                   help='ignores cached values and verdicts of tracer folders',
+                   action='store_true')
+    p.add_argument('--table',
+                   metavar='<table.npz>',
+                   help='file for create_tracerloc_table; .parquet requires pandas',
+                   type=str,
+                   default='tracerloc_table.npz')
+    p.add_argument('--profile',
+                   metavar='<report.json>',
+                   help='reports time and I/O of create_tracerloc_list per experiment and tracer folder',
+                   type=str,
+                   default=None)
     args = p.parse_args()
+    table = os.path.abspath(args.table)
 
-    c = Calibration(os.getenv('CNDA_UID'), os.getenv('CNDA_PWD'), cachedir=args.cachedir, prj=args.project)
+    c = Calibration(os.getenv('CNDA_UID'), os.getenv('CNDA_PWD'), cachedir=args.cachedir, prj=args.project,
+                    profile=args.profile)
+    c.recompute = args.recompute
+    c.nprocs = args.nprocs
     if args.method.lower() == 'create_ac':
         print('main.args.method->create_AC')
         c.create_AC()
     elif args.method.lower() == 'create_nac':
         print('main.args.method->create_NAC')
         c.create_NAC()
+    elif args.method.lower() == 'screen':
+        print('main.args.method->screen')
+        for r in c.screen():
+            print('%-100s %-10s %10.1f s' % (r['traloc'], r['status'], r['duration']))
+    elif args.method.lower() == 'create_tracerloc_table':
+        print('main.args.method->create_tracerloc_table')
+        c.save_table(c.create_tracerloc_table(), table)
     else:
         print('main.args.method->create_tracerloc_list')
         c.create_tracerloc_list()
@@ -4,6 +4,11 @@ import pyxnat
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 from warnings import warn
+from metrics import Metrics, timed
+from objectstore import ObjectStore
+from cachemanager import CacheManager
+from petlink import petlink_cache
+from sidecar import Sidecar
 
 
 
@@ -14,34 +19,134 @@ class StageXnat(object):
     __author__ = "John J. Lee"
     __copyright__ = "Copyright 2019"
 
-    project = None
-    subject = None
-    session = None
-    scan = None
     sleep_duration = 600 # secs
     tracers = ['Oxygen-water', 'Carbon', 'Oxygen', 'Fluorodeoxyglucose']
     debug_uri = False
+    url_retries = 0 # for __get_url on connection errors and timeouts
+    block_size = 1024 # bytes for streaming downloads
+    probe_bytes = 65536 # leading bytes of a DICOM read to find its modality
+    skip_xsitypes = ('xnat:scScanData', 'xnat:srScanData', 'xnat:otherDicomScanData') # secondary, report, non-imaging
+    skip_modalities = ('SC', 'SR', 'KO', 'PR', 'DOC')
+    freesurfer_mri = ('*.mgz',) # fnmatch patterns, relative to freesurfer's mri/, of files that stage_freesurfer stages
+    download_threads = 8 # concurrent file downloads of stage_freesurfer
+    use_objectstore = False # hardlinks staged files from an ObjectStore in cachedir, keeping each content once
+    cache_quota = None # bytes of cachedir; if set, stage_session first evicts least-recently-used processed folders
+    compress_bf = False # move_rawdata stores .bf as .bfz, compressed in chunks by xnatpet.compressedbf
+    write_sidecar = True # move_rawdata records parsed fields, sizes and checksums of tracer folders in a Sidecar
+    stack_umaps = False # stage_umaps stacks each umap series into umap.npz within its folder by xnatpet.umapvolume
     DO_pull_rawdata = True
     DO_stage_umaps = True
     DO_stage_freesurfer = True
 
+    @property
+    def xnat(self):
+        """is the pyxnat Interface, created on first access since pyxnat inspects the server when constructed"""
+        if self.__xnat is None:
+            self.__xnat = pyxnat.Interface(self.host, user=self.user, password=self.password, cachedir=self.cachedir)
+            assert(isinstance(self.__xnat, pyxnat.core.interfaces.Interface))
+            self.__xnat._http.hooks['response'].append(self.__count_response)
+        return self.__xnat
+
+    @xnat.setter
+    def xnat(self, interface):
+        self.__xnat = interface
+
+    @property
+    def project(self):
+        if self.__project is None:
+            self.__project = self.xnat.select.project(self.__ids['prj'])
+            assert(isinstance(self.__project, pyxnat.core.resources.Project))
+        return self.__project
+
+    @project.setter
+    def project(self, prj):
+        self.__project = prj
+
+    @property
+    def subject(self):
+        """is the subject given to the constructor, else all subjects of the project"""
+        if self.__subject is None:
+            if self.__ids['sbj']:
+                self.__subject = self.project.subject(self.__ids['sbj'])
+                assert(isinstance(self.__subject, pyxnat.core.resources.Subject))
+            else:
+                self.__subject = self.project.subjects()
+                assert(isinstance(self.__subject, pyxnat.resources.Subjects))
+        return self.__subject
+
+    @subject.setter
+    def subject(self, sbj):
+        self.__subject = sbj
+
+    @property
+    def session(self):
+        """is the experiment given to the constructor, else all experiments of the subject"""
+        if self.__session is None:
+            if self.__ids['ses']:
+                self.__session = self.subject.experiment(self.__ids['ses'])
+                assert(isinstance(self.__session, pyxnat.core.resources.Experiment))
+            else:
+                self.__session = self.subject.experiments()
+                assert(isinstance(self.__session, pyxnat.core.resources.Experiments))
+        return self.__session
+
+    @session.setter
+    def session(self, ses):
+        self.__session = ses
+
+    @property
+    def scan(self):
+        """is the scan given to the constructor, else all scans of the session"""
+        if self.__scan is None:
+            if self.__ids['scn']:
+                self.__scan = self.session.scan(str(self.__ids['scn']))
+                assert(isinstance(self.__scan, pyxnat.core.resources.Scan))
+            else:
+                self.__scan = self.session.scans()
+                assert(isinstance(self.__scan, pyxnat.core.resources.Scans))
+        return self.__scan
+
+    @scan.setter
+    def scan(self, scn):
+        self.__scan = scn
+
+    @property
+    def scan_dicom(self):
+        if self.__scan_dicom is None:
+            self.__scan_dicom = self.scan.resource('DICOM')
+        return self.__scan_dicom
+
+    @property
+    def rawdata(self):
+        if self.__rawdata is None:
+            self.__rawdata = self.session.resource('RawData')
+        return self.__rawdata
+
     @property
     def str_project(self):
+        if self.__project is None:
+            return self.__ids['prj']
         assert(isinstance(self.project, pyxnat.core.resources.Project))
         return self.project._urn
 
     @property
     def str_subject(self):
+        if self.__subject is None and self.__ids['sbj']:
+            return self.__ids['sbj']
         assert(isinstance(self.subject, pyxnat.core.resources.Subject))
         return self.subject._urn
 
     @property
     def str_session(self):
+        if self.__session is None and self.__ids['ses']:
+            return self.__ids['ses']
         assert(isinstance(self.session, pyxnat.core.resources.Experiment))
         return self.session._urn
 
     @property
     def str_scan(self):
+        if self.__scan is None and self.__ids['scn']:
+            return str(self.__ids['scn'])
         assert(isinstance(self.scan, pyxnat.core.resources.Scan))
         return self.scan._urn
 
@@ -108,12 +213,12 @@ class StageXnat(object):
     def sessions(self, prj=None, glob='*'):
         """
         :param prj:
-        :return all pyxnat.experiments_list for project:
+        :return all pyxnat.experiments for project:
         """
         if prj:
             assert(isinstance(prj, pyxnat.core.resources.Project))
             self.project = prj
-        return self.project.experiments_list(glob)
+        return self.project.experiments(glob)
 
     def scans(self, ses=None, glob='*'):
         """
@@ -129,6 +234,7 @@ class StageXnat(object):
 
     # SORTING #########################################################################
 
+    @timed('sort_rawdata')
     def sort_rawdata(self, ses=None, tracer='Fluorodeoxyglucose'):
         """
         arranges session rawdata as .dcm files in class param dir_rawdata and
@@ -156,6 +262,7 @@ class StageXnat(object):
             warn(e.message)
         return dests
 
+    @timed('sort_files_rawdata')
     def sort_files_rawdata(self, ses=None, ds0='*.dcm', tracer='Fluorodeoxyglucose'):
         """
         downloads .bf files from the session resources RawData to class param dir_rawdata
@@ -192,6 +299,7 @@ class StageXnat(object):
 
     # STAGING #########################################################################
 
+    @timed('stage_constraints')
     def stage_constraints(self, constraints=[('xnat:petSessionData/DATE', '<', '2018-01-01'), 'AND'], modal='pet'):
         """"""
         tbl = self.xnat.select(
@@ -204,6 +312,7 @@ class StageXnat(object):
             self.stage_session(self.session)
         return
 
+    @timed('stage_project')
     def stage_project(self, constraints=None, modal='pet'):
         """
         https://groups.google.com/forum/#!topic/xnat_discussion/SHWAxHNb570
@@ -219,8 +328,10 @@ class StageXnat(object):
             except Exception as e:
                 warn(e.message)
         self.xnat.disconnect()
+        self.metrics.print_summary()
         return
 
+    @timed('stage_subject')
     def stage_subject(self, sbj=None):
         """
         https://groups.google.com/forum/#!topic/xnat_discussion/SHWAxHNb570
@@ -231,8 +342,7 @@ class StageXnat(object):
         if sbj:
             assert(isinstance(sbj, pyxnat.core.resources.Subject))
             self.subject = sbj
-        # subject.experiments_list() invalid
-        for s in self.subject.experiments_list():
+        for s in self.subject.experiments():
             assert(isinstance(s, pyxnat.core.resources.Experiment))
             try:
                 self.stage_session(s)
@@ -240,6 +350,7 @@ class StageXnat(object):
                 warn(e.message)
         return
 
+    @timed('stage_session')
     def stage_session(self, ses=None):
         """
         https://groups.google.com/forum/#!topic/xnat_discussion/SHWAxHNb570
@@ -253,6 +364,8 @@ class StageXnat(object):
         if ses:
             assert(isinstance(ses, pyxnat.core.resources.Experiment))
             self.session = ses
+        if self.cache_quota is not None:
+            self.ensure_cache_space()
         try:
             self.stage_scan(self.scans()[0]) # KLUDGE:  default scan will be ignored by stage_rawdata
         except (StopIteration, KeyError) as e:
@@ -272,9 +385,12 @@ class StageXnat(object):
         else:
             for t in self.tracers:
                 self.stage_rawdata(self.session, t)
+        if self.cache_quota is not None and os.path.isdir(self.dir_session):
+            CacheManager(self.cachedir, quota=self.cache_quota).touch(self.dir_session)
         return
 
 
+    @timed('stage_scan')
     def stage_scan(self, scn=None, ses=None, sdir=None):
         if scn:
             self.scan = scn
@@ -285,6 +401,7 @@ class StageXnat(object):
             sdir = self.dir_scan
         return self.stage_dicoms_scan(self.scan, ses=ses, ddir=sdir)
 
+    @timed('stage_ct')
     def stage_ct(self, obj):
         # recursion for Subjects
         if isinstance(obj, pyxnat.core.resources.Subject):
@@ -308,6 +425,7 @@ class StageXnat(object):
 
         raise AssertionError("stage_ct could not find a ct experiments_list for %s" % str(obj))
 
+    @timed('stage_umaps')
     def stage_umaps(self, ses=None, umap_desc=u'Head_MRAC_Brain_HiRes_in_UMAP'):
         """
         downloads .dcm files for all umaps from a session, saving to a folder named self.umap_desc
@@ -324,6 +442,10 @@ class StageXnat(object):
             assert(isinstance(ses, pyxnat.core.resources.Experiment))
             self.session = ses
         if os.path.exists(self.dir_umaps):
+            self.metrics.count(cache_hits=1)
+            if self.stack_umaps:
+                self.stack_umap_volumes(
+                    [os.path.join(self.dir_umaps, d) for d in sorted(os.listdir(self.dir_umaps))])
             return None
         upaths = []
         scans = ses.scans('*')
@@ -338,13 +460,17 @@ class StageXnat(object):
                     #    warn(e.message)
                     for d in ds:
                         s.resource('DICOM').file(d).get(os.path.join(self.dir_scan, d))
+                        self.metrics.count(bytes=os.path.getsize(os.path.join(self.dir_scan, d)))
                         #self.session.resource('DICOM').file(d).get(self.dir_scan)
                     upaths.append(
                         self.move_scan(self.dir_scan, self.dir_umaps, scaninfo=dinfo))
             except (IOError, InvalidDicomError, TypeError, IndexError, DataError) as e:
                 warn(e.message)
+        if self.stack_umaps:
+            self.stack_umap_volumes(upaths)
         return upaths
 
+    @timed('stage_dicom0_scan')
     def stage_dicom0_scan(self, scn, fs='*.dcm'):
         """
         stages 0th DICOM for header information for scan
@@ -362,11 +488,15 @@ class StageXnat(object):
             except KeyError:
                 try:
                     self.scan.resource('DICOM').file(ds[0]).get(ds0)
+                    self.metrics.count(bytes=os.path.getsize(ds0))
                 except pyxnat.core.errors.DataError as e:
                     warn(e.message)
                     return None
+        else:
+            self.metrics.count(cache_hits=1)
         return pydicom.dcmread(ds0)
 
+    @timed('stage_dicoms_scan')
     def stage_dicoms_scan(self, scn=None, ses=None, ddir=None, fs='*.dcm'):
         """
         stages all DICOMs for a scan
@@ -384,10 +514,12 @@ class StageXnat(object):
         if not ddir:
             ddir = self.dir_scan
         if os.path.exists(ddir):
+            self.metrics.count(cache_hits=1)
             return None
         ds = self.scan.resources().files(fs).get()
         return self.__download_scan(ds, self.__get_dicomdict, sessid=ses.id(), scanid=self.scan.id(), fdir=ddir)
 
+    @timed('stage_rawdata')
     def stage_rawdata(self, ses=None, tracer='Fluorodeoxyglucose'):
         """
         downloads and arranges session rawdata as .dcm files in class param dir_rawdata and
@@ -414,6 +546,7 @@ class StageXnat(object):
             warn(e.message)
         return dests
 
+    @timed('stage_rawdata_zip')
     def stage_rawdata_zip(self, ses=None, tracer='Fluorodeoxyglucose', unzipped=None):
         if ses:
             assert(isinstance(ses, pyxnat.core.resources.Experiment))
@@ -434,6 +567,7 @@ class StageXnat(object):
             warn(e.message)
         return dests
 
+    @timed('stage_rawdata_existing')
     def stage_rawdata_existing(self, ses=None, tracer='Fluorodeoxyglucose'):
         if ses:
             assert(isinstance(ses, pyxnat.core.resources.Experiment))
@@ -452,6 +586,7 @@ class StageXnat(object):
             warn(e.message)
         return dests
 
+    @timed('stage_dicoms_rawdata')
     def stage_dicoms_rawdata(self, ses=None, dcms0='*.dcm', do_pull=True):
         """
         downloads all .dcm files from session resources RawData to class param dir_rawdata;
@@ -474,6 +609,7 @@ class StageXnat(object):
             warn(e.message)
             return None
 
+    @timed('stage_bfiles_rawdata')
     def stage_bfiles_rawdata(self, ses=None, dcms0='*.dcm', tracer='Fluorodeoxyglucose', do_pull=True):
         """
         downloads .bf files from the session resources RawData to class param dir_rawdata
@@ -498,6 +634,7 @@ class StageXnat(object):
             warn(e.message)
             return None
 
+    @timed('stage_bfiles_existing')
     def stage_bfiles_existing(self, ses=None, dcms0='*.dcm', tracer='Fluorodeoxyglucose'):
         """
         downloads .bf files from the session resources RawData to class param dir_rawdata
@@ -520,18 +657,27 @@ class StageXnat(object):
             warn(e.message)
             return None
 
+    @timed('stage_freesurfer')
     def stage_freesurfer(self):
         """
-        downloads assessors labeled freesurfer from a session
-        :return __download_assessors():
+        downloads the mri/ volumes of assessors labeled freesurfer from a session, falling back to the zip of all
+        assessor files if the assessor resources cannot be listed
+        :return __download_freesurfer_mri() or __download_assessors():
         """
         from glob2 import glob
         fs = glob(os.path.join(self.dir_session, self.str_session + '_freesurfer_*'))
         if fs and os.path.isdir(fs[0]):
+            self.metrics.count(cache_hits=1)
             return fs[0]
         try:
-            mri_symlink = self.__download_assessors()
+            mri_symlink = self.__download_freesurfer_mri()
+        except (AssertionError, ValueError, KeyError) as e:
+            warn('StageXnat.stage_freesurfer could not list assessor resources; downloading their zip:  %s' % e)
+            mri_symlink = None
+        if mri_symlink:
             return mri_symlink
+        try:
+            return self.__download_assessors()
         except AssertionError as e:
             warn(e.message)
             return None
@@ -540,6 +686,16 @@ class StageXnat(object):
 
     # UTILITIES #############################################################################
 
+    @timed('listmode')
+    def count_rates(self, bf):
+        """
+        :param bf is a PETLINK 32-bit listmode file, e.g., as staged by move_rawdata:
+        :return xnatpet.listmode.CountRates, as prompts and delays per second:
+        """
+        from listmode import Listmode
+        self.metrics.count(bytes=os.path.getsize(bf))
+        return Listmode(bf).count_rates()
+
     def dcm_acquisitiontime(self, dcm):
         """
         provides best estimate of start time (GMT) of MR sequences, PET acquisitions
@@ -572,6 +728,24 @@ class StageXnat(object):
         d = self.__get_dicom(dcm)
         return d.StudyTime # hhmmss.ffffff after http://dicom.nema.org/medical/dicom/current/output/chtml/part05/sect_6.2.html
 
+    @timed('ensure_cache_space')
+    def ensure_cache_space(self):
+        """
+        asks a CacheManager of cachedir for the bytes of the resources of the session not already staged, evicting
+        least-recently-used folders not pinned by pending reconstructions and not of the session
+        :return True if the session fits within self.cache_quota:
+        """
+        cookie = self.__jsession_request()
+        u = self.host + "/data/experiments/%s/resources?format=json" % self.str_session
+        r = self.__get_url(u, headers=cookie, verify=False)
+        nbytes = sum(int(res.get('file_size') or 0) for res in r.json()["ResultSet"]["Result"])
+        self.__jsession_expire(cookie)
+        cm = CacheManager(self.cachedir, quota=self.cache_quota)
+        if os.path.isdir(self.dir_session):
+            cm.touch(self.dir_session)
+            nbytes = max(0, nbytes - cm.folder_bytes(self.dir_session))
+        return cm.ensure_space(nbytes, keep=self.dir_session)
+
     def ensuredir(self, d):
         try:
             if not os.path.exists(d):
@@ -593,20 +767,16 @@ class StageXnat(object):
         return root + ".bf"
 
     def ifh_imageduration(self, dcm):
-        lm_dict = self.__get_interfile(dcm)
-        return lm_dict['image duration']['value'] # sec
+        return self.__get_petlink(dcm).image_duration # sec
 
     def ifh_studydate(self, dcm):
-        lm_dict = self.__get_interfile(dcm)
-        return lm_dict['study date']['value'] # yyyy:mm:dd
+        return self.__get_petlink(dcm).study_date.strftime('%Y:%m:%d') # yyyy:mm:dd
 
     def ifh_studytime(self, dcm):
-        lm_dict = self.__get_interfile(dcm)
-        return lm_dict['study time']['value'] # hh:mm:ss GMT+00:00
+        return self.__get_petlink(dcm).study_time.strftime('%H:%M:%S') # hh:mm:ss GMT+00:00
 
     def ifh_tracer(self, dcm):
-        lm_dict = self.__get_interfile(dcm)
-        return lm_dict['Radiopharmaceutical']['value']
+        return self.__get_petlink(dcm).tracer
 
     def is_norm(self, dcm):
         return self.__is_imagetype3(dcm, 'PET_NORM')
@@ -614,6 +784,7 @@ class StageXnat(object):
     def is_listmode(self, dcm):
         return self.__is_imagetype3(dcm, 'PET_LISTMODE')
 
+    @timed('parse')
     def is_tracer(self, dcm, tracer):
         import re
         with open(dcm, 'r') as fid:
@@ -626,6 +797,7 @@ class StageXnat(object):
         d = self.__get_dicom(dcm)
         return u'UMAP' in d.SeriesDescription # == u'Head_MRAC_Brain_HiRes_in_UMAP'
 
+    @timed('list')
     def list_rawdata(self, obj):
         lst = []
         if isinstance(obj, str):
@@ -658,21 +830,43 @@ class StageXnat(object):
             lst = [os.path.join(self.dir_rawdata, obj)]
         return lst
 
+    @timed('move')
     def move_rawdata(self, rfile0, tracer):
         """
         moves rawdata original file, .dcm or .bf, to file in new target directory
         :param rfile0 is the originating file:
         :param tracer from class param tracers:
-        :return rfile:
+        :return rfile, which is .bfz for .bf if compress_bf:
         """
         from os import path
         import shutil
         rtarg = self.rawdata_destination(rfile0, tracer)
         self.ensuredir(rtarg)
         rfile = path.join(rtarg, path.basename(rfile0))
-        shutil.move(rfile0, rfile)
+        if self.use_objectstore:
+            ObjectStore(self.cachedir).put(rfile0, rfile)
+        else:
+            shutil.move(rfile0, rfile)
+        if self.compress_bf and rfile.endswith('.bf'):
+            rfile = self.compress_rawdata(rfile)
+        if self.write_sidecar:
+            self.update_sidecar(rtarg)
         return rfile
 
+    @timed('compress')
+    def compress_rawdata(self, bf):
+        """
+        replaces bf with its .bfz, compressed in independently decodable chunks
+        :param bf is a staged listmode file:
+        :return .bfz filename:
+        """
+        from compressedbf import CompressedBf
+        c = CompressedBf.compress(bf, remove=True)
+        self.metrics.count(bytes=c.raw_bytes)
+        print('StageXnat.compress_rawdata:  %s %.2f:1' % (c.path, c.ratio))
+        return c.path
+
+    @timed('move')
     def move_scan(self, spath0, starg, scaninfo):
         """
         moves .dcm from originating scan path (:= scaninfo) to new target scan path (:= scaninfo)
@@ -690,17 +884,64 @@ class StageXnat(object):
                           str(scaninfo.AcquisitionTime))
         if os.path.exists(spath):
             shutil.rmtree(spath)
+        if self.use_objectstore:
+            store = ObjectStore(self.cachedir)
+            for dirpath, dirnames, files in os.walk(spath0):
+                for f in files:
+                    fn = path.join(dirpath, f)
+                    store.put(fn, path.join(spath, path.relpath(fn, spath0)))
+            shutil.rmtree(spath0)
+            return spath
         shutil.move(spath0, spath)
         return spath
 
+    @timed('umap_volume')
+    def stack_umap_volumes(self, upaths):
+        """
+        stacks the slices of each umap series into one volume, skipping series already stacked from the same slices
+        :param upaths are umap folders from stage_umaps:
+        :return list of volumes written:
+        """
+        from umapvolume import stack_folders
+        written = stack_folders([u for u in upaths if os.path.isdir(u)])
+        self.metrics.count(cache_hits=len(upaths) - len(written))
+        return written
+
+    @timed('sidecar')
+    def update_sidecar(self, folder):
+        """
+        records each .dcm of folder having its .bf in the Sidecar of folder
+        :param folder is a tracer folder from rawdata_destination:
+        :return list of basenames recorded:
+        """
+        return Sidecar(folder).update()
+
+    def metrics_fields(self):
+        """
+        :return fields identifying the current session and scan for records of self.metrics:
+        """
+        fields = {}
+        if isinstance(self.__session, pyxnat.core.resources.Experiment):
+            fields['session'] = self.__session._urn
+        elif self.__session is None and self.__ids['ses']:
+            fields['session'] = self.__ids['ses']
+        if isinstance(self.__scan, pyxnat.core.resources.Scan):
+            fields['scan'] = self.__scan._urn
+        elif self.__scan is None and self.__ids['scn']:
+            fields['scan'] = str(self.__ids['scn'])
+        return fields
+
     def on_schedule(self):
         return True
 
+    @timed('download')
     def pull_rawdata_files(self, fs, dest):
         resource = self.session.resource('RawData')
         for f in fs:
             resource.file(f).get(os.path.join(dest, f))
+            self.metrics.count(bytes=os.path.getsize(os.path.join(dest, f)))
 
+    @timed('pull_rawdata_zip')
     def pull_rawdata_zip(self, do_pull=True):
         """
         pulls self.session.resource('RawData').files('*.zip')
@@ -720,6 +961,9 @@ class StageXnat(object):
             z1 = join(self.dir_rawdata, z)
             if not exists(z1):
                 resource.file(z).get(z1)
+                self.metrics.count(bytes=os.path.getsize(z1))
+            else:
+                self.metrics.count(cache_hits=1)
             try:
                 zf = ZipFile(z1, 'r')
                 zf.extractall(self.dir_rawdata)
@@ -776,6 +1020,7 @@ class StageXnat(object):
             return False
         return '.CT.Head' in file_list[0]
 
+    @timed('parse')
     def tracer_label(self, t, b):
         from pydicom import dcmread
         d = dcmread(self.filename2dcm(b))
@@ -786,11 +1031,13 @@ class StageXnat(object):
             'Oxygen-water': 'HO',
         }[t]
 
+    @timed('parse')
     def visit_label(self, b):
         from pydicom import dcmread
         d = dcmread(self.filename2dcm(b))
         return 'DT' + d.StudyDate + d.SeriesTime # str DTYYYYMMDDhhmmss.xxxxxx
 
+    @timed('move')
     def walk_and_move(self, z, dest):
         """
         https://stackoverflow.com/questions/25675352/how-to-check-to-see-if-a-folder-contains-files-using-python-3
@@ -814,6 +1061,7 @@ class StageXnat(object):
 
     # CLASS-PRIVATE #########################################################################
 
+    @timed('download')
     def __download_assessors(self, variety='ALL', vtype='files'):
         """
         See also John Flavin's dcm2ni_wholeSession.py
@@ -821,13 +1069,12 @@ class StageXnat(object):
         :vtype is the variety type:
         :return filesystem with archive unpacked to self.dir_session && creation of symlink to freesurfer mri
         """
-        from shutil import copyfileobj
         from zipfile import ZipFile
         from zipfile import BadZipfile
         from glob2 import glob
 
         cookie = self.__jsession_request()
-        uri = self.host + "/data/experiments_list/%s/assessors/%s/%s?format=zip" % (self.str_session, variety, vtype)
+        uri = self.host + "/data/experiments/%s/assessors/%s/%s?format=zip" % (self.str_session, variety, vtype)
         zip = 'assessors_%s_%s.zip' % (variety, vtype)
         mri = os.path.join(self.dir_session, 'mri')
 
@@ -838,7 +1085,7 @@ class StageXnat(object):
                 r = self.__get_url(uri, headers=cookie, verify=False, stream=True)
                 if not r:
                     return None
-                copyfileobj(r.raw, f)
+                self.__write_stream(r, f)
             z = ZipFile(zip, 'r')
             z.extractall(self.dir_session)
             z.close()
@@ -848,10 +1095,91 @@ class StageXnat(object):
             print('Downloaded assessors %s to %s.\n' % (uri, zip))
         except (BadZipfile, IOError) as e:
             warn(e.message)
-
-        self.__jsession_expire(cookie)
+        finally:
+            self.__jsession_expire(cookie)
         return mri
 
+    @timed('download')
+    def __download_freesurfer_mri(self):
+        """
+        lists the resources of freesurfer assessors and concurrently downloads only files of their mri/ subtrees
+        matching self.freesurfer_mri, laid out as by the zip archive of __download_assessors
+        :return symlink self.dir_session/mri to mri/ of the first freesurfer assessor, or None if there is none:
+        """
+        from fnmatch import fnmatch
+        from multiprocessing.pool import ThreadPool
+        from functools import partial
+
+        cookie = self.__jsession_request()
+        try:
+            base = self.host + "/data/experiments/%s/assessors" % self.str_session
+            mri = os.path.join(self.dir_session, 'mri')
+            mri_dirs = []
+            jobs = []
+            r = self.__get_url(base + "?format=json", headers=cookie, verify=False)
+            for a in sorted(r.json()["ResultSet"]["Result"], key=lambda a: a['label']):
+                if 'freesurfer' not in a['label'].lower() and a.get('xsiType') != 'fs:fsData':
+                    continue
+                u = base + "/%s/out/resources?format=json" % a['ID']
+                for res in self.__get_url(u, headers=cookie, verify=False).json()["ResultSet"]["Result"]:
+                    u = base + "/%s/out/resources/%s/files?format=json&locator=absolutePath" % (a['ID'], res['label'])
+                    for obj in self.__get_url(u, headers=cookie, verify=False).json()["ResultSet"]["Result"]:
+                        rel = obj['URI'].split('/files/', 1)[1].split('/')
+                        if 'mri' not in rel[:-1]:
+                            continue
+                        i = rel.index('mri')
+                        if not any(fnmatch('/'.join(rel[i+1:]), p) for p in self.freesurfer_mri):
+                            continue
+                        fdir = os.path.join(a['label'], 'out', 'resources', res['label'], 'files')
+                        if os.path.join(fdir, *rel[:i+1]) not in mri_dirs:
+                            mri_dirs.append(os.path.join(fdir, *rel[:i+1]))
+                        jobs.append((os.path.join(self.dir_session, fdir, *rel),
+                                     {'URI': self.host + obj['URI'], 'absolutePath': obj.get('absolutePath', ''),
+                                      'Size': int(obj.get('Size') or 0)}))
+            if not mri_dirs:
+                return None
+
+            print('Downloading %d freesurfer mri files to %s.' % (len(jobs), self.dir_session))
+            pool = ThreadPool(max(1, min(self.download_threads, len(jobs))))
+            try:
+                fetched = pool.map(partial(self.__fetch_file, cookie), jobs)
+            finally:
+                pool.close()
+                pool.join()
+            self.metrics.count(bytes=sum(f[0] for f in fetched), requests=sum(f[1] for f in fetched),
+                               cache_hits=sum(f[2] for f in fetched))
+            self.ensuredir(self.dir_session)
+            os.chdir(self.dir_session)
+            if not os.path.lexists(mri):
+                os.symlink(mri_dirs[0], mri)
+            return mri
+        finally:
+            self.__jsession_expire(cookie)
+
+    def __fetch_file(self, cookie, job):
+        """
+        is run by threads of __download_freesurfer_mri, whose metrics records are not open in those threads
+        :param cookie:
+        :param job is (local filename, dict with 'URI', 'absolutePath', 'Size'):
+        :return (bytes, requests, cache hits):
+        """
+        name, path_dict = job
+        if os.path.exists(name) and os.path.getsize(name) == path_dict['Size']:
+            return 0, 0, 1
+        self.ensuredir(os.path.dirname(name))
+        if os.access(path_dict['absolutePath'], os.R_OK):
+            self.__symlink(name, path_dict)
+            return 0, 0, 0
+        try:
+            with open(name, 'wb') as f:
+                r = self.__get_url(path_dict['URI'], headers=cookie, verify=False, stream=True)
+                self.__write_stream(r, f)
+        except IOError as e:
+            warn('fname must be a filename; dest must be a directory')
+            raise AssertionError(e.message)
+        return os.path.getsize(name), 1, 0
+
+    @timed('download')
     def __download_scan(self, fnames, get_datadict, sessid=None, scanid=None, fdir=None):
         """
         See also John Flavin's dcm2ni_wholeSession.py
@@ -878,10 +1206,7 @@ class StageXnat(object):
             try:
                 with open(name, 'wb') as f:
                     r = self.__get_url(path_dict['URI'], headers=cookie, verify=False, stream=True)
-                    for block in r.iter_content(1024):
-                        if not block:
-                            break
-                        f.write(block)
+                    self.__write_stream(r, f)
             except IOError as e:
                 warn('fname must be a filename; dest must be a directory')
                 raise AssertionError(e.message)
@@ -889,6 +1214,7 @@ class StageXnat(object):
         self.__jsession_expire(cookie)
         return ddict
 
+    @timed('download')
     def __download_files(self, fnames, get_datadict, sessid=None, scanid=None, fdir=None):
         """
         See also John Flavin's dcm2ni_wholeSession.py
@@ -920,15 +1246,13 @@ class StageXnat(object):
                         self.__symlink(name, path_dict)
                     elif os.path.exists(name):
                         print("found file %s in %s." % (name, fdir))
+                        self.metrics.count(cache_hits=1)
                         path_dict['localPath'] = os.path.join(fdir, name)  # CHECK:  path_dict overwritten?  <JJL 2018-02-24>
                     else:
                         try:
                             with open(name, 'wb') as f:
                                 r = self.__get_url(path_dict['URI'], headers=cookie, verify=False, stream=True)
-                                for block in r.iter_content(1024):
-                                    if not block:
-                                        break
-                                    f.write(block)
+                                self.__write_stream(r, f)
                         except IOError as e:
                             warn('fname must be a filename; dest must be a directory')
                             raise AssertionError(e.message)
@@ -937,15 +1261,18 @@ class StageXnat(object):
         self.__jsession_expire(cookie)
         return ddict
 
+    @timed('download')
     def __download_legacy(self):
         """
-        Is the legacy implementation from John Flavin's dcm2ni_wholeSession.py
+        Is the legacy implementation from John Flavin's dcm2ni_wholeSession.py.
+        Secondary captures, reports and non-imaging scans are skipped, using the scan listing or a probe of the leading
+        bytes of one DICOM, before any bulk transfer; skipped bytes are counted as metrics bytes_avoided.
         """
-        import pydicom
         cookie = self.__jsession_request()
-        scanid_list = self.__get_scanid_list(cookie)
+        scan_list = self.__get_scan_list(cookie)
 
-        for scanid in scanid_list:
+        for scan in scan_list:
+            scanid = scan['ID']
             print('\nBeginning process for scan %s.' % scanid)
             skip_scan = False
 
@@ -961,15 +1288,26 @@ class StageXnat(object):
             if int(dicom_resource["file_count"]) == 0:
                 print("DICOM resource for scan %s has no files. Skipping." % scanid)
                 continue
+            if scan.get('xsiType') in self.skip_xsitypes:
+                print("Scan %s is %s. Skipping." % (scanid, scan['xsiType']))
+                self.metrics.count(bytes_avoided=int(dicom_resource.get("file_size") or 0))
+                continue
+
+            # probe the first DICOM before downloading any of them
+            dcmdict = self.__get_dicomdict(cookie, sessid=self.str_session, scanid=scanid)
+            first = sorted(dcmdict)[0]
+            skip_scan, nbytes = self.__probe_skip_scan(cookie, first, dcmdict[first])
+            if skip_scan:
+                print('Scan %s is a secondary capture, report or non-imaging. Skipping.' % scanid)
+                self.metrics.count(bytes_avoided=sum(d['Size'] for d in dcmdict.values()) - nbytes)
+                continue
 
             # download DICOMs
             print("Downloading files for scan %s." % scanid)
-            dcmdict = self.__get_dicomdict(cookie, sessid=self.str_session, scanid=scanid)
             self.ensuredir(self.cachedir)
             os.chdir(self.cachedir)
-            for j, (name, path_dict) in enumerate(dcmdict.iteritems()):
-                skip_scan = False
-
+            for name in sorted(dcmdict):
+                path_dict = dcmdict[name]
                 if os.access(path_dict['absolutePath'], os.R_OK):
                     self.__symlink(name, path_dict)
                 else:
@@ -979,29 +1317,12 @@ class StageXnat(object):
                             if not r.ok:
                                 print("Could not download file %s. Skipping scan %s." % (name, scanid))
                                 skip_scan = True
-                                continue  # break out of file download loop
-                            for block in r.iter_content(1024):
-                                if not block:
-                                    break
-                                f.write(block)
+                                break  # out of file download loop
+                            self.__write_stream(r, f)
                         print('Downloaded file %s.' % name)
                     except IOError as e:
                         warn('fname must be a filename; dest must be a directory')
                         raise AssertionError(e.message)
-
-                if j == 0 and not skip_scan:
-                    dcm = pydicom.dcmread(name)
-                    modality_header = dcm.get((0x0008, 0x0060), None)
-                    if modality_header:
-                        skip_scan = self.__check_skip_scan(name, modality_header)
-                        if skip_scan:
-                            print('Scan %s is a secondary capture. Skipping.' % scanid)
-                            continue  # break out of file download loop
-                    else:
-                        print('Could not read modality from DICOM headers. Skipping.')
-                        skip_scan = True
-                        continue  # break out of file download loop
-
                 path_dict['localPath'] = os.path.join(self.cachedir, name)
 
             os.chdir(self.cachedir)
@@ -1024,25 +1345,26 @@ class StageXnat(object):
         print('Checking modality in DICOM headers of file %s.' % name)
         print('Modality header: %s' % modality_header)
         modality = modality_header.value.strip("'").strip('"')
-        skip = modality == 'SC' or modality == 'SR'
+        skip = modality in self.skip_modalities
         return skip
 
     def __get_assessor(self, cookie):
 
         # get list of objects
-        u = self.host + "/data/experiments_list/%s/assessors/ALL/resources/*freesurfer*/files?format=json" % self.str_session
+        u = self.host + "/data/experiments/%s/assessors/ALL/resources/*freesurfer*/files?format=json" % self.str_session
         r = self.__get_url(u, headers=cookie, verify=False)
 
         # John Flavin:  "I don't like the results being in a list, so I will build a dict keyed off file name"
         adict = {obj['Name']: {'URI': self.host+obj['URI']} for obj in r.json()["ResultSet"]["Result"]}
 
         # have to manually add absolutePath with a separate request
-        u = self.host + "/data/experiments_list/%s/assessors/All/resources/*freesurfer*/files?format=json&locator=absolutePath" % self.str_session
+        u = self.host + "/data/experiments/%s/assessors/All/resources/*freesurfer*/files?format=json&locator=absolutePath" % self.str_session
         r = self.__get_url(u, headers=cookie, verify=False)
         for a in r.json()["ResultSet"]["Result"]:
             adict[a['Name']]['absolutePath'] = self.host+a['absolutePath']
         return adict
 
+    @timed('parse')
     def __get_dicom(self, dcm):
         """
         :param dcm:
@@ -1055,6 +1377,7 @@ class StageXnat(object):
             raise AssertionError('dcm must be a filename')
         return dcm_datset
 
+    @timed('list')
     def __get_dicomdict(self, cookie, sessid=None, scanid=None):
         """
         :param cookie is from self.host+/data/JSESSION:
@@ -1068,15 +1391,15 @@ class StageXnat(object):
             raise AssertionError("self.__get_dicomdict has no scanid")
 
         # get list of DICOMs
-        u = self.host + "/data/experiments_list/%s/scans/%s/resources/DICOM/files?format=json" % (sessid, scanid)
+        u = self.host + "/data/experiments/%s/scans/%s/resources/DICOM/files?format=json" % (sessid, scanid)
         r = self.__get_url(u, headers=cookie, verify=False)
 
         # John Flavin:  "I don't like the results being in a list, so I will build a dict keyed off file name"
-        ddict = {dicom['Name']: {'URI': self.host+dicom['URI']}
+        ddict = {dicom['Name']: {'URI': self.host+dicom['URI'], 'Size': int(dicom.get('Size') or 0)}
                  for dicom in r.json()["ResultSet"]["Result"]}
 
         # John Flavin:  manually add absolutePath with a separate request
-        u = self.host + "/data/experiments_list/%s/scans/%s/resources/DICOM/files?format=json&locator=absolutePath" % (sessid, scanid)
+        u = self.host + "/data/experiments/%s/scans/%s/resources/DICOM/files?format=json&locator=absolutePath" % (sessid, scanid)
         r = self.__get_url(u, headers=cookie, verify=False)
         for dcm in r.json()["ResultSet"]["Result"]:
             ddict[dcm['Name']]['absolutePath'] = self.host+dcm['absolutePath']
@@ -1091,18 +1414,20 @@ class StageXnat(object):
             os.remove(os.path.join(ddir, f))
         return ddir
 
-    def __get_interfile(self, dcm):
+    @timed('parse')
+    def __get_petlink(self, dcm):
         """
-        :param dcm:
-        :return lm_dict, a dictionary of interfile fields:
+        :param dcm is a listmode or norm .dcm:
+        :return xnatpet.petlink.PetlinkHeader, from the shared petlink_cache:
         """
-        from interfile import Interfile
         try:
-            lm_dict = Interfile.load(dcm)
-        except (AttributeError, TypeError):
+            if petlink_cache.cached(dcm):
+                self.metrics.count(cache_hits=1)
+            return petlink_cache.get(dcm)
+        except (AttributeError, TypeError, OSError):
             raise AssertionError('dcm must be a filename')
-        return lm_dict
 
+    @timed('list')
     def __get_rawdatadict(self, cookie, sessid=None, scanid=None):
         """
         :param cookie is from self.host+/data/JSESSION:
@@ -1113,19 +1438,20 @@ class StageXnat(object):
 
         # get list of DICOMs
         #print('__get_rawdatadict:  for session %s.' % self.str_session)
-        u = self.host + "/data/experiments_list/%s/resources/RawData/files?format=json" % self.str_session
+        u = self.host + "/data/experiments/%s/resources/RawData/files?format=json" % self.str_session
         r = self.__get_url(u, headers=cookie, verify=False)
 
         # John Flavin:  "I don't like the results being in a list, so I will build a dict keyed off file name"
         rddict = {rd['Name']: {'URI': self.host+rd['URI']} for rd in r.json()["ResultSet"]["Result"]}
 
         # have to manually add absolutePath with a separate request
-        u = self.host + "/data/experiments_list/%s/resources/RawData/files?format=json&locator=absolutePath" % self.str_session
+        u = self.host + "/data/experiments/%s/resources/RawData/files?format=json&locator=absolutePath" % self.str_session
         r = self.__get_url(u, headers=cookie, verify=False)
         for rd1 in r.json()["ResultSet"]["Result"]:
             rddict[rd1['Name']]['absolutePath'] = self.host+rd1['absolutePath']
         return rddict
 
+    @timed('list')
     def __get_scan_resources(self, cookie, scanid):
         """
         is used by __download_legacy
@@ -1134,39 +1460,47 @@ class StageXnat(object):
         :return:
         """
         print("\n__get_scan_resources:  for scan %s.\n" % scanid)
-        u = self.host + "/data/experiments_list/%s/scans/%s/resources?format=json" % (self.str_session, scanid)
+        u = self.host + "/data/experiments/%s/scans/%s/resources?format=json" % (self.str_session, scanid)
         r = self.__get_url(u, headers=cookie, verify=False)
         resources = r.json()["ResultSet"]["Result"]
         #print('Found resources %s.' % ', '.join(res["label"] for res in resources))
         return resources
 
-    def __get_scanid_list(self, cookie):
+    @timed('list')
+    def __get_scan_list(self, cookie):
         """
         is used by __download_legacy
         :param cookie:
-        :return:
+        :return list of dict with 'ID', 'xsiType', 'type', ... from requests.json()["ResultSet"]["Result"]:
         """
-        print("\n__get_scanid_list:  for session ID %s.\n" % self.str_session)
-        u = self.host + "/data/experiments_list/%s/scans?format=json" % self.str_session
+        print("\n__get_scan_list:  for session ID %s.\n" % self.str_session)
+        u = self.host + "/data/experiments/%s/scans?format=json" % self.str_session
         r = self.__get_url(u, headers=cookie, verify=False)
-        sid_list = r.json()["ResultSet"]["Result"]
-        idl = [scn['ID'] for scn in sid_list]
-        #print('Found scans %s.' % ', '.join(idl))
-        return idl
+        return r.json()["ResultSet"]["Result"]
 
+    @timed('get_url')
     def __get_url(self, url, **kwargs):
-        import requests, sys
+        import requests, time
         if self.debug_uri:
             print("__get_url.url->%s" + url)
-        try:
-            r = requests.get(url, **kwargs)
-            r.raise_for_status()
-        except (requests.ConnectionError, requests.exceptions.RequestException) as e:
-            raise AssertionError(e.message)
+        for attempt in range(self.url_retries + 1):
+            try:
+                self.metrics.count(requests=1)
+                r = requests.get(url, **kwargs)
+                r.raise_for_status()
+                break
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.url_retries:
+                    raise AssertionError(e.message)
+                self.metrics.count(retries=1)
+                time.sleep(2**attempt)
+            except requests.exceptions.RequestException as e:
+                raise AssertionError(e.message)
         if not r.ok:
             raise AssertionError("request.ok on %s was false" % url)
         return r
 
+    @timed('parse')
     def __is_imagetype3(self, dcm, itype3):
         import pydicom
         try:
@@ -1180,6 +1514,11 @@ class StageXnat(object):
         cookie = {"Cookie": "JSESSIONID=" + r.content}
         return cookie
 
+    def __count_response(self, r, *args, **kwargs):
+        """is a requests hook counting requests issued by pyxnat"""
+        self.metrics.count(requests=1)
+        return r
+
     def __jsession_expire(self, cookie):
         import requests
         requests.delete(self.host + "/data/JSESSION", headers=cookie, verify=False)
@@ -1191,6 +1530,43 @@ class StageXnat(object):
             lst1.append(os.path.basename(i))
         return lst1
 
+    def __probe_skip_scan(self, cookie, name, path_dict):
+        """
+        reads only the leading bytes of a DICOM, growing an HTTP range request until its header parses as far as
+        Modality (0008,0060)
+        :param cookie:
+        :param name of the DICOM:
+        :param path_dict with 'URI', 'absolutePath' and 'Size':
+        :return (skip, bytes transferred):
+        """
+        import pydicom
+        from io import BytesIO
+        n = self.probe_bytes
+        nbytes = 0
+        while True:
+            if os.access(path_dict['absolutePath'], os.R_OK):
+                with open(path_dict['absolutePath'], 'rb') as f:
+                    head = f.read(n)
+            else:
+                headers = dict(cookie)
+                headers['Range'] = 'bytes=0-%d' % (n - 1)
+                r = self.__get_url(path_dict['URI'], headers=headers, verify=False, stream=True)
+                head = r.raw.read(n, decode_content=True) # the server may ignore Range
+                r.close()
+                nbytes += len(head)
+                self.metrics.count(bytes=len(head))
+            try:
+                modality_header = pydicom.dcmread(BytesIO(head), stop_before_pixels=True, force=True).get(
+                    (0x0008, 0x0060), None)
+            except Exception:
+                modality_header = None
+            if modality_header:
+                return self.__check_skip_scan(name, modality_header), nbytes
+            if len(head) < n or (path_dict['Size'] and n >= path_dict['Size']): # Size 0 is unknown
+                print('Could not read modality from DICOM headers. Skipping.')
+                return True, nbytes
+            n *= 4
+
     def __resources_available(self):
         return True
 
@@ -1204,12 +1580,24 @@ class StageXnat(object):
             print('Copied %s.' % path_dict['absolutePath'])
         return
 
+    def __write_stream(self, r, f):
+        """
+        :param r is a streaming requests.Response:
+        :param f is a file opened for writing bytes:
+        """
+        for block in r.iter_content(self.block_size):
+            if not block:
+                break
+            f.write(block)
+            self.metrics.count(bytes=len(block))
+
     def __wait(self):
         import time
         time.sleep(self.sleep_duration)
         return
 
-    def __init__(self, user, password, cachedir="/scratch/jjlee/Singularity", prj="CCIR_00754", sbj=None, ses=None, scn=None):
+    def __init__(self, user, password, cachedir="/scratch/jjlee/Singularity", prj="CCIR_00754", sbj=None, ses=None, scn=None,
+                 host='https://cnda.wustl.edu', metrics=None):
         """
         :param user:
         :param password:
@@ -1218,37 +1606,25 @@ class StageXnat(object):
         :param sbj:
         :param ses:
         :param scn:
+        :param host is the XNAT server, e.g., a local xnatpet.tests.fakexnat.FakeXnat:
+        :param metrics is a JSON-lines file for per-phase timing and byte counts:
+        The pyxnat interface, project, subject, session, scan and resources resolve on first access and are memoized;
+        construction makes no requests of host.
         """
-        self.host     = 'https://cnda.wustl.edu'
+        self.host     = host
+        self.metrics  = Metrics(jsonl=metrics)
         self.user     = user #os.getenv('CNDA_UID')
         self.password = password #os.getenv('CNDA_PWD')
         self.cachedir = cachedir
         os.chdir(self.cachedir)
-        self.xnat     = pyxnat.Interface(self.host, user=self.user, password=self.password, cachedir=self.cachedir)
-        assert(isinstance(self.xnat, pyxnat.core.interfaces.Interface))
-        self.project  = self.xnat.select.project(prj)
-        assert(isinstance(self.project, pyxnat.core.resources.Project))
-        if sbj:
-            self.subject = self.project.subject(sbj)
-            assert(isinstance(self.subject, pyxnat.core.resources.Subject))
-        else:
-            self.subject = self.project.subjects()
-            assert(isinstance(self.subject, pyxnat.resources.Subjects))
-        if ses:
-            self.session = self.subject.experiment(ses)
-            assert(isinstance(self.session, pyxnat.core.resources.Experiment))
-        else:
-            self.session = self.subject.experiments()
-            assert(isinstance(self.session, pyxnat.core.resources.Experiments))
-        if scn:
-            self.scan = self.session.scan(str(scn))
-            assert(isinstance(self.scan, pyxnat.core.resources.Scan))
-        else:
-            self.scan = self.session.scans()
-            assert(isinstance(self.scan, pyxnat.core.resources.Scans))
-
-        self.scan_dicom = self.scan.resource('DICOM')
-        self.rawdata  = self.session.resource('RawData')
+        self.__ids = {'prj': prj, 'sbj': sbj, 'ses': ses, 'scn': scn}
+        self.__xnat = None
+        self.__project = None
+        self.__subject = None
+        self.__session = None
+        self.__scan = None
+        self.__scan_dicom = None
+        self.__rawdata = None
 
 
 
@@ -1283,9 +1659,15 @@ if __name__ == '__main__':
                    required=False,
                    help='must express the constraint API of pyxnat;'
                         'see also https://groups.google.com/forum/#!topic/xnat_discussion/SHWAxHNb570')
+    p.add_argument('-m', '--metrics',
+                   metavar='<file>',
+                   default=None,
+                   required=False,
+                   help='JSON-lines file for per-phase timing and byte counts')
     # \"[(\'<param>\', \'<logical>\', \'<value>\'), \'<LOGICAL>\']\"
     args = p.parse_args()
-    r = StageXnat(os.getenv('CNDA_UID'), os.getenv('CNDA_PWD'), cachedir=args.cachedir, prj=args.project, sbj=args.subject)
+    r = StageXnat(os.getenv('CNDA_UID'), os.getenv('CNDA_PWD'), cachedir=args.cachedir, prj=args.project, sbj=args.subject,
+                  metrics=args.metrics)
     if args.subject:
         r.stage_subject()
     if args.constraints: